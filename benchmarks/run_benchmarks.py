@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for every bundled dataset and engine: load time, single lookup latency (on the overlap and the nearest-gene
+    paths), bulk throughput, command line end-to-end time, and peak memory. Each dataset is also checked against the
+    reference `GeneLocator.at` with `genelocator.differential`.
+
+Results are written as JSON, one record per measurement, so that runs from different releases can be compared:
+    python benchmarks/run_benchmarks.py --out before.json
+    (change things)
+    python benchmarks/run_benchmarks.py --out after.json --compare before.json
+
+Use `--quick` for a fast smoke run with fewer repetitions. Command line runs use the default settings, as a new user
+    would, except that their user cache folder (where binary copies of the bundled datasets are saved) is a temporary
+    one. Single lookups are timed both cold (the first run, which makes the copy) and warm.
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import typing as ty
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+import genelocator  # noqa: E402
+from genelocator import annotate, assets, differential  # noqa: E402
+from genelocator.__version__ import version  # noqa: E402
+
+DATASET_FILENAME = re.compile(r'genes-grch(\d+)-gencode(\d+)-(\w+)\.pickle\.gz$')
+ENGINES = ('tree', 'compact', 'tiled')
+
+
+class Results:
+    def __init__(self):
+        self.records = []  # type: ty.List[dict]
+
+    def add(self, dataset: str, engine: str, metric: str, value: float, unit: str, higher_is_better: bool = False):
+        self.records.append({'dataset': dataset, 'engine': engine, 'metric': metric, 'value': value, 'unit': unit,
+                             'higher_is_better': higher_is_better})
+        print('{:<40} {:<8} {:<28} {:>14.3f} {}'.format(dataset, engine, metric, value, unit), flush=True)
+
+
+def _percentile(values: ty.List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def _run_child(args: ty.List[str], **kwargs) -> ty.Tuple[float, float]:
+    """Run a command, and return (wall seconds, peak RSS in MB)"""
+    started = time.perf_counter()
+    proc = subprocess.Popen(args, cwd=REPO_ROOT, env=dict(os.environ, PYTHONPATH=REPO_ROOT), **kwargs)
+    _, status, usage = os.wait4(proc.pid, 0)
+    elapsed = time.perf_counter() - started
+    proc.returncode = os.waitstatus_to_exitcode(status) if hasattr(os, 'waitstatus_to_exitcode') else status >> 8
+    if proc.returncode != 0:
+        raise RuntimeError('{} exited with status {}'.format(args, proc.returncode))
+    # ru_maxrss is in KB on Linux, and bytes on macOS
+    return elapsed, usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def _classified_positions(locator, n: int, seed: int) -> ty.Tuple[ty.List[tuple], ty.List[tuple]]:
+    """Random positions that fall inside a gene (overlap path), and positions that don't (nearest-gene path)"""
+    positions = differential.random_positions(locator, n * 4, seed=seed)
+    result = locator.at_many([c for c, _ in positions], [p for _, p in positions], strict=False)
+    has_overlap = [False] * len(positions)
+    for query, overlap in zip(result.query_index.tolist(), result.overlap.tolist()):
+        has_overlap[query] = has_overlap[query] or overlap
+    inside = [q for q, o in zip(positions, has_overlap) if o][:n]
+    outside = [q for q, o in zip(positions, has_overlap) if not o][:n]
+    return inside, outside
+
+
+def bench_dataset(results: Results, path: str, *, quick: bool, positions_file: str) -> None:
+    name = os.path.basename(path)
+    build, gencode_version, geneset = DATASET_FILENAME.search(name).groups()
+    n_loads, n_queries, n_bulk = (1, 2000, 20000) if quick else (3, 20000, 200000)
+
+    for engine in ENGINES:
+        load_times = []
+        for _ in range(n_loads):
+            started = time.perf_counter()
+            locator = genelocator.get_genelocator(path, engine=engine, cache=False)
+            load_times.append(time.perf_counter() - started)
+        results.add(name, engine, 'load_seconds', min(load_times), 's')
+        _, rss = _run_child([sys.executable, '-c', 'import sys, genelocator; genelocator.get_genelocator(sys.argv[1], engine=sys.argv[2])',
+                             path, engine])
+        results.add(name, engine, 'load_peak_rss', rss, 'MB')
+
+        started = time.perf_counter()
+        locator.at_many(['1'], [1], strict=False)  # builds the batch index, for the tree engine
+        results.add(name, engine, 'batch_index_build_seconds', time.perf_counter() - started, 's')
+
+        inside, outside = _classified_positions(locator, n_queries, seed=1)
+        for label, queries in (('overlap', inside), ('nearest', outside)):
+            latencies = []
+            at = locator.at
+            for chrom, pos in queries:
+                started = time.perf_counter()
+                at(chrom, pos)
+                latencies.append(time.perf_counter() - started)
+            results.add(name, engine, 'at_{}_p50'.format(label), _percentile(latencies, 50) * 1e6, 'us')
+            results.add(name, engine, 'at_{}_p99'.format(label), _percentile(latencies, 99) * 1e6, 'us')
+
+        bulk = differential.random_positions(locator, n_bulk, seed=2)
+        chroms, pos = [c for c, _ in bulk], [p for _, p in bulk]
+        started = time.perf_counter()
+        locator.at_many(chroms, pos, strict=False)
+        results.add(name, engine, 'at_many_throughput', n_bulk / (time.perf_counter() - started), 'queries/s', True)
+        lines = ['{}\t{}\n'.format(c, p) for c, p in bulk]
+        started = time.perf_counter()
+        annotate.annotate_stream(locator, lines, io.StringIO())
+        results.add(name, engine, 'annotate_throughput', n_bulk / (time.perf_counter() - started), 'rows/s', True)
+
+        checked = differential.edge_positions(locator, max_per_chrom=50 if quick else None) + bulk[:n_queries]
+        mismatches = differential.compare(genelocator.get_genelocator(path, engine='tree'), locator, checked)
+        results.add(name, engine, 'differential_mismatches', len(mismatches), 'count')
+
+        cli = [sys.executable, '-m', 'bin.command_line', 'GRCh{}'.format(build)]
+        options = ['--version', gencode_version, '--engine', engine] + (['--common-genetypes'] if geneset == 'common_genetypes' else [])
+        # The first lookup of a dataset saves a binary copy of it to the user cache folder, for the lookups after it
+        shutil.rmtree(assets.get_copy_dir(), ignore_errors=True)
+        elapsed, _ = _run_child(cli + ['chr19', '234523'] + options, stdout=subprocess.DEVNULL)
+        results.add(name, engine, 'cli_single_cold_seconds', elapsed, 's')
+        elapsed, rss = _run_child(cli + ['chr19', '234523'] + options, stdout=subprocess.DEVNULL)
+        results.add(name, engine, 'cli_single_seconds', elapsed, 's')
+        results.add(name, engine, 'cli_single_peak_rss', rss, 'MB')
+        elapsed, rss = _run_child(cli + options + ['--input', positions_file], stdout=subprocess.DEVNULL)
+        results.add(name, engine, 'cli_bulk_seconds', elapsed, 's')
+        results.add(name, engine, 'cli_bulk_peak_rss', rss, 'MB')
+
+
+def compare(results: ty.List[dict], baseline: ty.List[dict], tolerance: float) -> ty.List[str]:
+    """Describe every measurement that is worse than the baseline by more than `tolerance` (a fraction)"""
+    old = {(r['dataset'], r['engine'], r['metric']): r['value'] for r in baseline}
+    regressions = []
+    for record in results:
+        before = old.get((record['dataset'], record['engine'], record['metric']))
+        if before is None:
+            continue
+        after = record['value']
+        if record['metric'] == 'differential_mismatches':
+            worse = after > before
+        elif record['higher_is_better']:
+            worse = after < before * (1 - tolerance)
+        else:
+            worse = after > before * (1 + tolerance)
+        if worse:
+            regressions.append('{dataset} {engine} {metric}: {0:.3f} -> {1:.3f} {unit}'.format(before, after, **record))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', help="Write results to this JSON file")
+    parser.add_argument('--compare', metavar='BASELINE', help="Report regressions against an earlier results file")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed slowdown before reporting a regression")
+    parser.add_argument('--quick', action='store_true', help="Fewer repetitions and queries")
+    parser.add_argument('--dataset', action='append', help="Only run datasets whose filename contains this")
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(os.path.join(REPO_ROOT, 'genelocator', 'data', 'genes-*.pickle.gz')))
+    if args.dataset:
+        paths = [p for p in paths if any(d in os.path.basename(p) for d in args.dataset)]
+    results = Results()
+    with tempfile.TemporaryDirectory(prefix='genelocator-bench-') as user_cache_dir, \
+            tempfile.NamedTemporaryFile('w', suffix='.tsv') as positions_file:
+        # Inherited by the command line runs
+        os.environ.pop(assets.CACHE_DIR_ENV, None)
+        os.environ['XDG_CACHE_HOME'] = user_cache_dir
+        rng = random.Random(3)
+        for _ in range(20000 if args.quick else 200000):
+            positions_file.write('chr{}\t{}\n'.format(rng.randint(1, 22), rng.randint(1, 10 ** 8)))
+        positions_file.flush()
+        for path in paths:
+            bench_dataset(results, path, quick=args.quick, positions_file=positions_file.name)
+
+    report = {
+        'meta': {'genelocator_version': version, 'python': platform.python_version(), 'platform': platform.platform(),
+                 'cpus': os.cpu_count(), 'quick': args.quick, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')},
+        'results': results.records,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+    failed = any(r['metric'] == 'differential_mismatches' and r['value'] for r in results.records)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results.records, json.load(f)['results'], args.tolerance)
+        for regression in regressions:
+            print('REGRESSION: ' + regression)
+        failed = failed or bool(regressions)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
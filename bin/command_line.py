@@ -4,15 +4,25 @@ A command-line script that identifies nearest gene based on genomic coordinates
 Sample usages:
     gene-locator GRCh37 chr19 234523 --common-genetypes --version gencode32
     gene-locator hg38 18 234523 --version gencode31
+    gene-locator hg38 --input variants.vcf.gz --input-format vcf > annotated.tsv
+    gene-locator hg38 --input huge.vcf.gz --input-format vcf --processes 0 > annotated.tsv
+    zcat sumstats.tsv.gz | gene-locator hg38 --input - --header --chrom-col 2 --pos-col 3 --output-format json
+    gene-locator hg38 chr19 234523 --profile-startup
 """
 
-import argparse
-import logging
-import sys
+import time
 
-from genelocator import get_genelocator
-from genelocator.const import BUILD_LOOKUP
-from genelocator import exception as gene_exc
+_STARTED = time.perf_counter()  # for --profile-startup
+
+import argparse  # noqa: E402
+import io  # noqa: E402
+import logging  # noqa: E402
+import sys  # noqa: E402
+
+from genelocator import get_genelocator  # noqa: E402
+from genelocator import annotate  # noqa: E402
+from genelocator.const import BUILD_LOOKUP, KNOWN_ENGINES  # noqa: E402
+from genelocator import exception as gene_exc  # noqa: E402
 
 
 logger = logging.getLogger(__name__)
@@ -36,8 +46,8 @@ def parse_args():
     parser.add_argument("build",
                         choices=BUILD_LOOKUP.keys(),
                         help="The genome build (must be specified)")
-    parser.add_argument("chromosome")
-    parser.add_argument("position", type=int,
+    parser.add_argument("chromosome", nargs='?')
+    parser.add_argument("position", type=int, nargs='?',
                         help="The variant position (coordinates should refer to the selected genome build")
     parser.add_argument("--version", default=32, type=_validate_gencode,
                         help="The GENCODE database version to use")
@@ -45,25 +55,126 @@ def parse_args():
                         help='If specified, restrict search to "common" genetypes (which means protein_coding + IG_*_gene + TR_*_gene)')
     parser.add_argument('--auto-fetch', dest='auto_fetch', action='store_true',
                         help="If specified, will automatically try to download the required data")
-    return parser.parse_args()
+    parser.add_argument('--engine', choices=sorted(KNOWN_ENGINES), default='tree',
+                        help="Which lookup engine to use (all give the same answers)")
+    parser.add_argument('--profile-startup', action='store_true',
+                        help="Print how long each step took (import, loading the dataset, and the lookup) to stderr")
+
+    bulk = parser.add_argument_group('bulk annotation', 'Annotate every position in a file, instead of one position')
+    bulk.add_argument('--input', metavar='PATH',
+                      help="A (possibly gzipped) file of positions to annotate, or - for stdin")
+    bulk.add_argument('--input-format', choices=sorted(annotate.INPUT_FORMATS), default='tsv',
+                      help="Sets the default chromosome and position columns. bed positions are converted to 1-based")
+    bulk.add_argument('--chrom-col', type=int, metavar='N', help="1-based column number of the chromosome")
+    bulk.add_argument('--pos-col', type=int, metavar='N', help="1-based column number of the position")
+    bulk.add_argument('--delimiter', default='\t', help="Column delimiter of the input (default: tab)")
+    bulk.add_argument('--header', action='store_true', help="The first non-comment line of the input is a header")
+    bulk.add_argument('--output-format', choices=sorted(annotate.OUTPUT_FORMATS), default='tsv',
+                      help="tsv: input rows plus gene columns; genes: one row per gene; json: one object per input row")
+    bulk.add_argument('--chunk-size', type=int, default=10000, help="Number of rows to look up at a time")
+    bulk.add_argument('--processes', type=int, default=1,
+                      help="Annotate chunks in this many worker processes, which share one memory-mapped index (0: one per CPU)")
+
+    args = parser.parse_args()
+    if args.input is None and (args.chromosome is None or args.position is None):
+        parser.error('Specify either a chromosome and position, or --input')
+    if args.input is not None and args.chromosome is not None:
+        parser.error('A chromosome and position cannot be combined with --input')
+    for name in ('chrom_col', 'pos_col'):
+        if getattr(args, name) is not None and getattr(args, name) < 1:
+            parser.error('Column numbers start at 1')
+    return args
+
+
+def annotate_file(genelocator, args):
+    """Stream every position in the input through the locator, writing results to stdout"""
+    out = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', write_through=False, line_buffering=False)
+    options = dict(input_format=args.input_format,
+                   chrom_col=None if args.chrom_col is None else args.chrom_col - 1,
+                   pos_col=None if args.pos_col is None else args.pos_col - 1,
+                   delimiter=args.delimiter, header=args.header,
+                   output_format=args.output_format, chunk_size=args.chunk_size)
+    with annotate.open_input(args.input) as lines:
+        if args.processes == 1:
+            annotate.annotate_stream(genelocator, lines, out, **options)
+        else:
+            annotate.annotate_parallel(genelocator, lines, out, processes=args.processes or None, **options)
+    out.flush()
+
+
+class StartupProfile:
+    """Time each step of a run, for `--profile-startup`"""
+    def __init__(self):
+        self.seconds = [('import', time.perf_counter() - _STARTED)]  # (step, seconds) pairs
+        self._last = time.perf_counter()
+
+    def step(self, name: str) -> None:
+        now = time.perf_counter()
+        self.seconds.append((name, now - self._last))
+        self._last = now
+
+    def report(self) -> str:
+        lines = ['{:<8} {:8.4f}s'.format(name, seconds) for name, seconds in self.seconds]
+        lines.append('{:<8} {:8.4f}s (not counting interpreter startup)'.format('total', sum(s for _, s in self.seconds)))
+        return '\n'.join(lines)
+
+
+def _load_for_lookup(args):
+    """
+    Load a dataset for a single lookup, as quickly as possible: a binary copy is memory-mapped, and only the queried
+        chromosome is decoded. The first time a dataset is only available as a pickle, the copy is made from it and
+        saved to the user's cache folder (see `assets.get_copy_dir`), so only that run pays for loading the pickle.
+    """
+    return get_genelocator(args.build, gencode_version=args.version, common_genetypes_only=args.common_genetypes_only,
+                           auto_fetch=args.auto_fetch, engine=args.engine, lazy=True, cache=False)
 
 
 def main():
-    # TODO (future) Creating the tree is the slow step. A potential performance enhancement would be to allow searching
-    #   for multiple positions from a single run of the command line (so we get many searches but pay startup penalty once)
+    # Creating the tree is the slow step, so to look up many positions, use `--input` to pay that cost only once
+    profile = StartupProfile()
     args = parse_args()
     gencode_version = args.version
     try:
-        genelocator = get_genelocator(args.build,
-                                      gencode_version=gencode_version,
-                                      common_genetypes_only=args.common_genetypes_only,
-                                      auto_fetch=args.auto_fetch)
+        if args.input is None:
+            genelocator = _load_for_lookup(args)
+        elif args.processes != 1:
+            # Workers memory-map a binary copy of the dataset, which this only opens (and records the dataset's build,
+            #   so that the workers accept the same chromosome names as a serial run)
+            genelocator = get_genelocator(args.build,
+                                          gencode_version=gencode_version,
+                                          common_genetypes_only=args.common_genetypes_only,
+                                          auto_fetch=args.auto_fetch,
+                                          engine='compact', lazy=True, cache=False)
+        else:
+            genelocator = get_genelocator(args.build,
+                                          gencode_version=gencode_version,
+                                          common_genetypes_only=args.common_genetypes_only,
+                                          auto_fetch=args.auto_fetch,
+                                          engine=args.engine)
     except gene_exc.UnsupportedDatasetException:
         logger.error('No source found for the requested dataset; exiting')
         sys.exit(1)
 
-    for gene in genelocator.at(args.chromosome, args.position):
-        print('{chrom}\t{start}\t{end}\t{ensg}\t{symbol}'.format(**gene))
+    profile.step('load')
+
+    if args.input is not None:
+        try:
+            annotate_file(genelocator, args)
+        except gene_exc.BadCoordinateException as e:
+            logger.error(str(e))
+            sys.exit(1)
+        profile.step('annotate')
+    else:
+        try:
+            genes = genelocator.at(args.chromosome, args.position)
+        except gene_exc.BadCoordinateException as e:
+            logger.error(str(e))
+            sys.exit(1)
+        for gene in genes:
+            print('{chrom}\t{start}\t{end}\t{ensg}\t{symbol}'.format(**gene))
+        profile.step('query')
+    if args.profile_startup:
+        print(profile.report(), file=sys.stderr)
 
 
 if __name__ == '__main__':
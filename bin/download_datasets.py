@@ -0,0 +1,52 @@
+"""
+A command-line script that downloads GENCODE data and builds the dataset files used by gene-locator
+
+Sample usages:
+    gene-downloader GRCh37 GRCh38 --version gencode32
+    gene-downloader hg38 --geneset all --source gencode.v32.basic.annotation.gtf.gz --out-dir /tmp/datasets
+"""
+
+import argparse
+import logging
+
+from genelocator import build
+from genelocator.const import BUILD_LOOKUP, FILE_EXTENSIONS, KNOWN_GENESETS
+
+from bin.command_line import _validate_gencode
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Build gene locator datasets. Each GTF file is parsed once for all genesets, and each build runs in parallel.")
+    parser.add_argument("builds", nargs='+', choices=BUILD_LOOKUP.keys(), help="The genome builds to create")
+    parser.add_argument("--version", dest="versions", action='append', type=_validate_gencode,
+                        help="A GENCODE database version to use (can be given more than once; default: 32)")
+    parser.add_argument("--geneset", dest="genesets", action='append', choices=sorted(KNOWN_GENESETS),
+                        help="A geneset to build (can be given more than once; default: all of them)")
+    parser.add_argument("--format", dest="file_formats", action='append', choices=sorted(FILE_EXTENSIONS),
+                        help="A file format to write (can be given more than once; default: binary and pickle)")
+    parser.add_argument("--source", metavar='URL_OR_PATH',
+                        help="Use this GTF file instead of downloading one (only for a single build and version)")
+    parser.add_argument("--out-dir", help="Write datasets here instead of the cache folder (default: $GENELOCATOR_CACHE_DIR, or the package data folder)")
+    parser.add_argument("--processes", type=int, help="Number of builds to run at once (default: one per CPU)")
+    args = parser.parse_args()
+    args.versions = args.versions or [32]
+    if args.source is not None and len(args.builds) * len(args.versions) > 1:
+        parser.error('--source can only be used to build a single build and GENCODE version')
+    return args
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args()
+    sources = {(args.builds[0], args.versions[0]): args.source} if args.source else None
+    written = build.build_datasets(args.builds, args.versions, args.genesets or sorted(KNOWN_GENESETS),
+                                   file_formats=args.file_formats or ('binary', 'pickle'),
+                                   out_dir=args.out_dir, sources=sources, processes=args.processes)
+    for paths in written.values():
+        for path in paths:
+            print(path)
+
+
+if __name__ == '__main__':
+    main()
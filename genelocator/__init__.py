@@ -1,28 +1,170 @@
-import gzip
-import pickle
+import os
+import time
+import typing as ty
 
-from genelocator.download import get_genes_iterator  # noqa: F401
 from .locate import GeneLocator  # noqa: F401
+from .compact import CompactGeneLocator  # noqa: F401
+from .tiling import TiledGeneLocator  # noqa: F401
 
 from . import assets
-from .const import BUILD_LOOKUP
+from . import cache as gene_cache
+from . import fileformat
+from . import metrics
+from .const import BUILD_LOOKUP, KNOWN_ENGINES
 from . import exception as gene_exc  # noqa: F401
 
 
-def get_genelocator(build_or_path: str, *, gencode_version: int = 32, common_genetypes_only=True, coding_only=None, auto_fetch=False) -> GeneLocator:
+def get_genes_iterator(grch_build: str, **kwargs) -> ty.Iterator[dict]:
+    """See `download.get_genes_iterator`"""
+    # Build-time machinery (and the network libraries it needs) is only imported when it is used
+    from .download import get_genes_iterator as download_genes
+    return download_genes(grch_build, **kwargs)
+
+
+def get_genelocator(build_or_path: str, *, gencode_version: int = 32, common_genetypes_only=True, coding_only=None, auto_fetch=False,
+                    engine: str = 'tree', cache: bool = True, lazy: bool = False,
+                    cache_dir: str = None) -> ty.Union[GeneLocator, CompactGeneLocator]:
+    """
+    Load a gene locator. Both engines give the same answers:
+        - `tree` (default): a `GeneLocator` backed by interval trees
+        - `compact`: a `CompactGeneLocator` backed by flat arrays, which uses a fraction of the memory
+        - `tiled`: a `TiledGeneLocator`, which adds a precompiled tiling of every chromosome so that `at` is one bisect
+
+    With `lazy=True`, a binary dataset file is opened without decoding anything, and each chromosome is only built the
+        first time it is queried (see `lazy.LazyGeneLocator`). Pickled datasets (like the bundled ones) can't be read in
+        parts, so the first lazy load saves a binary copy, which later loads open instead (see `assets.get_copy_dir`).
+        If the copy can't be saved, the pickle is loaded in full. (The compact engine always reads binary files lazily.)
+
+    Loaded locators are kept in a process-wide cache (`genelocator.cache.locator_cache`), so asking for the same
+        dataset again returns the same object without reading the file. Use `cache=False` to always load a fresh copy.
+
+    Datasets made by `auto_fetch` are saved in `cache_dir` (by default `$GENELOCATOR_CACHE_DIR`, or the package data
+        folder). If several processes ask for the same missing dataset at once, one builds it while the others wait.
+    """
+    if engine not in KNOWN_ENGINES:
+        raise ValueError('Unknown engine {!r}; choose one of {}'.format(engine, sorted(KNOWN_ENGINES)))
 
     # for backward-compatibility with old argument name
     if coding_only is not None:
         common_genetypes_only = coding_only
 
+    # Each engine prefers the file format that it can load without conversion, but will fall back to the other one
+    file_formats = ('binary', 'pickle') if engine != 'tree' or lazy else ('pickle', 'binary')
+    source_path = _resolve_path(build_or_path, gencode_version, common_genetypes_only, auto_fetch, file_formats, cache_dir)
+
+    # A known dataset's build is known, so its chromosomes can also be named by that build's RefSeq accessions
+    metadata = _metadata(build_or_path, gencode_version, common_genetypes_only)
+    if cache:
+        variant = engine + ('+lazy' if lazy else '') + ('+{}'.format(BUILD_LOOKUP[build_or_path]) if metadata else '')
+        return gene_cache.locator_cache.get(gene_cache.dataset_key(source_path, variant),
+                                            lambda: _load(source_path, engine, lazy, metadata, cache_dir))
+    return _load(source_path, engine, lazy, metadata, cache_dir)
+
+
+def get_dataset_info(build_or_path: str, *, gencode_version: int = 32, common_genetypes_only=True,
+                     cache_dir: str = None) -> dict:
+    """
+    Describe a dataset (its metadata, and gene counts in total and per chromosome) without loading it. See
+        `fileformat.read_info`. A pickled dataset is described by its binary copy, which is made if there is none yet
+        (as for `get_genelocator(lazy=True)`).
+    """
+    source_path = _resolve_path(build_or_path, gencode_version, common_genetypes_only, False, ('binary', 'pickle'), cache_dir)
+    if not fileformat.is_locator_file(source_path):
+        metadata = _metadata(build_or_path, gencode_version, common_genetypes_only)
+        source_path = assets.find_binary_copy(source_path, cache_dir) or assets.save_binary_copy(
+            source_path, _read_pickle(source_path, metadata), metadata=metadata, cache_dir=cache_dir)
+        if source_path is None:
+            raise gene_exc.UnsupportedDatasetException(
+                'Pickled datasets can only be described from a binary copy, which could not be saved (see `assets.get_copy_dir`)')
+    return fileformat.read_info(source_path)
+
+
+def _metadata(build_or_path: str, gencode_version: int, common_genetypes_only: bool) -> ty.Optional[dict]:
+    """Describe a known dataset (see `assets.get_metadata`), or None for a path"""
+    if build_or_path not in BUILD_LOOKUP:
+        return None
+    return assets.get_metadata(build_or_path, gencode_version, 'common_genetypes' if common_genetypes_only else 'all')
+
+
+def _resolve_path(build_or_path: str, gencode_version: int, common_genetypes_only: bool, auto_fetch: bool,
+                  file_formats: ty.Sequence[str], cache_dir: str = None) -> str:
     if build_or_path in BUILD_LOOKUP:
         # We are looking up a special, known dataset cached on disk
         geneset = 'common_genetypes' if common_genetypes_only else 'all'  # TODO: Use enum here
         # If auto_fetch is specified, this function will block until the data has been returned
-        source_path = assets.locate_by_metadata(build_or_path, gencode_version, geneset, auto_fetch=auto_fetch)
-    else:
-        # The user has specified a path to a lookup file (premade tree in compressed pickle format). Use it!
-        source_path = build_or_path
+        return assets.locate_by_metadata(build_or_path, gencode_version, geneset, auto_fetch=auto_fetch,
+                                         file_formats=file_formats, cache_dir=cache_dir)
+    # The user has specified a path to a lookup file (binary locator, or premade tree in compressed pickle format). Use it!
+    return build_or_path
 
+
+def preload(build_or_path: str, **kwargs) -> None:
+    """Load a dataset into the cache ahead of time (eg at server startup). Takes the same arguments as `get_genelocator`."""
+    get_genelocator(build_or_path, **kwargs)
+
+
+def load_in_background(build_or_path: str, *, executor: ty.Any = None, **kwargs):
+    """
+    Start loading a dataset (or building it, with `auto_fetch=True`) in the background, and return a
+        `background.LoadHandle` at once. Takes the same arguments as `get_genelocator`, plus an optional
+        `concurrent.futures` executor to run the load in. The handle can be polled (`ready()`), waited for with a timeout
+        (`wait(timeout)`), or awaited from asyncio; errors from the load are raised by both.
+    """
+    from .background import LoadHandle
+    return LoadHandle.start(lambda: get_genelocator(build_or_path, **kwargs), executor=executor,
+                            description=os.path.basename(str(build_or_path)))
+
+
+def _load(source_path: str, engine: str, lazy: bool = False, metadata: dict = None,
+          cache_dir: str = None) -> ty.Union[GeneLocator, CompactGeneLocator]:
+    recorder = metrics.active
+    if recorder is None:
+        return _read_locator(source_path, engine, lazy, metadata, cache_dir)
+    started = time.perf_counter()
+    locator = _read_locator(source_path, engine, lazy, metadata, cache_dir)
+    recorder.record_load(engine, os.path.getsize(source_path), time.perf_counter() - started)
+    return locator
+
+
+def _read_locator(source_path: str, engine: str, lazy: bool = False, metadata: dict = None,
+                  cache_dir: str = None) -> ty.Union[GeneLocator, CompactGeneLocator]:
+    """`metadata` describes a known dataset (see `assets.get_metadata`); binary files also record their own"""
+    if lazy and not fileformat.is_locator_file(source_path):
+        # Pickles can't be read in parts, so a lazy load opens a binary copy, which is made from the pickle the first time
+        copy_path = assets.find_binary_copy(source_path, cache_dir)
+        if copy_path is None:
+            locator = _read_pickle(source_path, metadata)
+            copy_path = assets.save_binary_copy(source_path, locator, metadata=metadata, cache_dir=cache_dir)
+            if copy_path is None:
+                return _from_tree(locator, engine)
+        source_path = copy_path
+
+    if fileformat.is_locator_file(source_path):
+        if engine == 'tiled':
+            return fileformat.load(source_path, tiled=True)
+        compact = fileformat.load(source_path)
+        if engine == 'compact':
+            return compact
+        if lazy:
+            from .lazy import LazyGeneLocator
+            return LazyGeneLocator(compact)
+        return GeneLocator(compact.genes(), build=compact._index.contigs.build or (metadata or {}).get('build'))
+    return _from_tree(_read_pickle(source_path, metadata), engine)
+
+
+def _read_pickle(source_path: str, metadata: dict = None) -> GeneLocator:
+    import gzip
+    import pickle
     with gzip.open(source_path, 'rb') as f:
-        return pickle.load(f)
+        locator = pickle.load(f)
+    if metadata is not None:
+        locator._set_build(metadata['build'])  # older pickles don't record it
+    return locator
+
+
+def _from_tree(locator: GeneLocator, engine: str) -> ty.Union[GeneLocator, CompactGeneLocator]:
+    if engine == 'compact':
+        return CompactGeneLocator.from_locator(locator)
+    elif engine == 'tiled':
+        return TiledGeneLocator.from_locator(locator)
+    return locator
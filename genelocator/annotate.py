@@ -0,0 +1,228 @@
+"""
+Annotate a stream of positions (eg a VCF or a summary statistics file) with their nearest genes
+
+Rows are read and answered in fixed-size chunks via `at_many`, so memory use doesn't depend on the size of the input.
+    `annotate_parallel` answers the chunks in several worker processes, which share one memory-mapped index.
+"""
+
+import collections
+import concurrent.futures
+import contextlib
+import gzip
+import io
+import itertools
+import json
+import os
+import sys
+import tempfile
+import typing as ty
+
+from . import exception as gene_exc
+from . import fileformat
+
+
+# Where to find the chromosome and position in common file types, as (chrom column, pos column, offset to add to pos)
+#   All column numbers are 0-based. BED starts are 0-based, so they are shifted to match the 1-based gene coordinates.
+INPUT_FORMATS = {
+    'tsv': (0, 1, 0),
+    'vcf': (0, 1, 0),
+    'bed': (0, 1, 1),
+}
+OUTPUT_FORMATS = {'tsv', 'genes', 'json'}
+GENE_COLUMNS = ('gene_chrom', 'gene_start', 'gene_end', 'ensg', 'symbol', 'distance')
+
+
+def open_input(path: str) -> ty.TextIO:
+    """Open a (possibly gzipped) text file for reading; `-` means stdin"""
+    raw = sys.stdin.buffer if path == '-' else open(path, 'rb')
+    if not hasattr(raw, 'peek'):
+        raw = io.BufferedReader(raw)
+    if raw.peek(2)[:2] == b'\x1f\x8b':
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding='utf-8', newline='')
+
+
+class _Row:
+    __slots__ = ('line', 'chrom', 'pos')
+
+    def __init__(self, line: str, chrom: ty.Optional[str], pos: int):
+        self.line = line
+        self.chrom = chrom  # None for comment and header lines, which are passed through without a lookup
+        self.pos = pos
+
+
+def _read_rows(lines: ty.Iterable[str], chrom_col: int, pos_col: int, pos_offset: int, delimiter: str,
+               comment: str, header: bool, first_line_num: int = 1) -> ty.Iterator[_Row]:
+    last_col = max(chrom_col, pos_col)
+    for line_num, line in enumerate(lines, start=first_line_num):
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        if comment and line.startswith(comment):
+            yield _Row(line, None, 0)
+            continue
+        if header:
+            yield _Row(delimiter.join((line,) + GENE_COLUMNS), None, 0)
+            header = False
+            continue
+        fields = line.split(delimiter, last_col + 1)
+        try:
+            yield _Row(line, fields[chrom_col], int(fields[pos_col]) + pos_offset)
+        except (IndexError, ValueError):
+            raise gene_exc.BadCoordinateException(
+                'Line {}: could not read a chromosome from column {} and a position from column {} of {!r}'.format(
+                    line_num, chrom_col + 1, pos_col + 1, line))
+
+
+def _format_rows(rows: ty.List[_Row], result, output_format: str, delimiter: str) -> str:
+    """Render one chunk of answers as text. `result` has one query for each row that isn't a comment or header."""
+    out = []
+    # Plain lists are much faster to format than numpy scalars
+    chroms, starts, ends, ensgs, symbols, distances, offsets = (
+        column.tolist() for column in (result.chrom, result.start, result.end, result.ensg, result.symbol,
+                                       result.distances, result.offsets))
+    columns = (chroms, starts, ends, ensgs, symbols, distances)
+    escaped = delimiter.replace('{', '{{').replace('}', '}}')
+    single_gene_template = escaped.join(['{}'] * (1 + len(columns))) + '\n'
+    gene_row_template = escaped.join(['{}'] * (2 + len(columns))) + '\n'
+    i = 0
+    for row in rows:
+        if row.chrom is None:
+            if output_format == 'tsv':
+                out.append(row.line)
+                out.append('\n')
+            continue
+        hits = range(offsets[i], offsets[i + 1])
+        i += 1
+        if output_format == 'genes':
+            for j in hits:
+                out.append(gene_row_template.format(
+                    row.chrom, row.pos, chroms[j], starts[j], ends[j], ensgs[j], symbols[j], distances[j]))
+        elif output_format == 'json':
+            out.append(json.dumps({'chrom': row.chrom, 'pos': row.pos, 'genes': [
+                {'chrom': chroms[j], 'start': starts[j], 'end': ends[j], 'ensg': ensgs[j],
+                 'symbol': symbols[j], 'distance': distances[j]} for j in hits]}))
+            out.append('\n')
+        elif len(hits) == 1:
+            # The usual case: format a single gene directly, which is much faster than joining lists of values
+            j = hits[0]
+            out.append(single_gene_template.format(
+                row.line, chroms[j], starts[j], ends[j], ensgs[j], symbols[j], distances[j]))
+        else:
+            out.append(delimiter.join(itertools.chain(
+                [row.line], (','.join(str(column[j]) for j in hits) for column in columns))))
+            out.append('\n')
+    return ''.join(out)
+
+
+def annotate_stream(locator, lines: ty.Iterable[str], out: ty.TextIO, *,
+                    input_format: str = 'tsv', chrom_col: int = None, pos_col: int = None,
+                    delimiter: str = '\t', comment: str = '#', header: bool = False,
+                    output_format: str = 'tsv', chunk_size: int = 10000) -> int:
+    """
+    Read positions from `lines` and write one annotated record per row (or per gene, for `output_format='genes'`) to
+        `out`. Returns the number of rows annotated.
+
+    Output formats:
+        - `tsv`: the input row, followed by gene columns (comma-separated when several genes overlap the position).
+            Comment lines are copied, and a header line (if `header=True`) gets names for the new columns.
+        - `genes`: one row per gene, like the single-position command line output plus the query and distance
+        - `json`: one JSON object per input row
+
+    Positions on chromosomes without data get empty results rather than raising an error.
+    """
+    chrom_col, pos_col, pos_offset = _resolve_columns(input_format, chrom_col, pos_col, output_format)
+    rows = _read_rows(lines, chrom_col, pos_col, pos_offset, delimiter, comment, header)
+    count = 0
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        text, n_queries = _annotate_rows(locator, chunk, output_format, delimiter)
+        out.write(text)
+        count += n_queries
+
+
+def _resolve_columns(input_format: str, chrom_col: ty.Optional[int], pos_col: ty.Optional[int],
+                     output_format: str) -> ty.Tuple[int, int, int]:
+    """Check the options, and return (chrom column, pos column, offset to add to pos)"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError('Unknown output format {!r}; choose one of {}'.format(output_format, sorted(OUTPUT_FORMATS)))
+    default_chrom_col, default_pos_col, pos_offset = INPUT_FORMATS[input_format]
+    return (default_chrom_col if chrom_col is None else chrom_col,
+            default_pos_col if pos_col is None else pos_col,
+            pos_offset)
+
+
+def _annotate_rows(locator, rows: ty.List[_Row], output_format: str, delimiter: str) -> ty.Tuple[str, int]:
+    """Look up one chunk of rows, and return (output text, number of rows looked up)"""
+    queries = [row for row in rows if row.chrom is not None]
+    result = locator.at_many([row.chrom for row in queries], [row.pos for row in queries], strict=False)
+    return _format_rows(rows, result, output_format, delimiter), len(queries)
+
+
+# The locator used by each worker process of `annotate_parallel`, by path. It is opened by the first chunk that a
+#   worker gets (pool initializers need Python 3.7), and opening a binary file only maps it into memory.
+_worker_locators = {}  # type: ty.Dict[str, ty.Any]
+
+
+def _worker_locator(dataset_path: str):
+    locator = _worker_locators.get(dataset_path)
+    if locator is None:
+        locator = _worker_locators[dataset_path] = fileformat.load(dataset_path)
+    return locator
+
+
+def _annotate_chunk(dataset_path: str, lines: ty.List[str], first_line_num: int, header: bool,
+                    options: tuple) -> ty.Tuple[str, int]:
+    chrom_col, pos_col, pos_offset, delimiter, comment, output_format = options
+    rows = list(_read_rows(lines, chrom_col, pos_col, pos_offset, delimiter, comment, header, first_line_num))
+    return _annotate_rows(_worker_locator(dataset_path), rows, output_format, delimiter)
+
+
+def annotate_parallel(dataset, lines: ty.Iterable[str], out: ty.TextIO, *, processes: int = None,
+                      input_format: str = 'tsv', chrom_col: int = None, pos_col: int = None,
+                      delimiter: str = '\t', comment: str = '#', header: bool = False,
+                      output_format: str = 'tsv', chunk_size: int = 50000) -> int:
+    """
+    Like `annotate_stream`, but annotate chunks of the input in a pool of `processes` worker processes (by default, one
+        per CPU). The output is identical, and in the same order.
+
+    `dataset` is the path of a binary locator file (see `fileformat`), or a locator, which is saved to a temporary
+        binary file first (along with its build, so that workers accept the same chromosome names). Every worker
+        memory-maps the same file, so the operating system shares one copy of the index between them (unlike a
+        tree-based locator, which each forked worker would gradually copy).
+    """
+    chrom_col, pos_col, pos_offset = _resolve_columns(input_format, chrom_col, pos_col, output_format)
+    options = (chrom_col, pos_col, pos_offset, delimiter, comment, output_format)
+    processes = processes or os.cpu_count() or 1
+    with contextlib.ExitStack() as stack:
+        if not isinstance(dataset, str) or not fileformat.is_locator_file(dataset):
+            if isinstance(dataset, str):
+                raise gene_exc.UnsupportedDatasetException('Parallel annotation needs a binary locator file, not {}'.format(dataset))
+            tmp_dir = stack.enter_context(tempfile.TemporaryDirectory(prefix='genelocator-'))
+            path = os.path.join(tmp_dir, 'locator' + fileformat.EXTENSION)
+            fileformat.write(dataset, path, metadata=getattr(dataset, 'metadata', None))
+            dataset = path
+        pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(max_workers=processes))
+
+        count = 0
+        in_flight = collections.deque()  # type: ty.Deque[concurrent.futures.Future]
+        line_num = 1
+        header_pending = header
+        lines = iter(lines)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_size))
+            if chunk:
+                in_flight.append(pool.submit(_annotate_chunk, dataset, chunk, line_num, header_pending, options))
+                line_num += len(chunk)
+                # Only the first row that isn't blank or a comment can be the header
+                header_pending = header_pending and all(
+                    not line.rstrip('\r\n') or (comment and line.startswith(comment)) for line in chunk)
+            # Keep a few chunks per worker queued up, and write results as soon as they are ready (in order)
+            while in_flight and (not chunk or len(in_flight) > 2 * processes or in_flight[0].done()):
+                text, n_queries = in_flight.popleft().result()
+                out.write(text)
+                count += n_queries
+            if not chunk:
+                return count
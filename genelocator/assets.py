@@ -1,53 +1,193 @@
 """
 Contains helpers that can be used to locate (or generate) asset data files
 
-For now, assets will be cached in the `data` folder. Eventually we can extract this to a package.
+Datasets that ship with the package live in its `data` folder. Generated datasets are saved to the cache folder, which
+    is also the `data` folder unless the `GENELOCATOR_CACHE_DIR` environment variable (or a `cache_dir` argument) points
+    somewhere else, eg because the package is installed read-only. Both folders are searched for datasets.
+
+Only binary files can be memory-mapped and read in parts, but the bundled datasets are pickles. The first time that one
+    is opened lazily, a binary copy is saved (see `save_binary_copy`) to `$GENELOCATOR_CACHE_DIR`, or else a per-user cache
+    folder, never to the package. Each copy records the size and mtime of the pickle that it was made from, and is
+    only used while they still match, so a replaced pickle is converted again.
 """
+import contextlib
+import hashlib
 import logging
 import os
+import time
+import typing as ty
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
 
-from .const import BUILD_LOOKUP, KNOWN_GENESETS
-from . import download
+from .const import BUILD_LOOKUP, FILE_EXTENSIONS, KNOWN_GENESETS
 from . import exception as gene_exc
 
 logger = logging.getLogger(__name__)
 
+CACHE_DIR_ENV = 'GENELOCATOR_CACHE_DIR'
+PACKAGE_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+
+
+def get_cache_dir(cache_dir: str = None) -> str:
+    """Where generated datasets are saved: `cache_dir` if given, else `$GENELOCATOR_CACHE_DIR`, else the package data folder"""
+    return cache_dir or os.environ.get(CACHE_DIR_ENV) or PACKAGE_DATA_DIR
+
+
+def get_copy_dir(cache_dir: str = None) -> str:
+    """
+    Where binary copies of pickled datasets are saved: `cache_dir` if given, else `$GENELOCATOR_CACHE_DIR`, else
+        `genelocator` in the user's cache folder (`$XDG_CACHE_HOME`, or `~/.cache`)
+    """
+    user_cache = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return cache_dir or os.environ.get(CACHE_DIR_ENV) or os.path.join(user_cache, 'genelocator')
 
-def _get_cache_filepath(build: str, version: int, geneset: str) -> str:
+
+def get_metadata(grch_build: str, gencode_version: int, geneset: str) -> dict:
+    """Describe a dataset, for storage in the header of a binary locator file"""
+    return {'build': grch_build, 'grch_build_number': BUILD_LOOKUP[grch_build],
+            'gencode_version': gencode_version, 'geneset': geneset}
+
+
+def _get_cache_filepath(build: str, version: int, geneset: str, file_format: str = 'pickle', cache_dir: str = None) -> str:
     """Get the path to a cached, pre-built copy of the asset"""
     build_numeric = BUILD_LOOKUP[build]
-    filename = 'genes-grch{}-gencode{}-{}.pickle.gz'.format(build_numeric, version, geneset)
-    return os.path.join(os.path.dirname(__file__), 'data', filename)
+    filename = 'genes-grch{}-gencode{}-{}{}'.format(build_numeric, version, geneset, FILE_EXTENSIONS[file_format])
+    return os.path.join(get_cache_dir(cache_dir), filename)
+
+
+def _find_cached(build: str, version: int, geneset: str, file_formats: ty.Sequence[str], cache_dir: str = None) -> ty.List[str]:
+    """Every path where the dataset could be, in order of preference (by format, then the cache folder before the package)"""
+    paths = []
+    for file_format in file_formats:
+        path = _get_cache_filepath(build, version, geneset, file_format, cache_dir)
+        bundled_path = os.path.join(PACKAGE_DATA_DIR, os.path.basename(path))
+        paths.extend([path] if path == bundled_path else [path, bundled_path])
+    return paths
+
+
+@contextlib.contextmanager
+def _file_lock(path: str) -> ty.Iterator[None]:
+    """
+    Hold an exclusive lock on the file at `path` (creating it if needed), waiting for as long as any other process (or
+        thread) holds it. The lock is released if the holder dies, so a crashed build never blocks the others.
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                logger.info('Waiting for another process to finish with %s', path)
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        else:
+            import msvcrt
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                    break
+                except OSError:
+                    time.sleep(1)
+            try:
+                yield
+            finally:
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 
-def _get_generated_filepath(build: str, version: int, geneset: str) -> str:
+def _get_generated_filepath(build: str, version: int, geneset: str, file_formats: ty.Sequence[str],
+                            cache_dir: str = None) -> str:
     """
     Trigger generating/fetching the required dataset (if possible). This will block until completed, so it may be slow.
 
-    Generate a dataset (if possible). Returns the filename of the generated asset, or raises an AssetFetchError
+    Generate a dataset (if possible), in every requested format, in the cache folder. Returns the filename of the
+        generated asset in the first format, or raises an AssetFetchError
+
+    Only one process builds from each GENCODE file at a time: the others wait for it, then use what it wrote, rather than
+        all downloading the same file. (Files are written under a temporary name and renamed, so nothing ever sees half
+        of one.)
     """
-    out_path = _get_cache_filepath(build, version, geneset)
-    common_genetypes_only = (geneset == 'common_genesets')
-    download.make_gene_locator(build, out_path,
-                               gencode_version=version, common_genetypes_only=common_genetypes_only)
-    return out_path
+    from . import build as dataset_build  # build imports this module
+    out_dir = get_cache_dir(cache_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    lock_path = os.path.join(out_dir, '.genes-grch{}-gencode{}.lock'.format(BUILD_LOOKUP[build], version))
+    with _file_lock(lock_path):
+        # Someone else may have built it while we waited
+        for path in _find_cached(build, version, geneset, file_formats, cache_dir):
+            if os.path.isfile(path):
+                return path
+        written = dataset_build.build_datasets([build], [version], [geneset], file_formats=file_formats, out_dir=out_dir)
+    return written[(build, version, geneset)][0]
+
+
+def _copy_path(source_path: str, cache_dir: str = None) -> str:
+    """Where the binary copy of a pickled dataset is saved (named after the pickle, and the folder that it is in)"""
+    real_path = os.path.realpath(source_path)
+    name = os.path.basename(real_path)
+    if name.endswith(FILE_EXTENSIONS['pickle']):
+        name = name[:-len(FILE_EXTENSIONS['pickle'])]
+    digest = hashlib.sha1(real_path.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(get_copy_dir(cache_dir), '{}-{}{}'.format(name, digest, FILE_EXTENSIONS['binary']))
+
+
+def _source_stamp(source_path: str) -> dict:
+    """Identify the pickle that a copy was made from, so that a copy of an older version is never used"""
+    stat = os.stat(source_path)
+    return {'path': os.path.realpath(source_path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
 
+def find_binary_copy(source_path: str, cache_dir: str = None) -> ty.Optional[str]:
+    """The path of an up-to-date binary copy of the pickled dataset at `source_path`, if one has been saved"""
+    from . import fileformat
+    target_filename = _copy_path(source_path, cache_dir)
+    try:
+        converted_from = fileformat.read_info(target_filename)['metadata'].get('converted_from')
+    except (OSError, ValueError, KeyError, gene_exc.UnsupportedDatasetException):
+        return None  # no copy yet (or an unreadable one, which will be replaced)
+    return target_filename if converted_from == _source_stamp(source_path) else None
 
-def locate_by_metadata(build: str, version: int, geneset: str, *, auto_fetch=False) -> str:
-    """Locate an asset file that satisfies all specified parameters"""
+
+def save_binary_copy(source_path: str, locator, *, metadata: dict = None, cache_dir: str = None) -> ty.Optional[str]:
+    """
+    Save `locator`, loaded from the pickle at `source_path`, as its binary copy (in `get_copy_dir`), so that later loads
+        can memory-map it. This is only an optimization, so a failure (eg a read-only folder) is logged, and None is
+        returned. Returns the new path.
+    """
+    from . import fileformat
+    target_filename = _copy_path(source_path, cache_dir)
+    try:
+        os.makedirs(os.path.dirname(target_filename), exist_ok=True)
+        fileformat.write(locator, target_filename, metadata=dict(metadata or {}, converted_from=_source_stamp(source_path)))
+    except OSError as e:
+        logger.warning('Could not save a binary copy of the dataset to {}: {}'.format(target_filename, e))
+        return None
+    return target_filename
+
+
+def locate_by_metadata(build: str, version: int, geneset: str, *, auto_fetch=False,
+                       file_formats: ty.Sequence[str] = ('binary', 'pickle'), cache_dir: str = None) -> str:
+    """
+    Locate an asset file that satisfies all specified parameters. If copies exist in several formats, the earliest
+        entry in `file_formats` wins. `cache_dir` overrides the cache folder (see `get_cache_dir`).
+    """
     if geneset not in KNOWN_GENESETS:
         # Builds or gencode versions might be a new file (in which case, checking from a server is ok)
         # But how genes are selected is a set of rules defined in code, so these labels are rigidly defined
         raise gene_exc.UnsupportedDatasetException
 
     # Best option: find a cached copy of the asset on disk
-    target_filename = _get_cache_filepath(build, version, geneset)
-    if os.path.isfile(target_filename):
-        return target_filename
-    elif not auto_fetch:
-        raise gene_exc.NoCachedDataException('Failed to locate requested dataset: {}'.format(target_filename))
+    target_filenames = _find_cached(build, version, geneset, file_formats, cache_dir)
+    for target_filename in target_filenames:
+        if os.path.isfile(target_filename):
+            return target_filename
+    if not auto_fetch:
+        raise gene_exc.NoCachedDataException('Failed to locate requested dataset: {}'.format(' or '.join(target_filenames)))
 
     # There is no cached copy of the dataset, and the user has chosen to auto-fetch a copy
     # This function will download (or generate) the asset, and return a path when the process has completed
     logger.info("No cached asset found; attempting to download")
-    return _get_generated_filepath(build, version, geneset)
+    return _get_generated_filepath(build, version, geneset, file_formats, cache_dir)
@@ -0,0 +1,76 @@
+"""
+Load datasets in the background, so that a service can start (or warm several datasets at once) without blocking
+
+    handle = load_in_background('GRCh38', auto_fetch=True)
+    ...  # serve other traffic
+    if handle.ready():
+        gl = handle.result()
+    gl = handle.wait(timeout=60)  # or block until it is loaded (raising any error from the load)
+    gl = await handle  # or wait from asyncio, without blocking the event loop
+"""
+
+import concurrent.futures
+import threading
+import typing as ty
+
+
+class LoadHandle:
+    """A dataset that is being loaded in another thread"""
+    def __init__(self, future: concurrent.futures.Future, description: str = 'dataset'):
+        self._future = future
+        self.description = description
+
+    @classmethod
+    def start(cls, load: ty.Callable[[], ty.Any], *, executor: concurrent.futures.Executor = None,
+              description: str = 'dataset') -> 'LoadHandle':
+        """
+        Call `load()` in `executor`, or else in a new daemon thread (so that an unfinished load never keeps the process
+            from exiting)
+        """
+        if executor is not None:
+            return cls(executor.submit(load), description)
+        future = concurrent.futures.Future()  # type: concurrent.futures.Future
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(load())
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, name='genelocator-load {}'.format(description), daemon=True).start()
+        return cls(future, description)
+
+    def ready(self) -> bool:
+        """Whether the dataset has loaded successfully (so that `result()` returns at once)"""
+        return self._future.done() and not self._future.cancelled() and self._future.exception() is None
+
+    def done(self) -> bool:
+        """Whether the load has finished, successfully or not"""
+        return self._future.done()
+
+    def wait(self, timeout: float = None):
+        """
+        Wait up to `timeout` seconds (or forever) for the locator, and return it. If the load failed, its error is raised
+            here; if it takes too long, `concurrent.futures.TimeoutError` is raised (and the load carries on).
+        """
+        return self._future.result(timeout)
+
+    result = wait
+
+    def exception(self, timeout: float = None) -> ty.Optional[BaseException]:
+        """Wait like `wait`, but return the error that the load raised (or None), rather than raising it"""
+        return self._future.exception(timeout)
+
+    def add_done_callback(self, callback: ty.Callable[['LoadHandle'], ty.Any]) -> None:
+        """Call `callback(handle)` when the load finishes (at once, if it already has)"""
+        self._future.add_done_callback(lambda _: callback(self))
+
+    def __await__(self):
+        import asyncio
+        return asyncio.wrap_future(self._future).__await__()
+
+    def __repr__(self):
+        state = 'ready' if self.ready() else 'failed' if self.done() else 'loading'
+        return '<LoadHandle {} ({})>'.format(self.description, state)
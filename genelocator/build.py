@@ -0,0 +1,91 @@
+"""
+Build many dataset files at once (eg to refresh the bundled data)
+
+The `common_genetypes` and `all` datasets of a build differ only in which genes they keep, so each GENCODE GTF file is
+    downloaded and parsed once (or not at all, if its gene list is cached; see `genelist`), and every requested geneset
+    is built from that single pass. Each (build, gencode version) is independent, so several are built at the same time
+    in a pool of processes.
+"""
+
+import concurrent.futures
+import logging
+import os
+import typing as ty
+
+from . import assets
+from . import download
+from .const import BUILD_LOOKUP, KNOWN_GENESETS
+from .locate import GeneLocator
+
+
+logger = logging.getLogger(__name__)
+
+
+def _output_path(build: str, version: int, geneset: str, file_format: str, out_dir: ty.Optional[str]) -> str:
+    path = assets._get_cache_filepath(build, version, geneset, file_format)
+    return path if out_dir is None else os.path.join(out_dir, os.path.basename(path))
+
+
+def _build_source(build: str, version: int, genesets: ty.Sequence[str], file_formats: ty.Sequence[str],
+                  out_dir: ty.Optional[str], source: ty.Optional[str]) -> ty.Dict[ty.Tuple[str, int, str], ty.List[str]]:
+    """
+    Parse one GTF file (or read its cached gene list), and write every geneset in every format. Returns the paths written
+        for each dataset.
+    """
+    timings = download.BuildTimings()
+    gene_list = download.get_genelist(BUILD_LOOKUP[build], gencode_version=version, source=source, timings=timings,
+                                      cache_dir=out_dir)
+    written = {}
+    for geneset in genesets:
+        with timings.stage('filter'):
+            genes = list(gene_list.genes(download.geneset_genetypes(geneset)))
+        with timings.stage('index'):
+            locator = GeneLocator(genes, build=build)
+        paths = [_output_path(build, version, geneset, file_format, out_dir) for file_format in file_formats]
+        with timings.stage('serialize'):
+            for path in paths:
+                download.save_locator(locator, path, metadata=download.get_metadata(build, version, geneset))
+        written[(build, version, geneset)] = paths
+    logger.info('Built %s from GENCODE %s: %r', build, version, timings)
+    return written
+
+
+def build_datasets(builds: ty.Iterable[str], gencode_versions: ty.Iterable[int] = (32,),
+                   genesets: ty.Iterable[str] = tuple(sorted(KNOWN_GENESETS)), *,
+                   file_formats: ty.Sequence[str] = ('binary', 'pickle'), out_dir: str = None,
+                   sources: ty.Mapping[ty.Tuple[str, int], str] = None,
+                   processes: int = None) -> ty.Dict[ty.Tuple[str, int, str], ty.List[str]]:
+    """
+    Build every combination of build, gencode version and geneset, and save each one in every format in `file_formats`.
+        Files are written atomically to the cache folder, where `get_genelocator` looks for them (or into `out_dir`, if
+        given; see `assets.get_cache_dir`), along with the gene list cache of each GTF file. Returns the paths written,
+        keyed by (build, gencode version, geneset).
+
+    `sources` optionally maps (build, gencode version) to the URL or path of a GTF file to use instead of downloading
+        one (eg `('GRCh37', 32)` also applies to hg19). Builds are spread over `processes` worker processes (by
+        default, one per CPU).
+    """
+    genesets = list(genesets)
+    unknown = [geneset for geneset in genesets if geneset not in KNOWN_GENESETS]
+    if unknown:
+        raise ValueError('Unknown genesets {}; choose from {}'.format(unknown, sorted(KNOWN_GENESETS)))
+    sources_by_number = {(BUILD_LOOKUP[build], version): source for (build, version), source in (sources or {}).items()}
+    jobs = []  # type: ty.List[tuple]
+    seen = set()  # type: ty.Set[ty.Tuple[int, int]]
+    for build in builds:
+        for version in gencode_versions:
+            # hg19 and GRCh37 (etc) are the same data, so only build each one once
+            key = (BUILD_LOOKUP[build], version)
+            if key not in seen:
+                seen.add(key)
+                jobs.append((build, version, genesets, tuple(file_formats), out_dir, sources_by_number.get(key)))
+
+    written = {}
+    if len(jobs) <= 1 or processes == 1:
+        for job in jobs:
+            written.update(_build_source(*job))
+        return written
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as pool:
+        for result in pool.map(_build_source, *zip(*jobs)):
+            written.update(result)
+    return written
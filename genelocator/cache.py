@@ -0,0 +1,142 @@
+"""
+A process-wide cache of loaded gene locators, so that repeated `get_genelocator` calls don't reload the same dataset
+
+Entries are keyed by the resolved dataset path plus the file's mtime and size (so a rebuilt file is loaded afresh),
+    and by engine. Least recently used entries are evicted when there are too many, or when they use too much memory.
+    If several threads ask for the same dataset at once, it is only loaded once and they all get the same object.
+"""
+
+import collections
+import os
+import threading
+import typing as ty
+
+
+# Approximate heap use per gene of a tree-based `GeneLocator` (measured with tracemalloc on the bundled datasets)
+TREE_BYTES_PER_GENE = 950
+# The part of that which is the gene's ENSG id and symbol strings (measured the same way, which matches their
+#   `sys.getsizeof`). A `registry.StringPool` shares these between datasets.
+TREE_STRING_BYTES_PER_GENE = 120
+
+
+def estimate_memory(locator) -> int:
+    """
+    Approximate number of bytes used by a loaded locator. Arrays count in full, even if they are memory-mapped from a
+        file. A lazy locator counts its mapped file, plus the trees of the chromosomes that it has loaded so far (so its
+        estimate grows as it is used).
+    """
+    if hasattr(locator, '_its'):
+        trees = TREE_BYTES_PER_GENE * len(locator._gene_info)
+        return trees + (_array_bytes(locator._source) if hasattr(locator, '_source') else 0)
+    if not hasattr(locator, '_array_index'):
+        return 0
+    return _array_bytes(locator)
+
+
+def _array_bytes(locator) -> int:
+    index = locator._array_index()
+    table = index.table
+    buffers = [table.chrom_ids, table.start, table.end, table.ensg.offsets, table.ensg.data,
+               table.symbol.offsets, table.symbol.data]
+    for arrays in index.chroms.values():
+        buffers.extend(getattr(arrays, name) for name in arrays.ARRAYS)
+    for tiles in getattr(locator, '_tiling', {}).values():
+        buffers.extend(getattr(tiles, name) for name in tiles.ARRAYS)
+    return sum(memoryview(buffer).nbytes for buffer in buffers)
+
+
+def dataset_key(source_path: str, engine: str) -> ty.Tuple[str, int, int, str]:
+    """Identify a dataset file (and how it will be loaded), so that a changed file gets a new key"""
+    stat = os.stat(source_path)
+    return os.path.realpath(source_path), stat.st_mtime_ns, stat.st_size, engine
+
+
+class _PendingLoad:
+    """A load that is in progress, which other callers can wait for"""
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None  # type: ty.Any
+        self.error = None  # type: ty.Optional[BaseException]
+
+
+class LocatorCache:
+    def __init__(self, max_entries: int = 8, max_bytes: ty.Optional[int] = None):
+        """
+        Keep at most `max_entries` locators, and (if specified) at most `max_bytes` of estimated memory. The most
+            recently loaded locator is always kept, even if it alone is larger than `max_bytes`. Memory is estimated
+            afresh whenever it is checked, since lazy locators grow as they are used.
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()  # type: ty.MutableMapping[ty.Hashable, ty.Any]
+        self._pending = {}  # type: ty.Dict[ty.Hashable, _PendingLoad]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: ty.Hashable, load: ty.Callable[[], ty.Any]) -> ty.Any:
+        """Return the cached value for `key`, or call `load()` to create it. Errors from `load` are not cached."""
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            pending = self._pending.get(key)
+            is_loader = pending is None
+            if is_loader:
+                self.misses += 1
+                pending = self._pending[key] = _PendingLoad()
+            else:
+                # Another thread is already loading this dataset; share its result
+                self.hits += 1
+        if not is_loader:
+            pending.done.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.value
+
+        try:
+            pending.value = load()
+        except BaseException as e:
+            pending.error = e
+            raise
+        else:
+            with self._lock:
+                self._entries[key] = pending.value
+                self._evict()
+            return pending.value
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.done.set()
+
+    def _evict(self) -> None:
+        """Drop the least recently used entries until within limits (must be called with the lock held)"""
+        while len(self._entries) > 1 and (
+                len(self._entries) > self.max_entries or
+                (self.max_bytes is not None and self._estimated_bytes() > self.max_bytes)):
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def _estimated_bytes(self) -> int:
+        return sum(estimate_memory(locator) for locator in self._entries.values())
+
+    def clear(self) -> None:
+        """Forget every cached locator (locators that are still in use elsewhere are unaffected)"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'estimated_bytes': self._estimated_bytes(),
+            }
+
+
+# The cache used by `get_genelocator`
+locator_cache = LocatorCache()
@@ -0,0 +1,165 @@
+"""A gene locator that keeps only flat arrays in memory (no interval trees or per-gene Python objects)"""
+
+import bisect
+import typing as ty
+
+from . import exception as gene_exc
+from . import metrics
+from . import neighbors
+from . import records
+from . import search
+from .index import ArrayIndex
+
+
+class CompactGeneLocator:
+    """
+    Gives the same answers as `GeneLocator`, but stores each chromosome as sorted int64 arrays and refers to genes by
+        integer ids into one shared string table. This uses much less memory, and is much faster to load.
+    """
+    def __init__(self, index: ArrayIndex, *, metadata: dict = None):
+        self._index = index
+        self.metadata = metadata or {}  # eg the build and gencode version, when loaded from a dataset file
+
+    @classmethod
+    def from_genes(cls, genes: ty.Iterable[dict]) -> 'CompactGeneLocator':
+        """genes is like [{chrom: "1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4"},...]"""
+        return cls(ArrayIndex.from_genes(genes))
+
+    @classmethod
+    def from_locator(cls, locator) -> 'CompactGeneLocator':
+        """Convert a (tree-based) `GeneLocator`"""
+        return cls(ArrayIndex.from_locator(locator))
+
+    def genes(self) -> ty.Iterator[dict]:
+        """Iterate over all genes, in their original order (this can be used to build a `GeneLocator`)"""
+        table = self._index.table
+        return (table.serialize(gene_id) for gene_id in range(len(table)))
+
+    def at(self, chrom: str, pos: int, *, strict=True, result: str = 'dict') -> list:
+        """Locate a gene from position coordinates. See `GeneLocator.at` for `result` (here, gene keys are integers)."""
+        recorder = metrics.active
+        if recorder is None:
+            return records.convert(self, self._at_ids(chrom, pos, strict)[0], result)
+        return records.convert(self, recorder.observe_at(self._at_ids, chrom, pos, strict), result)
+
+    def _at_ids(self, chrom: str, pos: int, strict: bool) -> ty.Tuple[ty.List[int], str]:
+        """Find the ids of the genes for a position, and which rule found them (see `metrics.OUTCOMES`)"""
+        chrom = self._index.contigs.resolve(chrom)
+        try:
+            arrays = self._index.chroms[chrom]
+        except KeyError:
+            if strict:
+                raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            return [], 'unknown_chromosome'
+
+        # If any genes overlap this position, return them all (they are already sorted by start)
+        lo = bisect.bisect_right(arrays.max_ends, pos)
+        hi = bisect.bisect_right(arrays.overlap_starts, pos)
+        overlap_ends = arrays.overlap_ends
+        overlapping_genes = [arrays.overlap_ids[i] for i in range(lo, hi) if overlap_ends[i] > pos]
+        if overlapping_genes:
+            return overlapping_genes, 'overlap'
+
+        # Otherwise, return the gene whose end (before) or start (after) is closer. Ties go to the start.
+        prev_idx = bisect.bisect_right(arrays.ends, pos) - 1
+        next_idx = bisect.bisect_left(arrays.starts, pos)
+        has_prev = prev_idx >= 0
+        has_next = next_idx < len(arrays.starts)
+        if has_prev and (not has_next or pos - arrays.ends[prev_idx] < arrays.starts[next_idx] - pos):
+            return [arrays.end_ids[prev_idx]], 'nearest'
+        elif has_next:
+            return [arrays.start_ids[next_idx]], 'nearest'
+        else:
+            raise gene_exc.NoResultsFoundException(
+                'The position chr{!r}:{!r} has no genes before it or after it'.format(chrom, pos))
+
+    def overlapping(self, chrom: str, start: int, end: int, *, strict=True, result: str = 'dict') -> list:
+        """Find all genes that overlap the window `[start, end]` (inclusive), in order of start position"""
+        chrom = self._index.contigs.resolve(chrom)
+        if start > end:
+            raise gene_exc.BadCoordinateException('Window start {!r} is after its end {!r}'.format(start, end))
+        arrays = self._index.chroms.get(chrom)
+        if arrays is None:
+            if strict:
+                raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            return []
+        lo = bisect.bisect_right(arrays.max_ends, start)
+        hi = bisect.bisect_right(arrays.overlap_starts, end)
+        overlap_ends = arrays.overlap_ends
+        return records.convert(self, [arrays.overlap_ids[i] for i in range(lo, hi) if overlap_ends[i] > start], result)
+
+    def nearest(self, chrom: str, pos: int, k: ty.Optional[int] = 1, *, max_distance: int = None, strict=True) -> ty.List[dict]:
+        """Find the `k` genes nearest to a position, closest first (see `GeneLocator.nearest`)"""
+        return neighbors.nearest(self, chrom, pos, k, max_distance=max_distance, strict=strict)
+
+    def overlapping_many(self, chroms: ty.Union[str, ty.Sequence[str]], starts: ty.Sequence[int], ends: ty.Sequence[int], *,
+                         strict=True):
+        """Find genes overlapping many windows at once. Returns a columnar `BatchResult`."""
+        return self._index.overlapping_many(chroms, starts, ends, strict=strict)
+
+    def nearest_many(self, chroms: ty.Union[str, ty.Sequence[str]], positions: ty.Sequence[int], k: ty.Optional[int] = 1, *,
+                     max_distance: int = None, strict=True) -> ty.List[ty.List[dict]]:
+        """Find the nearest genes for many positions (see `GeneLocator.nearest`)"""
+        return neighbors.nearest_many(self, chroms, positions, k, max_distance=max_distance, strict=strict)
+
+    def at_many(self, chroms: ty.Union[str, ty.Sequence[str], None], positions: ty.Sequence[int], *, strict=True,
+                contig_ids: ty.Sequence[int] = None):
+        """
+        Locate genes for many positions at once, following the same rules as `at`. Returns a `BatchResult`.
+            See `GeneLocator.at_many` for `contig_ids`.
+        """
+        return self._index.at_many(chroms, positions, strict=strict, contig_ids=contig_ids)
+
+    def contig_ids(self, chroms: ty.Iterable[str]):
+        """The contig id of each chromosome name (-1 for chromosomes without data), for `at_many`"""
+        return self._index.contigs.ids(chroms)
+
+    def lookup(self, name: str, *, case_sensitive=False, result: str = 'dict') -> list:
+        """Find genes by symbol or ENSG id (see `GeneLocator.lookup`)"""
+        return search.lookup(self, name, case_sensitive=case_sensitive, result=result)
+
+    def lookup_many(self, names: ty.Iterable[str], *, case_sensitive=False, result: str = 'dict') -> ty.List[list]:
+        """Look up a list of gene names (see `GeneLocator.lookup`)"""
+        return search.lookup_many(self, names, case_sensitive=case_sensitive, result=result)
+
+    def autocomplete(self, prefix: str, *, limit: ty.Optional[int] = 10, result: str = 'dict') -> list:
+        """Find genes with a name that starts with `prefix` (see `GeneLocator.autocomplete`)"""
+        return search.autocomplete(self, prefix, limit=limit, result=result)
+
+    def gene(self, gene_id: int) -> records.Gene:
+        """Get the record for a gene id (as returned by `at(..., result='id')`)"""
+        return self._gene_records()[gene_id]
+
+    def _gene_records(self) -> ty.List[records.Gene]:
+        genes = self.__dict__.get('_genes')
+        if genes is None:
+            table = self._index.table
+            chrom_names = table.chrom_names
+            genes = self._genes = [
+                records.Gene(chrom_names[chrom_id], start, end, ensg, symbol)
+                for chrom_id, start, end, ensg, symbol in zip(table.chrom_ids, table.start, table.end, table.ensg, table.symbol)]
+        return genes
+
+    def _name_index(self) -> search.NameIndex:
+        # Built on demand (and not pickled), like `_array_index`
+        names = self.__dict__.get('_search')
+        if names is None:
+            names = self._search = search.NameIndex.from_locator(self)
+        return names
+
+    def _array_index(self) -> ArrayIndex:
+        return self._index
+
+    def _chrom_key(self, chrom: str) -> str:
+        """The name that this dataset uses for a chromosome (see `GeneLocator._chrom_key`)"""
+        return self._index.contigs.resolve(chrom)
+
+    def _sorted_boundaries(self, chrom: str) -> ty.Optional[ty.Tuple[ty.Sequence[int], ty.Sequence[int], ty.Sequence[int], ty.Sequence[int]]]:
+        """For a normalized chromosome name, get (sorted starts, their genes, sorted ends, their genes), or None"""
+        arrays = self._index.chroms.get(chrom)
+        if arrays is None:
+            return None
+        return arrays.starts, arrays.start_ids, arrays.ends, arrays.end_ids
+
+    def _serialize(self, gene_id: int) -> dict:
+        return self._index.table.serialize(gene_id)
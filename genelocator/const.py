@@ -1,2 +1,5 @@
 KNOWN_GENESETS = {'common_genetypes', 'all'}
 BUILD_LOOKUP = {'hg19': 37, 'GRCh37': 37, 'hg38': 38, 'GRCh38': 38}
+KNOWN_ENGINES = {'tree', 'compact', 'tiled'}
+# Dataset files can be saved as a memory-mappable binary (see `fileformat`) or as a gzipped pickle of a `GeneLocator`
+FILE_EXTENSIONS = {'binary': '.gloc', 'pickle': '.pickle.gz'}
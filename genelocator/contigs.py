@@ -0,0 +1,114 @@
+"""
+Chromosome names: every spelling of a dataset's chromosomes, resolved with one dict lookup
+
+Positions come with chromosome names in many styles: Ensembl (`19`, `MT`), UCSC (`chr19`, `chrM`), or RefSeq accessions
+    (`NC_000019.10`). Each locator has a `ContigIndex`, built along with it (and saved with it), that maps every known
+    spelling of each of its chromosomes straight to the name that the dataset uses. Names that aren't in the table fall
+    back to the general rules of `normalize` (so that errors name the chromosome in the usual way).
+
+RefSeq accessions name a chromosome in one build (`NC_000019.10` is chr19 of GRCh38, `NC_000019.9` is chr19 of GRCh37),
+    so a dataset only accepts the accessions of its own build; the other build's are unknown chromosomes. A dataset
+    whose build isn't known accepts no accessions.
+
+For batches, `ContigIndex.ids` turns names into integer contig ids once, and `at_many(None, positions, contig_ids=ids)`
+    skips reading names altogether.
+"""
+
+import typing as ty
+
+from .const import BUILD_LOOKUP
+
+if ty.TYPE_CHECKING:
+    import numpy as np  # noqa: F401
+
+
+HUMAN_CHROMS = tuple([str(i) for i in range(1, 23)] + ['X', 'Y', 'M'])
+
+# The version of each chromosome's RefSeq accession (NC_000001 to NC_000024 are chromosomes 1-22, X and Y) in GRCh38.
+#   In GRCh37, every version is one lower.
+_GRCH38_REFSEQ_VERSIONS = (11, 12, 12, 12, 10, 12, 14, 11, 12, 11, 10, 12, 11, 9, 10, 10, 11, 10, 10, 11, 9, 11, 11, 10)
+# The mitochondrial sequence (the revised Cambridge reference) is the same in both builds
+_MITOCHONDRIAL_ACCESSION = 'NC_012920.1'
+
+
+def refseq_accessions(build: int) -> ty.Dict[str, str]:
+    """The RefSeq accession of each chromosome (by its canonical name) in a GRCh build"""
+    accessions = {chrom: 'NC_{:06d}.{}'.format(i + 1, version - (38 - build))
+                  for i, (chrom, version) in enumerate(zip(HUMAN_CHROMS, _GRCH38_REFSEQ_VERSIONS))}
+    accessions['M'] = _MITOCHONDRIAL_ACCESSION
+    return accessions
+
+
+def build_number(build: ty.Union[str, int, None]) -> ty.Optional[int]:
+    """The GRCh build number of a build name (eg `GRCh38` or `hg19`) or number, or None if there are no accessions for it"""
+    number = BUILD_LOOKUP.get(build) if isinstance(build, str) else build
+    return number if number in (37, 38) else None
+
+
+def normalize(name: str) -> str:
+    """The general rules for chromosome names: drop any `chr` prefix, and call the mitochondrial chromosome `M`"""
+    if name.startswith('chr'):
+        name = name[3:]
+    if name == 'MT':
+        name = 'M'
+    return name
+
+
+def spellings(chrom: str, builds: ty.Iterable[int] = ()) -> ty.Set[str]:
+    """Every known spelling of a chromosome (by its canonical name), including RefSeq accessions in `builds`"""
+    names = {chrom} | ({'MT'} if chrom == 'M' else set())
+    names |= {name.lower() for name in names}
+    names |= {prefix + name for name in names for prefix in ('chr', 'Chr', 'CHR')}
+    for build in builds:
+        accession = refseq_accessions(build).get(chrom)
+        if accession is not None:
+            names.add(accession)
+    return names
+
+
+# Every known spelling of a human chromosome, from either build (used where no dataset is at hand, eg for metric labels)
+_CANONICAL = {name: chrom for chrom in HUMAN_CHROMS for name in spellings(chrom, (37, 38))}
+
+
+def canonical(name: str) -> str:
+    """The canonical name of any chromosome name (known spellings are looked up; others follow `normalize`)"""
+    chrom = _CANONICAL.get(name)
+    return chrom if chrom is not None else normalize(name)
+
+
+class ContigIndex:
+    """
+    Maps the spellings of a dataset's chromosomes to the names that the dataset uses, and to contig ids (the position of
+        each chromosome in `chroms`)
+    """
+    def __init__(self, chroms: ty.Iterable[str], aliases: ty.Mapping[str, str] = None, *,
+                 build: ty.Union[str, int] = None):
+        """
+        `chroms` are the dataset's chromosome names. `aliases` maps other spellings to them; by default, every known
+            spelling (see `spellings`) is included, with the RefSeq accessions of the dataset's `build` (a name like
+            `GRCh38`, or a number), if it is known.
+        """
+        self.chroms = list(chroms)
+        self.build = build_number(build)
+        if aliases is None:
+            builds = () if self.build is None else (self.build,)
+            aliases = {name: chrom for chrom in self.chroms for name in spellings(normalize(chrom), builds)}
+        self.aliases = dict(aliases)  # type: ty.Dict[str, str]
+        self.aliases.update((chrom, chrom) for chrom in self.chroms)
+        self._ids = {chrom: contig_id for contig_id, chrom in enumerate(self.chroms)}
+
+    def resolve(self, name: str) -> str:
+        """The dataset's name for a chromosome, or (for names that it doesn't know) the name given by `normalize`"""
+        chrom = self.aliases.get(name)
+        return chrom if chrom is not None else normalize(name)
+
+    def contig_id(self, name: str) -> int:
+        """The contig id of a chromosome name, or -1 if the dataset doesn't have that chromosome"""
+        return self._ids.get(self.resolve(name), -1)
+
+    def ids(self, names: ty.Iterable[str]) -> 'np.ndarray':
+        """The contig id of every name (resolving each distinct name once), for `at_many(contig_ids=...)`"""
+        import numpy as np
+        resolved = {}  # type: ty.Dict[str, int]
+        return np.array([resolved[name] if name in resolved else resolved.setdefault(name, self.contig_id(name))
+                         for name in names], dtype=np.int64)
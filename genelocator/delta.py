@@ -0,0 +1,232 @@
+"""
+Upgrade a dataset from one GENCODE release to the next without rebuilding it
+
+Most genes carry over unchanged between releases. `compare` reports the genes that were added, removed or changed
+    (matched by ENSG id without its version); `make_delta` records the edits to each chromosome's list of genes as a
+    `Delta`, which only holds the genes that are new; and `apply` edits a `GeneLocator` with it. Chromosomes without
+    edits keep their interval trees and sorted lists as they are, so only the edited chromosomes are indexed again.
+
+A delta stores a fingerprint of the dataset that it was made from and of the one that it makes. `apply` checks both, so
+    its result is known to hold the same genes as a fresh build of the new release (and so gives the same answers, down
+    to how ties are broken). Genes are always compared, fingerprinted and edited in one fixed order, by chromosome,
+    start and ENSG id, so nothing depends on the order that a dict keeps its keys in (which is arbitrary before Python
+    3.7).
+
+File layout (gzip-compressed): magic (8 bytes) | format version (uint32) | header length (uint32) | header (utf-8 JSON)
+"""
+
+import collections
+import collections.abc
+import difflib
+import gzip
+import hashlib
+import json
+import struct
+import typing as ty
+
+import intervaltree  # type: ignore
+
+from . import exception as gene_exc
+from . import fileformat
+from .contigs import ContigIndex, normalize
+from .lazy import LazyGeneLocator
+from .locate import BisectFinder, GeneLocator
+from .records import Gene
+
+
+MAGIC = b'GENEDLT\x00'
+FORMAT_VERSION = 2  # version 1 listed genes in the order that they were added
+EXTENSION = '.delta.gz'
+
+_PREAMBLE = struct.Struct('<8sII')
+
+# (ensg, start, end, symbol), as stored by `GeneLocator._gene_info`
+GeneRow = ty.Tuple[str, int, int, str]
+
+
+class Changes(collections.namedtuple('Changes', ['added', 'removed', 'changed'])):
+    """
+    `added` and `removed` are lists of `Gene` records; `changed` is a list of (old, new) pairs of records for genes that
+        kept their ENSG id (ignoring the version) but not everything else
+    """
+    __slots__ = ()
+
+    def __bool__(self) -> bool:
+        return bool(self.added or self.removed or self.changed)
+
+
+def _rows(genes) -> ty.List[ty.Tuple[str, GeneRow]]:
+    """
+    (chromosome, row) for every gene of a `GeneLocator`, `CompactGeneLocator`, `GeneList` or iterable of gene dicts,
+        sorted by chromosome, start and ENSG id
+    """
+    if isinstance(genes, LazyGeneLocator):
+        genes = genes._source  # read the file, rather than loading every chromosome
+    if isinstance(genes, GeneLocator):
+        rows = [(chrom, (ensg, start, end, symbol)) for ensg, (chrom, start, end, symbol) in genes._gene_info.items()]
+    else:
+        if hasattr(genes, 'genes'):
+            genes = genes.genes()
+        rows = [(normalize(gene['chrom']), (gene['ensg'], gene['start'], gene['end'], gene['symbol'])) for gene in genes]
+    rows.sort(key=lambda item: (item[0], item[1][1], item[1][0]))
+    return rows
+
+
+def _rows_by_chrom(genes) -> ty.Dict[str, ty.List[GeneRow]]:
+    """The rows of each chromosome, in order (see `_rows`)"""
+    by_chrom = collections.OrderedDict()  # type: ty.Dict[str, ty.List[GeneRow]]
+    for chrom, row in _rows(genes):
+        by_chrom.setdefault(chrom, []).append(row)
+    return by_chrom
+
+
+def fingerprint(genes) -> str:
+    """
+    A checksum of a dataset's genes (in the order of `_rows`), for anything that `compare` accepts. A `GeneLocator` has
+        the same fingerprint as the genes it was built from, and two locators with the same fingerprint give the same
+        answers.
+    """
+    digest = hashlib.sha256()
+    for chrom, (ensg, start, end, symbol) in _rows(genes):
+        digest.update('{}\t{}\t{}\t{}\t{}\n'.format(chrom, ensg, start, end, symbol).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _stable_id(ensg: str) -> str:
+    return ensg.split('.', 1)[0]
+
+
+def compare(old, new) -> Changes:
+    """
+    Find the genes that were added, removed or changed between two datasets. Each can be a `GeneLocator`,
+        `CompactGeneLocator`, `genelist.GeneList` or iterable of gene dicts.
+    """
+    old_genes = collections.OrderedDict((_stable_id(row[0]), Gene(chrom, row[1], row[2], row[0], row[3])) for chrom, row in _rows(old))
+    new_genes = collections.OrderedDict((_stable_id(row[0]), Gene(chrom, row[1], row[2], row[0], row[3])) for chrom, row in _rows(new))
+    return Changes(added=[gene for key, gene in new_genes.items() if key not in old_genes],
+                   removed=[gene for key, gene in old_genes.items() if key not in new_genes],
+                   changed=[(old_genes[key], gene) for key, gene in new_genes.items()
+                            if key in old_genes and old_genes[key] != gene])
+
+
+def _edits(old_rows: ty.List[GeneRow], new_rows: ty.List[GeneRow]) -> list:
+    """
+    The edits that turn one chromosome's rows into another's: a positive number keeps that many rows, a negative number
+        drops that many, and a list of rows is inserted
+    """
+    edits = []  # type: list
+    matcher = difflib.SequenceMatcher(None, old_rows, new_rows, autojunk=False)
+    for tag, old_start, old_end, new_start, new_end in matcher.get_opcodes():
+        if tag == 'equal':
+            edits.append(old_end - old_start)
+            continue
+        if old_end > old_start:
+            edits.append(old_start - old_end)
+        if new_end > new_start:
+            edits.append([list(row) for row in new_rows[new_start:new_end]])
+    return edits
+
+
+def _patch(old_rows: ty.List[GeneRow], edits: list) -> ty.List[GeneRow]:
+    rows = []  # type: ty.List[GeneRow]
+    position = 0
+    for edit in edits:
+        if isinstance(edit, list):
+            rows.extend((ensg, start, end, symbol) for ensg, start, end, symbol in edit)
+        elif edit > 0:
+            rows.extend(old_rows[position:position + edit])
+            position += edit
+        else:
+            position -= edit
+    if position != len(old_rows):
+        raise gene_exc.LookupCreateError('This delta does not fit the dataset that it is being applied to')
+    return rows
+
+
+class Delta:
+    """The edits that turn one dataset into another (see `make_delta`)"""
+    def __init__(self, chroms: ty.List[str], edits: ty.Dict[str, list], base: str, target: str, *,
+                 metadata: dict = None):
+        self.chroms = chroms  # every chromosome of the new dataset, in order
+        self.edits = edits  # only for the chromosomes that changed
+        self.base = base  # the fingerprints of the old and new datasets
+        self.target = target
+        self.metadata = metadata or {}  # eg the gencode versions
+
+    def write(self, out_path) -> None:
+        """Save the delta (atomically)"""
+        header = {'metadata': self.metadata, 'chroms': self.chroms, 'edits': self.edits,
+                  'base': self.base, 'target': self.target}
+        header_bytes = json.dumps(header, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        with fileformat.atomic_output(out_path) as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=9) as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+
+
+def make_delta(old, new, *, metadata: dict = None) -> Delta:
+    """
+    Record how to turn the `old` dataset into the `new` one (each can be anything that `compare` accepts). Within each
+        chromosome, runs of genes that didn't change are stored as a count, so the delta is mostly the new genes.
+    """
+    old, new = (list(genes) if isinstance(genes, collections.abc.Iterator) else genes for genes in (old, new))  # read twice
+    old_by_chrom, new_by_chrom = _rows_by_chrom(old), _rows_by_chrom(new)
+    edits = {chrom: _edits(old_by_chrom.get(chrom, []), rows)
+             for chrom, rows in new_by_chrom.items() if old_by_chrom.get(chrom) != rows}
+    return Delta(list(new_by_chrom), edits, fingerprint(old), fingerprint(new), metadata=metadata)
+
+
+def read(path) -> Delta:
+    """Load a delta that was saved by `Delta.write`"""
+    with gzip.open(path, 'rb') as f:
+        content = f.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise gene_exc.UnsupportedDatasetException('Not a dataset delta file: {}'.format(path))
+    _, version, header_length = _PREAMBLE.unpack_from(content)
+    if version != FORMAT_VERSION:
+        raise gene_exc.UnsupportedDatasetException(
+            'Delta file has format version {}, but this library only reads version {}'.format(version, FORMAT_VERSION))
+    header = json.loads(content[_PREAMBLE.size:_PREAMBLE.size + header_length].decode('utf-8'))
+    return Delta(header['chroms'], header['edits'], header['base'], header['target'], metadata=header['metadata'])
+
+
+def apply(locator: GeneLocator, delta: Delta, *, verify: bool = True) -> GeneLocator:
+    """
+    Make the new version of a (tree-based) dataset. The old locator is left as it is, and shares the indexes of every
+        chromosome that didn't change with the new one.
+
+    With `verify` (the default), raise `UnsupportedDatasetException` if the delta was made from another dataset, and
+        `LookupCreateError` unless the result matches the fingerprint of the dataset that the delta was made to.
+    """
+    if not isinstance(locator, GeneLocator):
+        raise TypeError('Deltas apply to a tree-based GeneLocator, not {}'.format(type(locator).__name__))
+    if isinstance(locator, LazyGeneLocator):
+        locator.load_all()
+    old_by_chrom = _rows_by_chrom(locator)
+    if verify and fingerprint(locator) != delta.base:
+        raise gene_exc.UnsupportedDatasetException('This delta was made for a different dataset')
+
+    patched = GeneLocator.__new__(GeneLocator)
+    patched._gene_info, patched._its, patched._gene_starts, patched._gene_ends = {}, {}, {}, {}
+    for chrom in delta.chroms:
+        if chrom not in delta.edits:
+            # Unchanged: reuse the old indexes
+            for ensg, start, end, symbol in old_by_chrom[chrom]:
+                patched._gene_info[ensg] = (chrom, start, end, symbol)
+            patched._its[chrom] = locator._its[chrom]
+            patched._gene_starts[chrom] = locator._gene_starts[chrom]
+            patched._gene_ends[chrom] = locator._gene_ends[chrom]
+            continue
+        # Index the chromosome in the same way as `GeneLocator.__init__`
+        rows = _patch(old_by_chrom.get(chrom, []), delta.edits[chrom])
+        tree = intervaltree.IntervalTree()
+        for ensg, start, end, symbol in rows:
+            patched._gene_info[ensg] = (chrom, start, end, symbol)
+            tree.addi(start, end, ensg)
+        patched._its[chrom] = tree
+        patched._gene_starts[chrom] = BisectFinder((start, ensg) for ensg, start, end, symbol in rows)
+        patched._gene_ends[chrom] = BisectFinder((end, ensg) for ensg, start, end, symbol in rows)
+
+    patched._contigs = ContigIndex(patched._its, build=locator._contig_index().build)
+    if verify and fingerprint(patched) != delta.target:
+        raise gene_exc.LookupCreateError('Applying the delta did not reproduce the dataset that it was made to')
+    return patched
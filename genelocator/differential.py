@@ -0,0 +1,125 @@
+"""
+Check that other ways of answering lookups agree with the reference `GeneLocator.at`
+
+Any new engine or batch path should give exactly the same genes, in the same order, as calling `at` once per position.
+    This module generates positions that exercise every rule of `at` (random positions, plus gene starts and ends, the
+    positions either side of them, exact ties between the previous and next gene, and the ends of each chromosome),
+    then compares each path against the reference.
+
+Run with `python -m genelocator.differential GRCh38 --positions 100000`.
+"""
+
+import argparse
+import collections
+import random
+import sys
+import typing as ty
+
+from . import get_genelocator
+from .const import BUILD_LOOKUP
+from .sweep import sweep
+
+
+# One disagreement with the reference: which path, the query, and both answers
+Mismatch = collections.namedtuple('Mismatch', ['path', 'chrom', 'pos', 'expected', 'actual'])
+
+
+def _chroms(locator) -> ty.List[str]:
+    return sorted(locator._array_index().chroms)
+
+
+def edge_positions(locator, *, max_per_chrom: int = None, seed: int = 0) -> ty.List[ty.Tuple[str, int]]:
+    """
+    Positions at the boundaries of the rules that `at` follows, for every chromosome (optionally sampling at most
+        `max_per_chrom` genes on each one)
+    """
+    rng = random.Random(seed)
+    positions = []
+    for chrom in _chroms(locator):
+        starts, _, ends, _ = locator._sorted_boundaries(chrom)
+        starts, ends = list(starts), list(ends)
+        positions.extend((chrom, pos) for pos in (0, 1, starts[0] - 1, ends[-1], ends[-1] + 1, ends[-1] + 10 ** 6))
+        genes = list(zip(starts, ends))
+        if max_per_chrom is not None and len(genes) > max_per_chrom:
+            genes = rng.sample(genes, max_per_chrom)
+        for start, end in genes:
+            positions.extend((chrom, pos) for pos in (start - 1, start, start + 1, end - 1, end, end + 1))
+        # Halfway between consecutive boundaries, where the previous gene end and the next gene start can be tied
+        boundaries = sorted(set(starts) | set(ends))
+        if max_per_chrom is not None and len(boundaries) > max_per_chrom:
+            boundaries = sorted(rng.sample(boundaries, max_per_chrom))
+        for left, right in zip(boundaries, boundaries[1:]):
+            positions.extend((chrom, pos) for pos in {(left + right) // 2, (left + right + 1) // 2})
+    return positions
+
+
+def random_positions(locator, n: int, *, seed: int = 0) -> ty.List[ty.Tuple[str, int]]:
+    """`n` uniformly random positions, on every chromosome (with a few past its last gene)"""
+    rng = random.Random(seed)
+    chroms = _chroms(locator)
+    limits = {chrom: locator._sorted_boundaries(chrom)[2][-1] * 11 // 10 for chrom in chroms}
+    names = collections.defaultdict(list)  # type: ty.Dict[str, ty.List[str]]
+    for name, chrom in sorted(locator._array_index().contigs.aliases.items()):
+        names[chrom].append(name)  # every spelling that the dataset accepts, eg chr19 and NC_000019.10
+    positions = []
+    for _ in range(n):
+        chrom = rng.choice(chroms)
+        positions.append((rng.choice(names[chrom]), rng.randint(0, limits[chrom])))
+    return positions
+
+
+def _paths(locator, positions: ty.List[ty.Tuple[str, int]]) -> ty.Iterator[ty.Tuple[str, ty.List[ty.List[dict]]]]:
+    """Yield (name, answers) for every way that `locator` can answer `positions`"""
+    chroms = [chrom for chrom, _ in positions]
+    pos = [p for _, p in positions]
+    yield 'at', [locator.at(c, p, strict=False) for c, p in positions]
+    yield 'at(result=gene)', [[g.as_dict() for g in locator.at(c, p, strict=False, result='gene')] for c, p in positions]
+    yield 'at_many', locator.at_many(chroms, pos, strict=False).to_lists()
+    order = sorted(range(len(positions)), key=lambda i: (locator._chrom_key(positions[i][0]), positions[i][1]))
+    swept = [genes for _, genes in sweep(locator, [positions[i] for i in order], strict=False)]
+    answers = [None] * len(positions)  # type: ty.List[ty.Any]
+    for i, genes in zip(order, swept):
+        answers[i] = genes
+    yield 'sweep', answers
+
+
+def compare(reference, candidate, positions: ty.List[ty.Tuple[str, int]], *, max_mismatches: int = 100) -> ty.List[Mismatch]:
+    """
+    Compare every lookup path of `candidate` (`at`, the record results, `at_many` and `sweep`) with `reference.at`, and
+        return up to `max_mismatches` disagreements. `candidate` can be the reference itself, to check its batch paths.
+    """
+    expected = [reference.at(chrom, pos, strict=False) for chrom, pos in positions]
+    mismatches = []
+    for path, answers in _paths(candidate, positions):
+        for (chrom, pos), want, got in zip(positions, expected, answers):
+            if want != got:
+                mismatches.append(Mismatch(path, chrom, pos, want, got))
+                if len(mismatches) >= max_mismatches:
+                    return mismatches
+    return mismatches
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Compare every engine and batch path against GeneLocator.at")
+    parser.add_argument('build', choices=BUILD_LOOKUP.keys())
+    parser.add_argument('--version', type=int, default=32)
+    parser.add_argument('--all-genetypes', action='store_true')
+    parser.add_argument('--positions', type=int, default=100000, help="Number of random positions")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    options = dict(gencode_version=args.version, common_genetypes_only=not args.all_genetypes)
+    reference = get_genelocator(args.build, engine='tree', **options)
+    positions = edge_positions(reference, seed=args.seed) + random_positions(reference, args.positions, seed=args.seed)
+    failed = False
+    for engine in ('tree', 'compact', 'tiled'):
+        mismatches = compare(reference, get_genelocator(args.build, engine=engine, **options), positions)
+        print('{}: {} positions, {} mismatches'.format(engine, len(positions), len(mismatches)))
+        for mismatch in mismatches[:10]:
+            print('  {}'.format(mismatch))
+        failed = failed or bool(mismatches)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
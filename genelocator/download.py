@@ -3,20 +3,31 @@ This script downloads Gencode data and converts it to a locator object
 
 This represents the "build step" to create a locator object from raw data
 """
+import collections
+import contextlib
 import gzip
 import io
-import json
+import logging
 import os
 import pickle
 import re
+import time
 import typing as ty
+import urllib.parse
 import urllib.request
 
+from . import assets
+from .assets import get_metadata
 from . import const
 from . import exception as gene_exc
+from . import fileformat
+from . import genelist
 from .locate import GeneLocator
 
 
+logger = logging.getLogger(__name__)
+
+
 # These "common" genetypes are usually the most useful
 # To see all genetypes, run `Counter(g['genetype'] for g in _get_unfiltered_genes_iterator(38)).most_common()`
 # These genetypes are copied from <https://github.com/hyunminkang/cramore/blob/6d85ed9/cmd_plp_make_dge_matrix.cpp#L137>.
@@ -37,100 +48,247 @@ COMMON_GENETYPES = {
 }
 
 
-def _download_gencode_gtf_gz_bytes(grch_build_number: int, gencode_version: int) -> bytes:
-    """Download the file, hold it in memory, and return it as bytes"""
+# Matches each `key "value";` pair in the attributes column of a GTF line
+_GTF_ATTRIBUTE = re.compile(r'(\w+) "([^"]*)"')
+_ENSG = re.compile(r'ENSGR?[0-9._A-Z]+\Z')
+
+
+class BuildTimings:
+    """
+    Seconds spent in each stage of building a dataset. Stages can be nested (eg reading compressed data from the network
+        while decompressing it); time is only counted towards the innermost stage that is running.
+    """
+    STAGES = ('fetch', 'decompress', 'parse', 'filter', 'index', 'serialize')
+
+    def __init__(self):
+        self.seconds = collections.OrderedDict((stage, 0.0) for stage in self.STAGES)
+        self._running = []  # type: ty.List[str]
+        self._since = 0.0
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> ty.Iterator[None]:
+        now = time.perf_counter()
+        if self._running:
+            self.seconds[self._running[-1]] += now - self._since
+        self._running.append(name)
+        self._since = now
+        try:
+            yield
+        finally:
+            now = time.perf_counter()
+            self.seconds[self._running.pop()] += now - self._since
+            self._since = now
+
+    def __repr__(self):
+        return 'BuildTimings({})'.format(', '.join('{}={:.2f}s'.format(k, v) for k, v in self.seconds.items()))
+
+
+class _TimedReader(io.RawIOBase):
+    """Wrap a binary stream, counting time spent reading it towards a stage (and optionally checking its length)"""
+    def __init__(self, raw, timings: BuildTimings, stage: str, *, expected_length: int = None):
+        self._raw = raw
+        self._timings = timings
+        self._stage = stage
+        self._expected_length = expected_length
+        self._length = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        with self._timings.stage(self._stage):
+            data = self._raw.read(len(buffer))
+        buffer[:len(data)] = data
+        self._length += len(data)
+        if not data and self._expected_length is not None and self._length != self._expected_length:
+            raise gene_exc.AssetFetchError('Expected {!r} bytes but received {!r} bytes.'.format(self._expected_length, self._length))
+        return len(data)
+
+
+def _get_gencode_url(grch_build_number: int, gencode_version: int) -> str:
     if grch_build_number == 37:
         template = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_human/release_{gencode_version}/GRCh37_mapping/gencode.v{gencode_version}lift37.annotation.gtf.gz'
     elif grch_build_number == 38:
         template = 'ftp://ftp.ebi.ac.uk/pub/databases/gencode/Gencode_human/release_{gencode_version}/gencode.v{gencode_version}.basic.annotation.gtf.gz'
     else:
         raise Exception('cannot handle GRCh build {!r}'.format(grch_build_number))
-    with urllib.request.urlopen(url=template.format(gencode_version=gencode_version)) as f:
-        x = f.read()
-        content_length = int(f.headers.get('Content-length'))
-        if len(x) != content_length:
-            raise Exception('Expected {!r} bytes but received {!r} bytes beginning {!r}.'.format(
-                content_length, len(x), x[:100]))
-        return x
+    return template.format(gencode_version=gencode_version)
+
+
+@contextlib.contextmanager
+def _open_gencode_gtf(source: str, timings: BuildTimings) -> ty.Iterator[ty.BinaryIO]:
+    """
+    Stream the decompressed lines of a GENCODE GTF file. `source` can be a URL (ftp, http, https or file) or a local
+        path. Nothing is buffered beyond what decompression needs, so memory use doesn't depend on the file size.
+    """
+    if os.path.exists(source):
+        source = 'file:' + urllib.request.pathname2url(os.path.abspath(source))
+    with timings.stage('fetch'):
+        response = urllib.request.urlopen(url=source)
+    with response:
+        content_length = response.headers.get('Content-length')
+        if urllib.parse.urlparse(source).scheme == 'file' or content_length is None:
+            expected_length = None
+        else:
+            expected_length = int(content_length)
+        compressed = io.BufferedReader(_TimedReader(response, timings, 'fetch', expected_length=expected_length),
+                                       buffer_size=1024 * 1024)
+        decompressed = _TimedReader(gzip.GzipFile(fileobj=compressed), timings, 'decompress')
+        yield io.BufferedReader(decompressed, buffer_size=1024 * 1024)
 
 
-def _get_genelist_filename(grch_build_number: int, *, gencode_version: int = 32, common_genetypes_only: bool = True) -> str:
-    return 'gencode-{}-gencode{}-{}.json.gz'.format(grch_build_number, gencode_version,
-                                                    'common_genetypes_only' if common_genetypes_only else 'all')
+def _get_genelist_filename(grch_build_number: int, *, gencode_version: int = 32) -> str:
+    return 'gencode-{}-gencode{}{}'.format(grch_build_number, gencode_version, genelist.EXTENSION)
 
 
-def _save_locator(locator: GeneLocator, out_path):
+def save_locator(locator: GeneLocator, out_path, *, metadata: dict = None):
     """
     Once the interval tree has been created, it is convenient to save it for future use.
+
+    Paths ending in `.gloc` are written in the memory-mappable binary format (see `fileformat`); anything else is
+        written as a gzipped pickle. Either way, the file is replaced atomically.
     """
-    with gzip.open(out_path, 'wb') as f:
+    if str(out_path).endswith(fileformat.EXTENSION):
+        fileformat.write(locator, out_path, metadata=metadata)
+        return
+    with fileformat.atomic_output(out_path) as raw, gzip.GzipFile(fileobj=raw, mode='wb') as f:
         # protocol=4 is faster and supported in python3.4+
         pickle.dump(locator, f, protocol=4)
 
 
-def _get_unfiltered_genes_iterator(grch_build_number: int, *, gencode_version: int = 32) -> ty.Iterator[dict]:
-    compressed = _download_gencode_gtf_gz_bytes(grch_build_number, gencode_version)
-    with gzip.open(io.BytesIO(compressed), 'rt') as f:  # avoid holding the full text uncompressed in RAM at once
-        for line in f:
-            if line.startswith('#'):
-                continue
-            chrom, source, feature_type, start, end, _, strand, CDS_phase, info = line.split('\t')
-            if feature_type != 'gene':
-                continue
-            start = int(start)
-            end = int(end)
-            if start >= end:
-                raise Exception('start >= end for line {!r}'.format(line))
-            ensg = _extract_first_group(r'gene_id "(ENSGR?[0-9._A-Z]+?)"', info)  # Sometimes we want `ensg.split('.')[0]` but not here.
-            symbol = _extract_first_group(r'gene_name "(.+?)"', info)
-            genetype = _extract_first_group(r'gene_type "(.+?)"', info)
-            yield {'chrom': chrom, 'start': start, 'end': end, 'ensg': ensg, 'symbol': symbol, 'genetype': genetype, 'line': line}
-
-
-def get_genes_iterator(grch_build: str, *, gencode_version: int = 32, common_genetypes_only: bool = True) -> ty.Iterator[dict]:
+def _parse_gene_line(line: str) -> dict:
+    chrom, source, feature_type, start, end, _, strand, CDS_phase, info = line.split('\t')
+    start = int(start)
+    end = int(end)
+    if start >= end:
+        raise Exception('start >= end for line {!r}'.format(line))
+    attributes = dict(_GTF_ATTRIBUTE.findall(info))
+    try:
+        ensg = attributes['gene_id']  # Sometimes we want `ensg.split('.')[0]` but not here.
+        symbol = attributes['gene_name']
+        genetype = attributes['gene_type']
+    except KeyError as e:
+        raise Exception('Missing attribute {} on line {!r}'.format(e, line))
+    if not _ENSG.match(ensg):
+        raise Exception('Unexpected gene_id {!r} on line {!r}'.format(ensg, line))
+    return {'chrom': chrom, 'start': start, 'end': end, 'ensg': ensg, 'symbol': symbol, 'genetype': genetype, 'line': line}
+
+
+def _get_unfiltered_genes_iterator(grch_build_number: int, *, gencode_version: int = 32, source: str = None,
+                                   timings: BuildTimings = None) -> ty.Iterator[dict]:
+    """
+    Stream genes out of a GENCODE GTF file, downloading it from GENCODE unless `source` (a URL or path) is given.
+    """
+    timings = timings or BuildTimings()
+    source = source or _get_gencode_url(grch_build_number, gencode_version)
+    with _open_gencode_gtf(source, timings) as f:
+        lines = iter(f)
+        while True:
+            with timings.stage('parse'):
+                # Most lines are transcripts, exons etc; skip them without decoding or splitting them
+                for line in lines:
+                    if b'\tgene\t' in line and not line.startswith(b'#') and line.split(b'\t', 3)[2] == b'gene':
+                        gene = _parse_gene_line(line.decode('utf-8').rstrip('\n'))
+                        break
+                else:
+                    return
+            yield gene
+
+
+def get_genes_iterator(grch_build: str, *, gencode_version: int = 32, common_genetypes_only: bool = True,
+                       source: str = None, timings: BuildTimings = None, cache_dir: str = None) -> ty.Iterator[dict]:
     """
     Get a list of genes (represented by dicts). The CODINGLIKE_GENETYPES in this module were chosen manually.
-    This creates an intermediate datafile that is then used to build the interval tree, so usually this function is
-        only used during initial dataset generation
+    This creates an intermediate datafile (a `GeneList`, cached in `cache_dir`; see `get_genelist`) that is then used to
+        build the interval tree, so usually this function is only used during initial dataset generation
         (not during day-to-day analysis)
+
+    `source` is a URL or local path of a GENCODE GTF file to use instead of downloading one (eg to work offline).
+        If `timings` is given, the time spent in each stage is added to it.
     """
     try:
         grch_build_number = const.BUILD_LOOKUP[grch_build]
     except KeyError:
         raise gene_exc.AssetFetchError('Cannot retrieve assets for build {}'.format(grch_build))
 
-    filepath = os.path.join(os.path.dirname(__file__),
-                            'data',
-                            _get_genelist_filename(grch_build_number, gencode_version=gencode_version,
-                                                   common_genetypes_only=common_genetypes_only))
-    if os.path.exists(filepath):
-        with gzip.open(filepath, 'rt') as f:
-            yield from json.load(f)
-    else:
-        for gene in _get_unfiltered_genes_iterator(grch_build_number, gencode_version=gencode_version):
+    timings = timings or BuildTimings()
+    genes = get_genelist(grch_build_number, gencode_version=gencode_version, source=source, timings=timings,
+                         cache_dir=cache_dir)
+    with timings.stage('filter'):
+        selected = list(genes.genes(geneset_genetypes('common_genetypes' if common_genetypes_only else 'all')))
+    yield from selected
+
+
+def get_genelist(grch_build_number: int, *, gencode_version: int = 32, source: str = None,
+                 timings: BuildTimings = None, cache_dir: str = None) -> genelist.GeneList:
+    """
+    Get every gene on the regular chromosomes (with its genetype) as a columnar `GeneList`.
+
+    The first time, the GTF file is downloaded (or read from `source`) and parsed, and the result is saved in `cache_dir`
+        (by default, the cache folder; see `assets.get_cache_dir`). Later calls for the same build, gencode version and source read that
+        cache instead, which takes well under a second and needs no network access.
+    """
+    timings = timings or BuildTimings()
+    if source is not None and os.path.exists(source):
+        source = os.path.abspath(source)
+    source = source or _get_gencode_url(grch_build_number, gencode_version)
+    cache_path = os.path.join(assets.get_cache_dir(cache_dir), _get_genelist_filename(grch_build_number, gencode_version=gencode_version))
+    if os.path.exists(cache_path):
+        with timings.stage('fetch'):
+            cached = genelist.read(cache_path)
+        if cached.metadata.get('source') == source:
+            return cached
+        logger.info('Ignoring the gene list cache %s, which was made from %s', cache_path, cached.metadata.get('source'))
+
+    genes = genelist.GeneList.from_genes(
+        _get_chromosome_genes_iterator(grch_build_number, gencode_version=gencode_version, source=source, timings=timings),
+        metadata={'grch_build_number': grch_build_number, 'gencode_version': gencode_version, 'source': source})
+    with timings.stage('serialize'):
+        try:
+            genes.write(cache_path)
+        except OSError as e:
+            logger.warning('Could not save the gene list cache %s: %s', cache_path, e)
+    return genes
+
+
+def _get_chromosome_genes_iterator(grch_build_number: int, *, gencode_version: int, source: ty.Optional[str],
+                                   timings: BuildTimings) -> ty.Iterator[dict]:
+    """Genes on the regular chromosomes (still including their `genetype`, so that genesets can be chosen later)"""
+    for gene in _get_unfiltered_genes_iterator(grch_build_number, gencode_version=gencode_version, source=source,
+                                               timings=timings):
+        with timings.stage('filter'):
             if not gene['chrom'].startswith('chr'):
                 if gene['chrom'].startswith('GL'):
                     # We don't know what to do with this type of entry, even though it's a valid identifier
                     continue
                 else:
                     raise Exception('Unknown chromosome {!r} on line {!r}'.format(gene['chrom'], gene['line']))
-            if common_genetypes_only and gene['genetype'] not in COMMON_GENETYPES:
-                continue
-            gene.pop('genetype')
             gene.pop('line')
-            yield gene
+        yield gene
 
 
-def _extract_first_group(pattern: str, string: str) -> str:
-    match = re.search(pattern, string)
-    if match is None:
-        raise Exception("re.search({!r}, {!r}) didn't match!")
-    return match.group(1)
+def geneset_genetypes(geneset: str) -> ty.Optional[ty.Container[str]]:
+    """The genetypes in the named geneset (see `const.KNOWN_GENESETS`), or None if it has every genetype"""
+    if geneset == 'all':
+        return None
+    elif geneset == 'common_genetypes':
+        return COMMON_GENETYPES
+    raise gene_exc.UnsupportedDatasetException('Unknown geneset {!r}'.format(geneset))
 
 
-def make_gene_locator(grch_build: str, out_path, *, gencode_version: int = 32, common_genetypes_only: bool = True) -> GeneLocator:
-    # TODO: We should save this genes list for performance reasons if possible
-    genes = get_genes_iterator(grch_build, gencode_version=gencode_version, common_genetypes_only=common_genetypes_only)
-    locator = GeneLocator(genes)
-    _save_locator(locator, out_path)
+def make_gene_locator(grch_build: str, out_path, *, gencode_version: int = 32, common_genetypes_only: bool = True,
+                      source: str = None, timings: BuildTimings = None, cache_dir: str = None) -> GeneLocator:
+    """
+    Build a locator from GENCODE data and save it to `out_path`. See `get_genes_iterator` for `source`, `timings` and
+        `cache_dir`; the time for each stage is also logged.
+    """
+    timings = timings or BuildTimings()
+    genes = get_genes_iterator(grch_build, gencode_version=gencode_version, common_genetypes_only=common_genetypes_only,
+                               source=source, timings=timings, cache_dir=cache_dir)
+    with timings.stage('index'):
+        locator = GeneLocator(genes, build=grch_build)
+    geneset = 'common_genetypes' if common_genetypes_only else 'all'
+    with timings.stage('serialize'):
+        save_locator(locator, out_path, metadata=get_metadata(grch_build, gencode_version, geneset))
+    logger.info('Built %s: %r', out_path, timings)
     return locator
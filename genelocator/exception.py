@@ -25,6 +25,10 @@ class NoResultsFoundException(BaseGeneLocatorException):
     DEFAULT_MESSAGE = "No results found"
 
 
+class UnsortedInputException(BaseGeneLocatorException):
+    DEFAULT_MESSAGE = "Positions must be sorted by chromosome and then position"
+
+
 # Problems locating the cached lookup data
 class UnsupportedDatasetException(BaseGeneLocatorException):
     """unable to load data (for any reason)"""
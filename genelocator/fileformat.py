@@ -0,0 +1,208 @@
+"""
+A versioned binary file format for gene locators, designed to be memory-mapped
+
+Layout (integers are little-endian):
+    magic (8 bytes) | format version (uint32) | header length (uint32) | header (utf-8 JSON) | sections...
+
+The header holds the dataset metadata, the chromosome names (and the other spellings of them, `contig_aliases`, with
+    the build of their RefSeq accessions, `contig_build`), and the (offset, size, type) of every section. Each section
+    is a flat array (int32 gene ids or int64 positions) or a utf-8 string blob, aligned to 8 bytes. Genes are described
+    once (`genes/...`), and every chromosome has its own sorted arrays (`chroms/<name>/...`). Files saved from a
+    `TiledGeneLocator` also hold its tiling (`chroms/<name>/tile_...`), which other readers ignore.
+
+Opening a file maps it into memory and wraps each section in a `memoryview`. Nothing is copied or decoded until a query
+    touches it, so opening takes about the same time regardless of how large the dataset is. `read_info` reads just the
+    header, and `lazy.LazyGeneLocator` builds interval trees one chromosome at a time from the per-chromosome sections.
+"""
+
+import array
+import contextlib
+import json
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import typing as ty
+
+from . import exception as gene_exc
+from .compact import CompactGeneLocator
+from .contigs import ContigIndex, build_number
+from .const import FILE_EXTENSIONS
+from .index import ArrayIndex, ChromIndex, GeneTable, StringTable
+from .tiling import ChromTiling, TiledGeneLocator
+
+
+MAGIC = b'GENELOC\x00'
+FORMAT_VERSION = 1
+EXTENSION = FILE_EXTENSIONS['binary']
+
+_PREAMBLE = struct.Struct('<8sII')
+_ALIGNMENT = 8
+_TYPECODES = {'i': 4, 'q': 8, 'B': 1}  # int32 ids, int64 positions, raw bytes
+
+
+def _align(offset: int) -> int:
+    return -(-offset // _ALIGNMENT) * _ALIGNMENT
+
+
+def is_locator_file(path) -> bool:
+    """Check whether a file is in this format (rather than, eg, a gzipped pickle)"""
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _sections(index: ArrayIndex, tiling: ty.Dict[str, ChromTiling] = None) -> ty.Iterator[ty.Tuple[str, str, ty.Any]]:
+    """Yield (name, typecode, buffer) for every section of the file"""
+    table = index.table
+    yield 'genes/chrom_ids', 'i', table.chrom_ids
+    yield 'genes/start', 'q', table.start
+    yield 'genes/end', 'q', table.end
+    for column in ('ensg', 'symbol'):
+        strings = getattr(table, column)
+        yield 'genes/{}/offsets'.format(column), 'q', strings.offsets
+        yield 'genes/{}/data'.format(column), 'B', strings.data
+    for chrom, arrays in index.chroms.items():
+        for name in ChromIndex.ARRAYS:
+            yield 'chroms/{}/{}'.format(chrom, name), 'i' if name.endswith('_ids') else 'q', getattr(arrays, name)
+    for chrom, tiles in (tiling or {}).items():
+        for name in ChromTiling.ARRAYS:
+            yield 'chroms/{}/{}'.format(chrom, name), ChromTiling.TYPECODES[name], getattr(tiles, name)
+
+
+def _to_little_endian(buffer, typecode: str) -> bytes:
+    data = memoryview(buffer)
+    if data.itemsize != _TYPECODES[typecode]:
+        raise gene_exc.LookupCreateError('Expected {}-byte items but got {}'.format(_TYPECODES[typecode], data.itemsize))
+    if sys.byteorder == 'little' or typecode == 'B':
+        return data.tobytes()
+    swapped = array.array(typecode, data.tobytes())
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+@contextlib.contextmanager
+def atomic_output(out_path) -> ty.Iterator[ty.BinaryIO]:
+    """
+    Open a file for writing under a temporary name in the same directory, and rename it to `out_path` once the block
+        completes. Readers (and concurrent writers) never see a partial file; on error, nothing is left behind.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_path))
+    fd, tmp_path = tempfile.mkstemp(dir=out_dir, prefix='.tmp-', suffix=os.path.basename(out_path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            yield f
+        os.chmod(tmp_path, 0o644)  # mkstemp creates files that only the owner can read
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _contig_index(index: ArrayIndex, metadata: ty.Optional[dict]) -> ContigIndex:
+    """The chromosome names to save; if `metadata` names the build, they use its RefSeq accessions"""
+    contigs = index.contigs
+    build = (metadata or {}).get('build')
+    if build is not None and build_number(build) != contigs.build:
+        contigs = ContigIndex(contigs.chroms, build=build)
+    return contigs
+
+
+def write(locator, out_path, *, metadata: dict = None) -> None:
+    """
+    Save a `GeneLocator` or `CompactGeneLocator` in the binary format. `metadata` (eg build and gencode version) is
+        stored in the header as-is. The tiling of a `TiledGeneLocator` is saved too.
+
+    The file is written atomically (see `atomic_output`).
+    """
+    index = locator._array_index()
+    contigs = _contig_index(index, metadata)
+    sections = []
+    header = {
+        'metadata': metadata or {},
+        'n_genes': len(index.table),
+        'chrom_names': index.table.chrom_names,
+        'chroms': list(index.chroms),
+        'contig_aliases': contigs.aliases,
+        'contig_build': contigs.build,
+        'sections': {},
+    }
+    offset = 0
+    for name, typecode, buffer in _sections(index, getattr(locator, '_tiling', None)):
+        data = _to_little_endian(buffer, typecode)
+        header['sections'][name] = [offset, len(data), typecode]
+        sections.append((offset, data))
+        offset = _align(offset + len(data))
+    header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+    data_start = _align(_PREAMBLE.size + len(header_bytes))
+
+    with atomic_output(out_path) as f:
+        f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+        f.write(header_bytes)
+        for section_offset, data in sections:
+            f.seek(data_start + section_offset)
+            f.write(data)
+        f.truncate(data_start + offset)
+
+
+def _read_preamble(f) -> ty.Tuple[int, dict]:
+    """Check the magic and version, and return (offset of the first section, header)"""
+    preamble = f.read(_PREAMBLE.size)
+    if len(preamble) < _PREAMBLE.size or preamble[:len(MAGIC)] != MAGIC:
+        raise gene_exc.UnsupportedDatasetException('Not a gene locator file')
+    _, version, header_length = _PREAMBLE.unpack(preamble)
+    if version != FORMAT_VERSION:
+        raise gene_exc.UnsupportedDatasetException(
+            'Gene locator file has format version {}, but this library only reads version {}'.format(version, FORMAT_VERSION))
+    header = json.loads(f.read(header_length).decode('utf-8'))
+    return _align(_PREAMBLE.size + header_length), header
+
+
+def read_info(path) -> dict:
+    """
+    Describe a dataset file without loading any of its genes: its metadata (eg build, gencode version and geneset), the
+        total number of genes, and the number of genes on each chromosome
+    """
+    with open(path, 'rb') as f:
+        _, header = _read_preamble(f)
+    sizes = header['sections']
+    return {
+        'metadata': header['metadata'],
+        'n_genes': header['n_genes'],
+        'chroms': {chrom: sizes['chroms/{}/starts'.format(chrom)][1] // _TYPECODES['q'] for chrom in header['chroms']},
+    }
+
+
+def load(path, *, tiled: bool = False) -> CompactGeneLocator:
+    """
+    Memory-map a gene locator file. The returned locator reads directly from the mapped file.
+
+    With `tiled=True`, return a `TiledGeneLocator`, using the tiling saved in the file (or compiling one, if there is none).
+    """
+    if sys.byteorder != 'little':
+        raise gene_exc.UnsupportedDatasetException('Memory-mapped gene locator files require a little-endian machine')
+    with open(path, 'rb') as f:
+        data_start, header = _read_preamble(f)
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    buffer = memoryview(mapped)
+
+    def section(name):
+        offset, size, typecode = header['sections'][name]
+        view = buffer[data_start + offset:data_start + offset + size]
+        return view if typecode == 'B' else view.cast(typecode)
+
+    table = GeneTable(header['chrom_names'], section('genes/chrom_ids'), section('genes/start'), section('genes/end'),
+                      StringTable(section('genes/ensg/data'), section('genes/ensg/offsets')),
+                      StringTable(section('genes/symbol/data'), section('genes/symbol/offsets')))
+    chroms = {chrom: ChromIndex(*(section('chroms/{}/{}'.format(chrom, name)) for name in ChromIndex.ARRAYS))
+              for chrom in header['chroms']}
+    # Files written before aliases were saved get the default ones
+    build = header.get('contig_build', header['metadata'].get('build'))
+    index = ArrayIndex(table, chroms, ContigIndex(header['chroms'], header.get('contig_aliases'), build=build))
+    if not tiled:
+        return CompactGeneLocator(index, metadata=header['metadata'])
+    tiling = None
+    if all('chroms/{}/tile_starts'.format(chrom) in header['sections'] for chrom in header['chroms']):
+        tiling = {chrom: ChromTiling(*(section('chroms/{}/{}'.format(chrom, name)) for name in ChromTiling.ARRAYS))
+                  for chrom in header['chroms']}
+    return TiledGeneLocator(index, tiling, metadata=header['metadata'])
@@ -0,0 +1,150 @@
+"""
+Annotate the positions in a pandas DataFrame or an Arrow table with their genes, a whole column at a time
+
+    annotated = annotate_dataframe(gl, variants, chrom='chrom', pos='pos')
+    annotated[['chrom', 'pos', 'symbol', 'distance']]
+
+Positions are read straight from the column's buffer, and chromosome names are read once per distinct name (from the
+    categories or dictionary of a categorical column, or after factorizing a string column), so no Python object is
+    made per row. The answers are the same as `at`. These columns are added:
+    - `gene_chrom` and `symbol` (categorical), `ensg`, `gene_start` and `gene_end`
+    - `distance`: 0 for genes that overlap the position, otherwise the distance in bp to the nearest gene
+    - `overlap`: whether the gene overlaps the position (a nearby gene can also be 0bp away)
+
+A position can overlap several genes. With `multiple='first'`, each row gets the first of them (in order of start
+    position); with `multiple='explode'`, the row is repeated once per gene (as `DataFrame.explode` would). Rows on
+    unknown chromosomes get empty (null) gene columns, unless `strict=True`. If the input already has a column with one
+    of these names, a ValueError is raised; use `prefix` (eg `prefix='gl_'`) to name the new columns differently.
+
+pandas and pyarrow are optional dependencies: they are only imported when these functions are used.
+"""
+
+import typing as ty
+
+from .annotate import GENE_COLUMNS
+
+if ty.TYPE_CHECKING:
+    import numpy as np  # noqa: F401
+
+
+MULTIPLE = {'first', 'explode'}
+# The columns that are added, in order
+COLUMNS = GENE_COLUMNS + ('overlap',)
+
+
+def _check_columns(existing: ty.Iterable[str], prefix: str) -> None:
+    existing = set(existing)
+    clashes = [prefix + column for column in COLUMNS if prefix + column in existing]
+    if clashes:
+        raise ValueError('The input already has columns named {}; choose a prefix for the new columns'.format(
+            ', '.join(repr(column) for column in clashes)))
+
+
+def _locate(locator, names: ty.List[str], codes: 'np.ndarray', positions: 'np.ndarray', multiple: str,
+            strict: bool) -> 'ty.Tuple[np.ndarray, np.ndarray, ty.Any]':
+    """
+    Answer every position. Returns (input row of each output row, index into the results of each output row or -1 if it
+        has no gene, the `BatchResult`)
+    """
+    import numpy as np
+    if multiple not in MULTIPLE:
+        raise ValueError('Unknown value for multiple: {!r}; choose one of {}'.format(multiple, sorted(MULTIPLE)))
+    result = locator._array_index().at_many(names, positions, strict=strict, chrom_codes=codes)
+    counts = result.counts
+    if multiple == 'first':
+        return np.arange(len(result)), np.where(counts > 0, result.offsets[:-1], -1), result
+
+    # One row per gene, and one (empty) row for a position without any genes
+    rows_per_query = np.maximum(counts, 1)
+    rows = np.repeat(np.arange(len(result)), rows_per_query)
+    hits = np.full(len(rows), -1, dtype=np.int64)
+    first_row = np.cumsum(rows_per_query) - rows_per_query
+    query_index = result.query_index
+    hits[first_row[query_index] + np.arange(len(query_index)) - result.offsets[query_index]] = np.arange(len(query_index))
+    return rows, hits, result
+
+
+def _gene_columns(result, hits: 'np.ndarray') -> ty.Dict[str, ty.Tuple[str, ty.Any, ty.Any]]:
+    """
+    The values of each new column as numpy arrays, with a mask of the rows that have no gene. Categorical columns are
+        (categories, codes), with code -1 for no gene.
+    """
+    import numpy as np
+    missing = hits < 0
+    hit = np.where(missing, 0, hits)
+    gene_ids = result.gene_ids[hit] if len(result.gene_ids) else np.zeros(len(hits), dtype=np.int32)
+    table = result._table
+    columns = {}  # type: ty.Dict[str, ty.Tuple[str, ty.Any, ty.Any]]
+    for column, name in (('gene_chrom', 'chrom'), ('symbol', 'symbol')):
+        categories, codes = table.categories(name)
+        columns[column] = ('category', categories, np.where(missing, -1, codes[gene_ids]))
+    columns['ensg'] = ('string', table.column('ensg')[gene_ids], missing)
+    columns['gene_start'] = ('int', table.column('start')[gene_ids], missing)
+    columns['gene_end'] = ('int', table.column('end')[gene_ids], missing)
+    columns['distance'] = ('int', result.distances[hit] if len(result.distances) else np.zeros(len(hits), dtype=np.int64), missing)
+    columns['overlap'] = ('bool', result.overlap[hit] if len(result.overlap) else np.zeros(len(hits), dtype=bool), missing)
+    return {column: columns[column] for column in COLUMNS}
+
+
+def annotate_dataframe(locator, df, chrom: str = 'chrom', pos: str = 'pos', *, multiple: str = 'first',
+                       strict: bool = False, prefix: str = ''):
+    """
+    Return a copy of a pandas DataFrame with gene columns added (named with `prefix`), for the positions in the columns
+        `chrom` and `pos`. Any locator engine works.
+    """
+    import numpy as np
+    import pandas as pd  # optional dependency
+
+    _check_columns(df.columns, prefix)
+    chroms = df[chrom]
+    if isinstance(chroms.dtype, pd.CategoricalDtype):
+        names, codes = list(chroms.cat.categories), chroms.cat.codes.to_numpy()
+    else:
+        codes, uniques = pd.factorize(chroms)
+        names = list(uniques)
+    positions = df[pos].to_numpy(dtype=np.int64)  # raises an error for missing positions
+    rows, hits, result = _locate(locator, [str(name) for name in names], codes, positions, multiple, strict)
+
+    annotated = df.take(rows) if multiple == 'explode' else df.copy()
+    for column, (kind, values, extra) in _gene_columns(result, hits).items():
+        if kind == 'category':
+            annotated[prefix + column] = pd.Categorical.from_codes(extra, categories=values)
+        elif kind == 'string':
+            annotated[prefix + column] = np.where(extra, None, values)
+        elif kind == 'int':
+            annotated[prefix + column] = pd.arrays.IntegerArray(values, extra)
+        else:
+            annotated[prefix + column] = pd.arrays.BooleanArray(values, extra)
+    return annotated
+
+
+def annotate_arrow(locator, table, chrom: str = 'chrom', pos: str = 'pos', *, multiple: str = 'first',
+                   strict: bool = False, prefix: str = ''):
+    """
+    Return a pyarrow Table with gene columns added (named with `prefix`), for the positions in the columns `chrom` and
+        `pos`. Categorical columns are dictionary-encoded. Any locator engine works.
+    """
+    import numpy as np
+    import pyarrow as pa  # optional dependency
+    import pyarrow.compute as pc
+
+    _check_columns(table.column_names, prefix)
+    chroms = table.column(chrom).combine_chunks()
+    if not pa.types.is_dictionary(chroms.type):
+        chroms = pc.dictionary_encode(chroms)
+    names = chroms.dictionary.to_pylist()
+    codes = pc.fill_null(chroms.indices, -1).to_numpy()
+    positions = table.column(pos).combine_chunks()
+    if positions.null_count:
+        raise ValueError('The {!r} column has missing positions'.format(pos))
+    positions = positions.to_numpy(zero_copy_only=False).astype(np.int64, copy=False)
+    rows, hits, result = _locate(locator, [str(name) for name in names], codes, positions, multiple, strict)
+
+    annotated = table.take(pa.array(rows)) if multiple == 'explode' else table
+    for column, (kind, values, extra) in _gene_columns(result, hits).items():
+        if kind == 'category':
+            array = pa.DictionaryArray.from_arrays(pa.array(extra, type=pa.int32(), mask=extra < 0), pa.array(values, type=pa.string()))
+        else:
+            array = pa.array(values, mask=extra, type=pa.string() if kind == 'string' else None)
+        annotated = annotated.append_column(prefix + column, array)
+    return annotated
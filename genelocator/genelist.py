@@ -0,0 +1,126 @@
+"""
+A columnar cache of the genes parsed from one GENCODE GTF file, so that datasets can be rebuilt without downloading or
+    parsing the GTF again
+
+The cache holds every gene on the regular chromosomes, with its genetype, so any geneset can be selected from it.
+    Layout (gzip-compressed; integers are little-endian):
+        magic (8 bytes) | format version (uint32) | header length (uint32) | header (utf-8 JSON) | sections...
+
+The header holds the metadata, the chromosome and genetype names, and the (size, type) of each section, in order.
+    Chromosomes and genetypes are stored as int32 ids into those names, starts and ends as int64 arrays, and ensgs and
+    symbols as newline-separated utf-8 text. Reading the columns back is much faster than parsing JSON.
+"""
+
+import array
+import collections
+import gzip
+import json
+import struct
+import sys
+import typing as ty
+
+from . import exception as gene_exc
+from . import fileformat
+
+
+MAGIC = b'GENELST\x00'
+FORMAT_VERSION = 1
+EXTENSION = '.genes.gz'
+
+_PREAMBLE = struct.Struct('<8sII')
+
+
+class GeneList:
+    """Genes as parallel columns, in the order they appeared in the GTF file"""
+    def __init__(self, chrom_names: ty.List[str], chrom_ids: ty.Sequence[int], starts: ty.Sequence[int],
+                 ends: ty.Sequence[int], ensgs: ty.List[str], symbols: ty.List[str], genetype_names: ty.List[str],
+                 genetype_ids: ty.Sequence[int], *, metadata: dict = None):
+        self.chrom_names = chrom_names
+        self.chrom_ids = chrom_ids
+        self.start = starts
+        self.end = ends
+        self.ensg = ensgs
+        self.symbol = symbols
+        self.genetype_names = genetype_names
+        self.genetype_ids = genetype_ids
+        self.metadata = metadata or {}  # eg the build, gencode version and GTF source
+
+    @classmethod
+    def from_genes(cls, genes: ty.Iterable[dict], *, metadata: dict = None) -> 'GeneList':
+        """genes is like [{chrom: "chr1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4", genetype: "lincRNA"},...]"""
+        # Ids are given in order of first appearance (an OrderedDict keeps that order on every Python version)
+        chrom_slots = collections.OrderedDict()  # type: ty.Dict[str, int]
+        genetype_slots = collections.OrderedDict()  # type: ty.Dict[str, int]
+        columns = ([], [], [], [], [], [])  # type: ty.Tuple[list, ...]
+        chrom_ids, starts, ends, ensgs, symbols, genetype_ids = columns
+        for gene in genes:
+            chrom_ids.append(chrom_slots.setdefault(gene['chrom'], len(chrom_slots)))
+            starts.append(gene['start'])
+            ends.append(gene['end'])
+            ensgs.append(gene['ensg'])
+            symbols.append(gene['symbol'])
+            genetype_ids.append(genetype_slots.setdefault(gene['genetype'], len(genetype_slots)))
+        return cls(list(chrom_slots), array.array('i', chrom_ids), array.array('q', starts), array.array('q', ends),
+                   ensgs, symbols, list(genetype_slots), array.array('i', genetype_ids), metadata=metadata)
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def genes(self, genetypes: ty.Container[str] = None) -> ty.Iterator[dict]:
+        """Iterate over genes (without their genetype), optionally keeping only those with one of `genetypes`"""
+        keep = [genetypes is None or name in genetypes for name in self.genetype_names]
+        chrom_names = self.chrom_names
+        for chrom_id, start, end, ensg, symbol, genetype_id in zip(
+                self.chrom_ids, self.start, self.end, self.ensg, self.symbol, self.genetype_ids):
+            if keep[genetype_id]:
+                yield {'chrom': chrom_names[chrom_id], 'start': start, 'end': end, 'ensg': ensg, 'symbol': symbol}
+
+    def _sections(self) -> ty.Iterator[ty.Tuple[str, str, bytes]]:
+        for name, typecode in (('chrom_ids', 'i'), ('start', 'q'), ('end', 'q'), ('genetype_ids', 'i')):
+            yield name, typecode, fileformat._to_little_endian(getattr(self, name), typecode)
+        for name in ('ensg', 'symbol'):
+            yield name, 'B', '\n'.join(getattr(self, name)).encode('utf-8')
+
+    def write(self, out_path) -> None:
+        """Save the gene list (atomically)"""
+        sections = list(self._sections())
+        header = {
+            'metadata': self.metadata,
+            'n_genes': len(self),
+            'chrom_names': self.chrom_names,
+            'genetype_names': self.genetype_names,
+            'sections': [[name, len(data), typecode] for name, typecode, data in sections],
+        }
+        header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+        with fileformat.atomic_output(out_path) as raw, gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6) as f:
+            f.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header_bytes)))
+            f.write(header_bytes)
+            for _, _, data in sections:
+                f.write(data)
+
+
+def read(path) -> GeneList:
+    """Load a gene list that was saved by `GeneList.write`"""
+    with gzip.open(path, 'rb') as f:
+        content = f.read()
+    if content[:len(MAGIC)] != MAGIC:
+        raise gene_exc.UnsupportedDatasetException('Not a gene list file: {}'.format(path))
+    _, version, header_length = _PREAMBLE.unpack_from(content)
+    if version != FORMAT_VERSION:
+        raise gene_exc.UnsupportedDatasetException(
+            'Gene list file has format version {}, but this library only reads version {}'.format(version, FORMAT_VERSION))
+    header = json.loads(content[_PREAMBLE.size:_PREAMBLE.size + header_length].decode('utf-8'))
+
+    columns = {}
+    offset = _PREAMBLE.size + header_length
+    for name, size, typecode in header['sections']:
+        data = content[offset:offset + size]
+        offset += size
+        if typecode == 'B':
+            columns[name] = data.decode('utf-8').split('\n') if header['n_genes'] else []
+        else:
+            columns[name] = array.array(typecode, data)
+            if sys.byteorder != 'little':
+                columns[name].byteswap()
+    return GeneList(header['chrom_names'], columns['chrom_ids'], columns['start'], columns['end'], columns['ensg'],
+                    columns['symbol'], header['genetype_names'], columns['genetype_ids'], metadata=header['metadata'])
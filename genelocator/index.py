@@ -0,0 +1,428 @@
+"""
+Flat, array-backed representation of a gene locator, used to answer many queries at once
+
+A `GeneLocator` answers one position at a time. For bulk work (eg annotating every variant in a GWAS), the per-call
+    Python overhead dominates. This module stores the same data as sorted arrays per chromosome, so that a whole batch
+    of positions can be answered with a few vectorized `searchsorted` calls.
+"""
+
+import array
+import collections
+import itertools
+import time
+import typing as ty
+
+from . import exception as gene_exc
+from . import metrics
+from .contigs import ContigIndex, normalize
+
+if ty.TYPE_CHECKING:
+    import numpy as np  # noqa: F401  # numpy itself is only imported once a batch query needs it
+
+
+class StringTable:
+    """Many strings, stored as one utf-8 blob plus an array of offsets into it"""
+    def __init__(self, data: ty.Union[bytes, memoryview], offsets: ty.Sequence[int]):
+        self.data = data
+        self.offsets = offsets  # len(self) + 1 entries; string i is data[offsets[i]:offsets[i + 1]]
+
+    @classmethod
+    def from_strings(cls, strings: ty.Iterable[str]) -> 'StringTable':
+        encoded = [s.encode('utf-8') for s in strings]
+        return cls(b''.join(encoded), array.array('q', itertools.accumulate(itertools.chain([0], map(len, encoded)))))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> str:
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __iter__(self) -> ty.Iterator[str]:
+        return (self[i] for i in range(len(self)))
+
+
+class GeneTable:
+    """
+    Per-gene columns, indexed by an integer gene id. Every other structure refers to genes by this id.
+    """
+    def __init__(self, chrom_names: ty.List[str], chrom_ids: ty.Sequence[int], starts: ty.Sequence[int],
+                 ends: ty.Sequence[int], ensgs: StringTable, symbols: StringTable):
+        self.chrom_names = chrom_names
+        self.chrom_ids = chrom_ids
+        self.start = starts
+        self.end = ends
+        self.ensg = ensgs
+        self.symbol = symbols
+        self._object_columns = {}  # type: ty.Dict[str, np.ndarray]
+        self._categories = {}  # type: ty.Dict[str, ty.Tuple[ty.List[str], np.ndarray]]
+
+    @classmethod
+    def from_columns(cls, chroms: ty.Sequence[str], starts: ty.Sequence[int], ends: ty.Sequence[int],
+                     ensgs: ty.Sequence[str], symbols: ty.Sequence[str]) -> 'GeneTable':
+        slots = collections.OrderedDict()  # type: ty.Dict[str, int]  # ids follow first appearance, on any Python version
+        chrom_ids = array.array('i', (slots.setdefault(chrom, len(slots)) for chrom in chroms))
+        return cls(list(slots), chrom_ids, array.array('q', starts), array.array('q', ends),
+                   StringTable.from_strings(ensgs), StringTable.from_strings(symbols))
+
+    def __len__(self) -> int:
+        return len(self.start)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_object_columns'] = {}
+        state['_categories'] = {}
+        return state
+
+    def serialize(self, gene_id: int) -> dict:
+        """Return the same representation of a gene that `GeneLocator.at` uses"""
+        return {'chrom': self.chrom_names[self.chrom_ids[gene_id]], 'start': self.start[gene_id],
+                'end': self.end[gene_id], 'ensg': self.ensg[gene_id], 'symbol': self.symbol[gene_id]}
+
+    def column(self, name: str) -> 'np.ndarray':
+        """Get a column as a numpy array, so that it can be indexed by an array of gene ids"""
+        import numpy as np
+        if name in ('start', 'end'):
+            return np.frombuffer(getattr(self, name), dtype=np.int64)
+        if name not in self._object_columns:
+            if name == 'chrom':
+                names = np.array(self.chrom_names, dtype=object)
+                self._object_columns[name] = names[np.frombuffer(self.chrom_ids, dtype=np.int32)]
+            else:
+                self._object_columns[name] = np.array(list(getattr(self, name)), dtype=object)
+        return self._object_columns[name]
+
+    def categories(self, name: str) -> 'ty.Tuple[ty.List[str], np.ndarray]':
+        """Get a string column as (distinct values, index of each gene's value), eg to build a categorical column"""
+        import numpy as np
+        if name == 'chrom':
+            return self.chrom_names, np.frombuffer(self.chrom_ids, dtype=np.int32)
+        categories = self.__dict__.setdefault('_categories', {})  # tables pickled by older versions lack this
+        if name not in categories:
+            slots = collections.OrderedDict()  # type: ty.Dict[str, int]
+            codes = np.fromiter((slots.setdefault(value, len(slots)) for value in getattr(self, name)), dtype=np.int32,
+                                count=len(self))
+            categories[name] = (list(slots), codes)
+        return categories[name]
+
+
+class ChromIndex:
+    """
+    Sorted arrays for the genes on one chromosome
+
+    Overlaps are found from genes sorted by (start, ensg) plus a running maximum of their ends: the genes that can
+        contain `pos` form a contiguous run of that order, bounded on the left by the running maximum and on the right
+        by the starts.
+    Nearest genes are found from starts and ends sorted in the same (stable) order that `BisectFinder` uses, so that
+        ties resolve to the same gene as `GeneLocator.at`.
+    """
+    ARRAYS = ('overlap_ids', 'overlap_starts', 'overlap_ends', 'max_ends', 'start_ids', 'starts', 'end_ids', 'ends')
+
+    def __init__(self, overlap_ids: ty.Sequence[int], overlap_starts: ty.Sequence[int], overlap_ends: ty.Sequence[int],
+                 max_ends: ty.Sequence[int], start_ids: ty.Sequence[int], starts: ty.Sequence[int],
+                 end_ids: ty.Sequence[int], ends: ty.Sequence[int]):
+        """Gene ids are int32 and positions are int64; any buffer of those types works (eg `array.array` or `memoryview`)"""
+        self.overlap_ids = overlap_ids
+        self.overlap_starts = overlap_starts
+        self.overlap_ends = overlap_ends
+        self.max_ends = max_ends
+        self.start_ids = start_ids
+        self.starts = starts
+        self.end_ids = end_ids
+        self.ends = ends
+        self._np = None  # type: ty.Optional[ty.Dict[str, np.ndarray]]
+
+    @classmethod
+    def from_ids(cls, overlap_ids: ty.Sequence[int], start_ids: ty.Sequence[int], end_ids: ty.Sequence[int],
+                 table: GeneTable) -> 'ChromIndex':
+        """Given gene ids in (start, ensg) order, in start order and in end order, look up the positions"""
+        overlap_ends = array.array('q', (table.end[g] for g in overlap_ids))
+        return cls(array.array('i', overlap_ids),
+                   array.array('q', (table.start[g] for g in overlap_ids)),
+                   overlap_ends,
+                   array.array('q', itertools.accumulate(overlap_ends, max)),
+                   array.array('i', start_ids),
+                   array.array('q', (table.start[g] for g in start_ids)),
+                   array.array('i', end_ids),
+                   array.array('q', (table.end[g] for g in end_ids)))
+
+    def __len__(self) -> int:
+        return len(self.overlap_ids)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_np'] = None
+        return state
+
+    def as_numpy(self) -> 'ty.Dict[str, np.ndarray]':
+        """Zero-copy numpy views of every array, for vectorized queries"""
+        import numpy as np
+        if self._np is None:
+            self._np = {name: np.frombuffer(getattr(self, name), dtype=np.int32 if name.endswith('_ids') else np.int64)
+                        for name in self.ARRAYS}
+        return self._np
+
+
+class BatchResult:
+    """
+    Columnar results for a batch of queries
+
+    The genes found for query `i` are `gene_ids[offsets[i]:offsets[i + 1]]`. Overlapping genes are listed in order of
+        start position and have distance 0; otherwise the single nearest gene is listed, with its distance in bp.
+    """
+    def __init__(self, offsets: 'np.ndarray', gene_ids: 'np.ndarray', distances: 'np.ndarray', overlap: 'np.ndarray',
+                 table: GeneTable):
+        self.offsets = offsets
+        self.gene_ids = gene_ids
+        self.distances = distances
+        self.overlap = overlap  # whether each gene contains the position (a nearby gene can also be 0bp away)
+        self._table = table
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> ty.List[dict]:
+        return [self._table.serialize(g) for g in self.gene_ids[self.offsets[i]:self.offsets[i + 1]].tolist()]
+
+    @property
+    def counts(self) -> 'np.ndarray':
+        """The number of genes found for each query"""
+        import numpy as np
+        return np.diff(self.offsets)
+
+    @property
+    def query_index(self) -> 'np.ndarray':
+        """For each gene found, the index of the query that it answers"""
+        import numpy as np
+        return np.repeat(np.arange(len(self), dtype=np.int64), self.counts)
+
+    @property
+    def chrom(self) -> 'np.ndarray':
+        return self._table.column('chrom')[self.gene_ids]
+
+    @property
+    def start(self) -> 'np.ndarray':
+        return self._table.column('start')[self.gene_ids]
+
+    @property
+    def end(self) -> 'np.ndarray':
+        return self._table.column('end')[self.gene_ids]
+
+    @property
+    def ensg(self) -> 'np.ndarray':
+        return self._table.column('ensg')[self.gene_ids]
+
+    @property
+    def symbol(self) -> 'np.ndarray':
+        return self._table.column('symbol')[self.gene_ids]
+
+    def to_lists(self) -> ty.List[ty.List[dict]]:
+        """The same answers as calling `GeneLocator.at` once per query"""
+        return [self[i] for i in range(len(self))]
+
+
+class ArrayIndex:
+    """A gene table, plus sorted arrays for each chromosome, and the names that each chromosome can be called by"""
+    def __init__(self, table: GeneTable, chroms: ty.Dict[str, ChromIndex], contigs: ContigIndex = None):
+        self.table = table
+        self.chroms = chroms
+        self.contigs = contigs if contigs is not None else ContigIndex(chroms)
+
+    @classmethod
+    def from_genes(cls, genes: ty.Iterable[dict]) -> 'ArrayIndex':
+        """genes is like [{chrom: "1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4"},...]"""
+        chroms, starts, ends, ensgs, symbols = [], [], [], [], []  # type: ty.Tuple[list, list, list, list, list]
+        seen = set()  # type: ty.Set[str]
+        for gene in genes:
+            if not isinstance(gene['start'], int) or not isinstance(gene['end'], int):
+                raise gene_exc.LookupCreateError(
+                    "start and end must be int, unlike {!r} and {!r}".format(gene['start'], gene['end']))
+            if gene['ensg'] in seen:
+                raise gene_exc.LookupCreateError("The gene {!r} appears multiple times in this genes list".format(gene['ensg']))
+            seen.add(gene['ensg'])
+            chroms.append(normalize(gene['chrom']))
+            starts.append(gene['start'])
+            ends.append(gene['end'])
+            ensgs.append(gene['ensg'])
+            symbols.append(gene['symbol'])
+
+        ids_by_chrom = {}  # type: ty.Dict[str, ty.List[int]]
+        for gene_id, chrom in enumerate(chroms):
+            ids_by_chrom.setdefault(chrom, []).append(gene_id)
+        # Python's sort is stable, so genes with the same start (or end) stay in input order, as in `BisectFinder`
+        return cls._build(GeneTable.from_columns(chroms, starts, ends, ensgs, symbols), ensgs,
+                          {chrom: (sorted(ids, key=starts.__getitem__), sorted(ids, key=ends.__getitem__))
+                           for chrom, ids in ids_by_chrom.items()})
+
+    @classmethod
+    def from_locator(cls, locator) -> 'ArrayIndex':
+        """Build from an existing `GeneLocator`, reusing its `BisectFinder` order so that ties resolve identically"""
+        gene_ids = {ensg: gene_id for gene_id, ensg in enumerate(locator._gene_info)}
+        ensgs = list(locator._gene_info)
+        table = GeneTable.from_columns(*zip(*((chrom, start, end, ensg, symbol)
+                                              for ensg, (chrom, start, end, symbol) in locator._gene_info.items())))
+        index = cls._build(table, ensgs,
+                           {chrom: ([gene_ids[ensg] for ensg in locator._gene_starts[chrom]._values],
+                                    [gene_ids[ensg] for ensg in locator._gene_ends[chrom]._values])
+                            for chrom in locator._its})
+        index.contigs = locator._contig_index()  # the same chromosomes, in the same order
+        return index
+
+    @classmethod
+    def _build(cls, table: GeneTable, ensgs: ty.Sequence[str],
+               nearest_order: ty.Dict[str, ty.Tuple[ty.List[int], ty.List[int]]]) -> 'ArrayIndex':
+        """Given the (start-sorted, end-sorted) gene ids for each chromosome, build the per-chromosome arrays"""
+        return cls(table, {chrom: ChromIndex.from_ids(sorted(start_ids, key=lambda g: (table.start[g], ensgs[g])),
+                                                      start_ids, end_ids, table)
+                           for chrom, (start_ids, end_ids) in nearest_order.items()})
+
+    def _group_queries(self, chroms: ty.Union[str, ty.Sequence[str]], n: int, strict: bool,
+                       chrom_codes: ty.Sequence[int] = None) -> 'ty.Tuple[ty.List[ty.Optional[str]], np.ndarray]':
+        """Resolve each distinct chromosome name once, and return (slot names, slot number for each query)"""
+        import numpy as np
+        resolve = self.contigs.resolve
+        if chrom_codes is not None:
+            # The caller has already grouped the queries (eg a categorical column); negative codes are missing values
+            names = [resolve(c) for c in chroms] + [None]
+            codes = np.asarray(chrom_codes, dtype=np.int64)
+            codes = np.where(codes < 0, len(chroms), codes)
+            if strict and np.any(codes == len(chroms)):
+                raise gene_exc.BadCoordinateException('Missing chromosome')
+        elif isinstance(chroms, str):
+            names = [resolve(chroms)]  # type: ty.List[ty.Optional[str]]
+            codes = np.zeros(n, dtype=np.int64)
+        else:
+            slots = collections.OrderedDict()  # type: ty.Dict[str, int]
+            codes = np.fromiter((slots.setdefault(c, len(slots)) for c in chroms), dtype=np.int64, count=n)
+            names = [resolve(c) for c in slots]
+        for slot, name in enumerate(names):
+            if name is not None and name not in self.chroms:
+                if strict:
+                    raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(name))
+                names[slot] = None
+        return names, codes
+
+    def at_many(self, chroms: ty.Union[str, ty.Sequence[str], None], positions: ty.Sequence[int], *,
+                strict: bool = True, chrom_codes: ty.Sequence[int] = None, contig_ids: ty.Sequence[int] = None) -> BatchResult:
+        """
+        Locate genes for many positions at once, following the same rules as `GeneLocator.at`.
+
+        `chroms` is either one chromosome name for all positions, or one name per position. With `strict=False`,
+            positions on unknown chromosomes get no results instead of raising an error.
+
+        Alternatively, `chroms` can be a list of distinct names, with `chrom_codes` giving the index into it for each
+            position (negative for a missing chromosome), like the codes of a categorical column. That saves reading a
+            name for every position. Or `chroms` can be None, with the `contig_ids` from `contigs.ids` (-1 for a
+            chromosome that this dataset doesn't have).
+        """
+        if contig_ids is not None:
+            chroms, chrom_codes = self.contigs.chroms, contig_ids
+        return self._run_batch(chroms, [positions], self._chrom_at_many, strict, chrom_codes)
+
+    def overlapping_many(self, chroms: ty.Union[str, ty.Sequence[str]], starts: ty.Sequence[int], ends: ty.Sequence[int], *,
+                         strict: bool = True) -> BatchResult:
+        """Find all genes that overlap each window `[start, end]` (inclusive), in order of start position"""
+        return self._run_batch(chroms, [starts, ends], self._chrom_overlapping_many, strict)
+
+    def _run_batch(self, chroms: ty.Union[str, ty.Sequence[str]], columns: ty.List[ty.Sequence[int]],
+                   answer: ty.Callable, strict: bool, chrom_codes: ty.Sequence[int] = None) -> BatchResult:
+        """Split queries up by chromosome, `answer` each group, and gather the hits back into query order"""
+        import numpy as np
+        recorder = metrics.active
+        started = time.perf_counter() if recorder is not None else 0.0
+        columns = [np.asarray(column, dtype=np.int64) for column in columns]
+        if any(column.ndim != 1 for column in columns):
+            raise ValueError('positions must be one-dimensional')
+        n = len(columns[0])
+        n_chroms = len(chrom_codes) if chrom_codes is not None else None if isinstance(chroms, str) else len(chroms)
+        if any(len(column) != n for column in columns) or n_chroms not in (None, n):
+            raise ValueError('Expected the same number of chromosomes and positions')
+        names, codes = self._group_queries(chroms, n, strict, chrom_codes)
+
+        counts = np.zeros(n, dtype=np.int64)
+        found = []  # (query index, rank within the query, gene id, distance, overlap) of each hit, per chromosome
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(names) + 1))
+        for slot, name in enumerate(names):
+            if name is None:
+                continue
+            queries = order[bounds[slot]:bounds[slot + 1]]
+            if len(queries):
+                found.append(answer(self.chroms[name].as_numpy(), queries, *(column[queries] for column in columns),
+                                    counts=counts))
+
+        offsets = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        gene_ids = np.empty(offsets[-1], dtype=np.int32)
+        distances = np.empty(offsets[-1], dtype=np.int64)
+        overlap = np.empty(offsets[-1], dtype=bool)
+        for query, rank, ids, dists, is_overlap in found:
+            dest = offsets[query] + rank
+            gene_ids[dest] = ids
+            distances[dest] = dists
+            overlap[dest] = is_overlap
+        if recorder is not None:
+            recorder.record_batch(n, time.perf_counter() - started)
+        return BatchResult(offsets, gene_ids, distances, overlap, self.table)
+
+    @staticmethod
+    def _overlaps(arrays: 'ty.Dict[str, np.ndarray]', first: 'np.ndarray',
+                  last: 'np.ndarray') -> 'ty.Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]':
+        """
+        Find the genes that overlap each window [first, last]. Returns (query of each hit, gene id of each hit, number
+            of hits per query, rank of each hit within its query).
+        """
+        import numpy as np
+        # Candidates are genes that start at or before `last`, after the last gene that no earlier gene outlives
+        lo = np.searchsorted(arrays['max_ends'], first, side='right')
+        hi = np.searchsorted(arrays['overlap_starts'], last, side='right')
+        n_candidates = np.maximum(hi - lo, 0)
+        candidate_query = np.repeat(np.arange(len(first)), n_candidates)
+        candidate_first = np.cumsum(n_candidates) - n_candidates
+        candidates = np.arange(len(candidate_query)) - np.repeat(candidate_first - lo, n_candidates)
+        is_hit = arrays['overlap_ends'][candidates] > first[candidate_query]
+        hit_query = candidate_query[is_hit]
+        hit_ids = arrays['overlap_ids'][candidates[is_hit]]
+        n_hits = np.bincount(hit_query, minlength=len(first))
+        hit_rank = np.arange(len(hit_query)) - np.repeat(np.cumsum(n_hits) - n_hits, n_hits)
+        return hit_query, hit_ids, n_hits, hit_rank
+
+    @classmethod
+    def _chrom_overlapping_many(cls, arrays: 'ty.Dict[str, np.ndarray]', queries: 'np.ndarray', first: 'np.ndarray',
+                                last: 'np.ndarray', *, counts: 'np.ndarray') -> 'ty.Tuple[np.ndarray, ...]':
+        import numpy as np
+        if np.any(first > last):
+            raise gene_exc.BadCoordinateException('Window starts must not be after their ends')
+        hit_query, hit_ids, n_hits, hit_rank = cls._overlaps(arrays, first, last)
+        counts[queries] = n_hits
+        return queries[hit_query], hit_rank, hit_ids, np.zeros(len(hit_ids), dtype=np.int64), np.ones(len(hit_ids), dtype=bool)
+
+    @classmethod
+    def _chrom_at_many(cls, arrays: 'ty.Dict[str, np.ndarray]', queries: 'np.ndarray', pos: 'np.ndarray', *,
+                       counts: 'np.ndarray') -> 'ty.Tuple[np.ndarray, ...]':
+        """Answer all queries for one chromosome; fills in `counts` and returns the hits"""
+        import numpy as np
+        hit_query, hit_ids, n_hits, hit_rank = cls._overlaps(arrays, pos, pos)
+
+        # Nearest: for positions without overlaps, compare the previous gene end and the next gene start
+        missing = np.flatnonzero(n_hits == 0)
+        mpos = pos[missing]
+        starts, ends = arrays['starts'], arrays['ends']
+        prev_idx = np.searchsorted(ends, mpos, side='right') - 1
+        next_idx = np.searchsorted(starts, mpos, side='left')
+        has_prev = prev_idx >= 0
+        has_next = next_idx < len(starts)
+        dist_prev = np.where(has_prev, mpos - ends[np.maximum(prev_idx, 0)], 0)
+        dist_next = np.where(has_next, starts[np.minimum(next_idx, len(starts) - 1)] - mpos, 0)
+        use_prev = has_prev & (~has_next | (dist_prev < dist_next))
+        near_ids = np.where(use_prev,
+                            arrays['end_ids'][np.maximum(prev_idx, 0)],
+                            arrays['start_ids'][np.minimum(next_idx, len(starts) - 1)])
+        near_dists = np.where(use_prev, dist_prev, dist_next)
+        n_hits[missing] = 1
+
+        counts[queries] = n_hits
+        return (np.concatenate([queries[hit_query], queries[missing]]),
+                np.concatenate([hit_rank, np.zeros(len(missing), dtype=hit_rank.dtype)]),
+                np.concatenate([hit_ids, near_ids]),
+                np.concatenate([np.zeros(len(hit_ids), dtype=np.int64), near_dists]),
+                np.arange(len(hit_ids) + len(missing)) < len(hit_ids))
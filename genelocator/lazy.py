@@ -0,0 +1,118 @@
+"""
+A tree-based gene locator that only builds the chromosomes that are queried
+
+`LazyGeneLocator` reads from a memory-mapped binary dataset file (see `fileformat`), where every chromosome has its own
+    sections. Opening it decodes nothing; the interval tree and sorted lists for a chromosome are built the first time
+    that chromosome is queried, so a job that looks at one locus only pays for one chromosome.
+"""
+
+import threading
+import typing as ty
+
+import intervaltree  # type: ignore
+
+from . import records
+from .compact import CompactGeneLocator
+from .contigs import ContigIndex
+from .index import ArrayIndex
+from .locate import BisectFinder, GeneLocator
+
+
+class LazyGeneLocator(GeneLocator):
+    """
+    Gives the same answers as `GeneLocator`. Chromosomes are loaded on first use, and it is safe to query from several
+        threads at once (each chromosome is only built once).
+    """
+    def __init__(self, source: CompactGeneLocator):
+        # Unlike `GeneLocator.__init__`, this doesn't build anything yet
+        self._source = source
+        self.metadata = source.metadata
+        self._lock = threading.Lock()
+        self._gene_info = {}  # type: ty.Dict[str, ty.Tuple[str, int, int, str]]
+        self._its = {}  # type: ty.Dict[str, intervaltree.IntervalTree]  # only the chromosomes that have been loaded
+        self._gene_starts = {}  # type: ty.Dict[str, BisectFinder]
+        self._gene_ends = {}  # type: ty.Dict[str, BisectFinder]
+
+    @property
+    def loaded_chroms(self) -> ty.List[str]:
+        """The chromosomes that have been decoded so far"""
+        return sorted(self._its)
+
+    def _load_chrom(self, chrom: str) -> None:
+        """Build the indexes for a (normalized) chromosome, unless it is already loaded or has no data"""
+        if chrom in self._its:
+            return
+        arrays = self._source._index.chroms.get(chrom)
+        if arrays is None:
+            return
+        with self._lock:
+            if chrom in self._its:
+                return  # another thread got here first
+            table = self._source._index.table
+            intervals = []
+            for gene_id in arrays.start_ids:
+                start, end, ensg = table.start[gene_id], table.end[gene_id], table.ensg[gene_id]
+                self._gene_info[ensg] = (chrom, start, end, table.symbol[gene_id])
+                intervals.append(intervaltree.Interval(start, end, ensg))
+            tree = intervaltree.IntervalTree(intervals)  # building a tree in one go is about twice as fast as adding each gene
+            self._gene_starts[chrom] = BisectFinder(zip(arrays.starts, (table.ensg[i] for i in arrays.start_ids)))
+            self._gene_ends[chrom] = BisectFinder(zip(arrays.ends, (table.ensg[i] for i in arrays.end_ids)))
+            # Publish the tree last: readers that find it can rely on everything else being in place
+            self._its[chrom] = tree
+
+    def load_all(self) -> None:
+        """Decode every chromosome now"""
+        for chrom in self._source._index.chroms:
+            self._load_chrom(chrom)
+
+    def _at_keys(self, chrom: str, pos: int, strict: bool) -> ty.Tuple[ty.List[str], str]:
+        chrom = self._chrom_key(chrom)
+        self._load_chrom(chrom)
+        return super()._at_keys(chrom, pos, strict)
+
+    def overlapping(self, chrom: str, start: int, end: int, *, strict=True, result: str = 'dict') -> list:
+        chrom = self._chrom_key(chrom)
+        self._load_chrom(chrom)
+        return super().overlapping(chrom, start, end, strict=strict, result=result)
+
+    def gene(self, ensg: str) -> records.Gene:
+        if ensg not in self._gene_info:
+            # Keys returned by lookups are always loaded; anything else could be on any chromosome
+            self.load_all()
+        return super().gene(ensg)
+
+    def _gene_records(self) -> ty.Dict[str, records.Gene]:
+        # Records are added as chromosomes are loaded, rather than built once for every gene
+        genes = self.__dict__.setdefault('_genes', {})
+        if len(genes) != len(self._gene_info):
+            with self._lock:
+                for ensg, (chrom, start, end, symbol) in self._gene_info.items():
+                    if ensg not in genes:
+                        genes[ensg] = records.Gene(chrom, start, end, ensg, symbol)
+        return genes
+
+    def _name_index(self):
+        # Names could be on any chromosome
+        self.load_all()
+        return super()._name_index()
+
+    def _array_index(self) -> ArrayIndex:
+        # Batch queries read the memory-mapped arrays directly
+        return self._source._index
+
+    def _contig_index(self) -> ContigIndex:
+        # Every chromosome in the file, including those that haven't been loaded yet
+        return self._source._index.contigs
+
+    def _sorted_boundaries(self, chrom: str):
+        self._load_chrom(chrom)
+        return super()._sorted_boundaries(chrom)
+
+    def __reduce__(self):
+        # Pickle as an ordinary (fully loaded) `GeneLocator`, since the memory map can't be pickled
+        return _tree_locator, (list(self._source.genes()), self._contig_index().build)
+
+
+def _tree_locator(genes: ty.List[dict], build: ty.Optional[int]) -> GeneLocator:
+    """Unpickle a `LazyGeneLocator`, keeping its build (so that RefSeq accessions still resolve)"""
+    return GeneLocator(genes, build=build)
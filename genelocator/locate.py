@@ -1,35 +1,35 @@
 """Helpers for nearest gene location"""
 
 import bisect
-import re
 import typing as ty
 
 import intervaltree  # type: ignore
 
 from . import exception as gene_exc
+from . import metrics
+from . import records
+from . import search
+from .contigs import ContigIndex, normalize
 
-
-CHROM_PREFIX = re.compile('^chr')
-
-
-def _chrom_helper(value: str) -> str:
-    """
-    A lot of people add a prefix when referring to chromosomes; standardize chr1 and 1 to the latter.
-    This makes it easier to run queries
-    """
-    return CHROM_PREFIX.sub('', value)
+if ty.TYPE_CHECKING:
+    import numpy as np  # noqa: F401
 
 
 class GeneLocator:
-    def __init__(self, genes: ty.Iterable[dict]):
-        """genes is like [{chrom: "1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4"},...]"""
+    def __init__(self, genes: ty.Iterable[dict], *, build: ty.Union[str, int] = None):
+        """
+        genes is like [{chrom: "1", start: 123, end: 234, ensg: "ENSG00345", symbol: "ACG4"},...]
+
+        `build` (eg `GRCh38`) is the genome build of the genes; chromosomes can be named by the RefSeq accessions of that
+            build (see `contigs`).
+        """
         self._gene_info = {}  # type: ty.Dict[str, ty.Tuple[str, int, int, str]]
         self._its = {}  # type: ty.Dict[str, intervaltree.IntervalTree]  # an interval tree for each chromosome
         gene_starts = {}  # type: ty.Dict[str, ty.List[ty.Tuple[int, str]]]  # a searchable list of (start, ensg) pairs, per chromosome
         gene_ends = {}  # type: ty.Dict[str, ty.List[ty.Tuple[int, str]]]  # a list of (end, ensg) pairs for each chromosome
 
         for gene in genes:
-            chrom = _chrom_helper(gene['chrom'])
+            chrom = normalize(gene['chrom'])
             start = gene['start']
             end = gene['end']
             ensg = gene['ensg']
@@ -47,24 +47,34 @@ class GeneLocator:
 
         self._gene_starts = {chrom: BisectFinder(gene_starts[chrom]) for chrom in self._its}
         self._gene_ends = {chrom: BisectFinder(gene_ends[chrom]) for chrom in self._its}
+        self._contigs = ContigIndex(self._its, build=build)  # every spelling of each chromosome's name (saved with the locator)
 
-    def at(self, chrom: str, pos: int, *, strict=True) -> ty.List[dict]:
-        """Locate a gene from position coordinates"""
+    def at(self, chrom: str, pos: int, *, strict=True, result: str = 'dict') -> list:
+        """
+        Locate a gene from position coordinates
 
-        chrom = _chrom_helper(chrom)
+        By default, each gene is a new dict. For faster lookups in a loop, `result='gene'` returns shared, immutable
+            `records.Gene` objects instead, and `result='id'` returns gene keys (ENSG ids), which `gene()` looks up.
+        """
+        recorder = metrics.active
+        if recorder is None:
+            return records.convert(self, self._at_keys(chrom, pos, strict)[0], result)
+        return records.convert(self, recorder.observe_at(self._at_keys, chrom, pos, strict), result)
 
-        if chrom == 'MT':
-            # FIXME: Should we be coercing chromosome names in a generic reusable class?
-            chrom = 'M'
+    def _at_keys(self, chrom: str, pos: int, strict: bool) -> ty.Tuple[ty.List[str], str]:
+        """Find the keys of the genes for a position, and which rule found them (see `metrics.OUTCOMES`)"""
+        chrom = self._chrom_key(chrom)
 
         if chrom not in self._its:
             if strict:
                 raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            return [], 'unknown_chromosome'
 
         # If any genes overlap this position, return them all.
         overlapping_genes = self._its[chrom].at(pos)
         if overlapping_genes:
-            return sorted((self._serialize(g.data) for g in overlapping_genes), key=(lambda g: g['start']))
+            # Genes with the same start are ordered by ENSG so that the answer doesn't depend on set iteration order
+            return self._sorted_by_start(g.data for g in overlapping_genes), 'overlap'
 
         # If only one direction has genes (either before or after this position), return the gene in that direction.
         prev_gene_end = self._gene_ends[chrom].get_item_before_or_at(pos)
@@ -74,17 +84,142 @@ class GeneLocator:
             dist_to_prev_gene_end = abs(prev_gene_end[0] - pos)
             dist_to_next_gene_start = abs(next_gene_start[0] - pos)
             if dist_to_prev_gene_end < dist_to_next_gene_start:
-                return [self._serialize(prev_gene_end[1])]
+                return [prev_gene_end[1]], 'nearest'
             else:
-                return [self._serialize(next_gene_start[1])]
+                return [next_gene_start[1]], 'nearest'
         elif prev_gene_end is not None:
-            return [self._serialize(prev_gene_end[1])]
+            return [prev_gene_end[1]], 'nearest'
         elif next_gene_start is not None:
-            return [self._serialize(next_gene_start[1])]
+            return [next_gene_start[1]], 'nearest'
         else:
             raise gene_exc.NoResultsFoundException(
                 'The position chr{!r}:{!r} has no genes before it or after it'.format(chrom, pos))
 
+    def overlapping(self, chrom: str, start: int, end: int, *, strict=True, result: str = 'dict') -> list:
+        """
+        Find all genes that overlap the window `[start, end]` (inclusive), in order of start position.
+        `overlapping(chrom, pos, pos)` gives the overlapping genes that `at(chrom, pos)` would. See `at` for `result`.
+        """
+        chrom = self._chrom_key(chrom)
+        if start > end:
+            raise gene_exc.BadCoordinateException('Window start {!r} is after its end {!r}'.format(start, end))
+        if chrom not in self._its:
+            if strict:
+                raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            return []
+        return records.convert(self, self._sorted_by_start(g.data for g in self._its[chrom].overlap(start, end + 1)), result)
+
+    def nearest(self, chrom: str, pos: int, k: ty.Optional[int] = 1, *, max_distance: int = None, strict=True) -> ty.List[dict]:
+        """
+        Find the `k` genes nearest to a position, closest first, each with a `distance` (0 for genes that overlap it).
+            With `max_distance`, only genes at most that far away are returned (and `k=None` returns all of them).
+
+        Overlapping genes come first (in order of start position); otherwise distance is measured to the nearer end of
+            the gene, and ties go to the gene after the position, as in `at`.
+        """
+        from . import neighbors
+        return neighbors.nearest(self, chrom, pos, k, max_distance=max_distance, strict=strict)
+
+    def overlapping_many(self, chroms: ty.Union[str, ty.Sequence[str]], starts: ty.Sequence[int], ends: ty.Sequence[int], *,
+                         strict=True):
+        """Find genes overlapping many windows at once (see `overlapping`). Returns a columnar `BatchResult`."""
+        return self._array_index().overlapping_many(chroms, starts, ends, strict=strict)
+
+    def nearest_many(self, chroms: ty.Union[str, ty.Sequence[str]], positions: ty.Sequence[int], k: ty.Optional[int] = 1, *,
+                     max_distance: int = None, strict=True) -> ty.List[ty.List[dict]]:
+        """Find the nearest genes for many positions (see `nearest`)"""
+        from . import neighbors
+        return neighbors.nearest_many(self, chroms, positions, k, max_distance=max_distance, strict=strict)
+
+    def at_many(self, chroms: ty.Union[str, ty.Sequence[str], None], positions: ty.Sequence[int], *, strict=True,
+                contig_ids: ty.Sequence[int] = None):
+        """
+        Locate genes for many positions at once, following the same rules as `at`. Returns a columnar `BatchResult`.
+
+        The first call builds a flat array copy of the locator, which is then reused by later calls. Chromosome names
+            can be resolved ahead of time with `contig_ids`, and passed as `at_many(None, positions, contig_ids=ids)`.
+        """
+        return self._array_index().at_many(chroms, positions, strict=strict, contig_ids=contig_ids)
+
+    def contig_ids(self, chroms: ty.Iterable[str]) -> 'np.ndarray':
+        """The contig id of each chromosome name (-1 for chromosomes without data), for `at_many`"""
+        return self._array_index().contigs.ids(chroms)
+
+    def lookup(self, name: str, *, case_sensitive=False, result: str = 'dict') -> list:
+        """
+        Find genes by symbol or ENSG id (with or without its version, eg "TCF7L2", "ENSG00000148737"), ignoring case
+            unless `case_sensitive`. Several genes can share a symbol, so this returns a list. See `at` for `result`.
+        """
+        return search.lookup(self, name, case_sensitive=case_sensitive, result=result)
+
+    def lookup_many(self, names: ty.Iterable[str], *, case_sensitive=False, result: str = 'dict') -> ty.List[list]:
+        """Look up a list of gene names (see `lookup`)"""
+        return search.lookup_many(self, names, case_sensitive=case_sensitive, result=result)
+
+    def autocomplete(self, prefix: str, *, limit: ty.Optional[int] = 10, result: str = 'dict') -> list:
+        """Find up to `limit` genes with a symbol or ENSG id that starts with `prefix` (ignoring case), in order of name"""
+        return search.autocomplete(self, prefix, limit=limit, result=result)
+
+    def gene(self, ensg: str) -> records.Gene:
+        """Get the record for a gene key (as returned by `at(..., result='id')`)"""
+        return self._gene_records()[ensg]
+
+    def _gene_records(self) -> ty.Dict[str, records.Gene]:
+        # Built on demand (and not pickled), like `_array_index`
+        genes = self.__dict__.get('_genes')
+        if genes is None:
+            genes = self._genes = {ensg: records.Gene(chrom, start, end, ensg, symbol)
+                                   for ensg, (chrom, start, end, symbol) in self._gene_info.items()}
+        return genes
+
+    def _name_index(self) -> search.NameIndex:
+        # Built on demand (and not pickled), like `_array_index`
+        names = self.__dict__.get('_search')
+        if names is None:
+            names = self._search = search.NameIndex.from_locator(self)
+        return names
+
+    def _sorted_by_start(self, ensgs: ty.Iterable[str]) -> ty.List[str]:
+        gene_info = self._gene_info
+        return sorted(ensgs, key=lambda ensg: (gene_info[ensg][1], ensg))
+
+    def _array_index(self):
+        # Built on demand (and not pickled), so that locators pickled by older versions still support batch queries
+        index = self.__dict__.get('_index')
+        if index is None:
+            from .index import ArrayIndex  # numpy is only needed for batch queries
+            index = self._index = ArrayIndex.from_locator(self)
+        return index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        state.pop('_genes', None)
+        state.pop('_search', None)
+        return state
+
+    def _contig_index(self) -> ContigIndex:
+        # Locators that were pickled before this was saved with them build it on demand (see `_set_build`)
+        contigs = self.__dict__.get('_contigs')
+        if contigs is None:
+            contigs = self._contigs = ContigIndex(self._its)
+        return contigs
+
+    def _set_build(self, build: ty.Union[str, int]) -> None:
+        """Record the genome build of the genes, eg for a locator that was pickled without it"""
+        self._contigs = ContigIndex(self._its, build=build)
+
+    def _chrom_key(self, chrom: str) -> str:
+        """The name that this dataset uses for a chromosome (eg `19` for `chr19` or `NC_000019.10`)"""
+        return self._contig_index().resolve(chrom)
+
+    def _sorted_boundaries(self, chrom: str) -> ty.Optional[ty.Tuple[ty.Sequence[int], ty.Sequence[str], ty.Sequence[int], ty.Sequence[str]]]:
+        """For a normalized chromosome name, get (sorted starts, their genes, sorted ends, their genes), or None"""
+        if chrom not in self._its:
+            return None
+        starts, ends = self._gene_starts[chrom], self._gene_ends[chrom]
+        return starts._nums, starts._values, ends._nums, ends._values
+
     def _serialize(self, ensg: str) -> dict:
         """Return a serialized representation of the gene data"""
         info = self._gene_info[ensg]
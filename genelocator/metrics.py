@@ -0,0 +1,145 @@
+"""
+Opt-in runtime metrics for lookups and dataset loads, exportable in the Prometheus text format
+
+Metrics are off by default, and then cost one attribute check per lookup. To turn them on:
+
+    from genelocator import metrics
+    recorder = metrics.enable()
+    ...
+    print(recorder.to_prometheus())  # or serve it (the HTTP service in `server` has a /metrics endpoint)
+
+Every locator then records, for each `at` call, its chromosome and outcome (`overlap` if genes contain the position,
+    `nearest` if the closest gene was returned instead, `unknown_chromosome` for a non-strict lookup on a chromosome
+    without data, or `error`) and its latency. Batch lookups and dataset loads (duration and bytes read) are recorded
+    too. A callback can also be registered to receive every event, eg to forward them to another metrics library.
+"""
+
+import bisect
+import collections
+import threading
+import time
+import typing as ty
+
+from . import contigs
+from . import exception as gene_exc
+
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2)
+OUTCOMES = ('overlap', 'nearest', 'unknown_chromosome', 'error')
+
+
+def _chrom_label(chrom: str) -> str:
+    # Every spelling of a chromosome gets the same label, so the number of labels stays small
+    return contigs.canonical(chrom)
+
+
+class Metrics:
+    """Counters for lookups and loads. All methods can be called from several threads at once."""
+    def __init__(self, callback: ty.Callable[[str, dict, float], None] = None):
+        """`callback(event, labels, value)` (if given) is called for every query, batch and load that is recorded"""
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.queries = collections.Counter()  # type: ty.Counter[ty.Tuple[str, str]]  # by (chromosome, outcome)
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # the last bucket is +Inf
+        self.latency_sum = 0.0
+        self.batches = 0
+        self.batch_queries = 0
+        self.batch_seconds = 0.0
+        self.loads = collections.Counter()  # type: ty.Counter[str]  # by engine
+        self.load_seconds = 0.0
+        self.load_bytes = 0
+
+    def observe_at(self, find: ty.Callable[[str, int, bool], ty.Tuple[list, str]], chrom: str, pos: int,
+                   strict: bool) -> list:
+        """Run `find(chrom, pos, strict)` (which returns (genes, outcome)), recording its outcome and latency"""
+        started = time.perf_counter()
+        try:
+            genes, outcome = find(chrom, pos, strict)
+        except gene_exc.BaseGeneLocatorException:
+            self.record_query(chrom, 'error', time.perf_counter() - started)
+            raise
+        self.record_query(chrom, outcome, time.perf_counter() - started)
+        return genes
+
+    def record_query(self, chrom: str, outcome: str, seconds: float) -> None:
+        # Only label real chromosomes, so that bad input can't create an unbounded number of series
+        label = _chrom_label(chrom) if outcome in ('overlap', 'nearest') else 'other'
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self._lock:
+            self.queries[(label, outcome)] += 1
+            self.latency_buckets[bucket] += 1
+            self.latency_sum += seconds
+        if self.callback is not None:
+            self.callback('query', {'chrom': label, 'outcome': outcome}, seconds)
+
+    def record_batch(self, n_queries: int, seconds: float) -> None:
+        with self._lock:
+            self.batches += 1
+            self.batch_queries += n_queries
+            self.batch_seconds += seconds
+        if self.callback is not None:
+            self.callback('batch', {'queries': n_queries}, seconds)
+
+    def record_load(self, engine: str, n_bytes: int, seconds: float) -> None:
+        with self._lock:
+            self.loads[engine] += 1
+            self.load_bytes += n_bytes
+            self.load_seconds += seconds
+        if self.callback is not None:
+            self.callback('load', {'engine': engine, 'bytes': n_bytes}, seconds)
+
+    def to_prometheus(self, prefix: str = 'genelocator') -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        with self._lock:
+            queries = sorted(self.queries.items())
+            buckets = list(self.latency_buckets)
+            latency_sum = self.latency_sum
+            batches, batch_queries, batch_seconds = self.batches, self.batch_queries, self.batch_seconds
+            loads = sorted(self.loads.items())
+            load_seconds, load_bytes = self.load_seconds, self.load_bytes
+
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                      for k, v in labels)
+                lines.append('{}_{}{}{} {}'.format(prefix, name, suffix, '{' + label_text + '}' if labels else '', value))
+
+        metric('queries_total', 'counter', 'Single lookups, by chromosome and outcome',
+               [('', (('chrom', chrom), ('outcome', outcome)), count) for (chrom, outcome), count in queries])
+        cumulative = 0
+        histogram = []
+        for bound, count in zip(list(LATENCY_BUCKETS) + ['+Inf'], buckets):
+            cumulative += count
+            histogram.append(('_bucket', (('le', bound),), cumulative))
+        histogram.append(('_sum', (), latency_sum))
+        histogram.append(('_count', (), cumulative))
+        metric('query_duration_seconds', 'histogram', 'Latency of single lookups', histogram)
+        metric('batches_total', 'counter', 'Batch lookups (at_many and overlapping_many)', [('', (), batches)])
+        metric('batch_queries_total', 'counter', 'Positions looked up in batches', [('', (), batch_queries)])
+        metric('batch_duration_seconds_total', 'counter', 'Time spent in batch lookups', [('', (), batch_seconds)])
+        metric('loads_total', 'counter', 'Datasets loaded from disk, by engine',
+               [('', (('engine', engine),), count) for engine, count in loads])
+        metric('load_duration_seconds_total', 'counter', 'Time spent loading datasets', [('', (), load_seconds)])
+        metric('load_bytes_total', 'counter', 'Size of the dataset files loaded', [('', (), load_bytes)])
+        return '\n'.join(lines) + '\n'
+
+
+# The recorder that every locator reports to, or None when metrics are off
+active = None  # type: ty.Optional[Metrics]
+
+
+def enable(recorder: Metrics = None) -> Metrics:
+    """Start recording metrics (into `recorder`, or a new `Metrics`), and return the recorder"""
+    global active
+    active = recorder or Metrics()
+    return active
+
+
+def disable() -> None:
+    global active
+    active = None
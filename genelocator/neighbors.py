@@ -0,0 +1,62 @@
+"""
+k-nearest gene search, shared by both locator engines
+
+Every gene on a chromosome is either before `pos` (end <= pos), overlapping it (start <= pos < end), or after it
+    (start > pos). The overlapping genes come from the locator's overlap index; the others are found by walking outward
+    from `pos` through the sorted gene ends and starts. Each step of the walk yields a new gene, so the cost is
+    proportional to log(n) plus the number of genes returned.
+"""
+
+import bisect
+import itertools
+import typing as ty
+
+from . import exception as gene_exc
+
+
+def nearest(locator, chrom: str, pos: int, k: ty.Optional[int] = 1, *, max_distance: int = None,
+            strict: bool = True) -> ty.List[dict]:
+    """See `GeneLocator.nearest`"""
+    if k is None and max_distance is None:
+        raise ValueError('Specify k, max_distance, or both')
+    chrom = locator._chrom_key(chrom)
+    boundaries = locator._sorted_boundaries(chrom)
+    if boundaries is None:
+        if strict:
+            raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+        return []
+    starts, start_genes, ends, end_genes = boundaries
+
+    found = []  # type: ty.List[dict]
+    for gene in locator.overlapping(chrom, pos, pos):
+        gene['distance'] = 0
+        found.append(gene)
+    before = bisect.bisect_right(ends, pos) - 1
+    after = bisect.bisect_right(starts, pos)
+    while k is None or len(found) < k:
+        dist_before = pos - ends[before] if before >= 0 else None
+        dist_after = starts[after] - pos if after < len(starts) else None
+        # On ties, prefer the gene after the position (like `GeneLocator.at`)
+        if dist_after is not None and (dist_before is None or dist_after <= dist_before):
+            distance, gene_key = dist_after, start_genes[after]
+            after += 1
+        elif dist_before is not None:
+            distance, gene_key = dist_before, end_genes[before]
+            before -= 1
+        else:
+            break
+        if max_distance is not None and distance > max_distance:
+            break
+        gene = locator._serialize(gene_key)
+        gene['distance'] = distance
+        found.append(gene)
+
+    return found if k is None else found[:k]
+
+
+def nearest_many(locator, chroms: ty.Union[str, ty.Sequence[str]], positions: ty.Sequence[int], k: ty.Optional[int] = 1, *,
+                 max_distance: int = None, strict: bool = True) -> ty.List[ty.List[dict]]:
+    """See `GeneLocator.nearest_many`"""
+    chroms = itertools.repeat(chroms) if isinstance(chroms, str) else chroms
+    return [nearest(locator, chrom, pos, k, max_distance=max_distance, strict=strict)
+            for chrom, pos in zip(chroms, positions)]
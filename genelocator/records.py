@@ -0,0 +1,34 @@
+"""
+Lightweight gene records, for callers that look up many positions in a loop (see the `result` argument of `at`)
+
+Building a fresh dict for every gene found is the main cost of a lookup. Instead, a locator can return `Gene` records,
+    which are created once per gene (the first time they are asked for) and then shared by every answer, or just its
+    internal gene keys, which `locator.gene(key)` turns into records.
+"""
+
+import collections
+import typing as ty
+
+
+RESULT_TYPES = {'dict', 'gene', 'id'}
+
+
+class Gene(collections.namedtuple('Gene', ['chrom', 'start', 'end', 'ensg', 'symbol'])):
+    """An immutable gene record. Each locator creates one `Gene` per gene, and returns that same object every time."""
+    __slots__ = ()
+
+    def as_dict(self) -> dict:
+        """The same dict that a lookup returns by default"""
+        return {'chrom': self.chrom, 'start': self.start, 'end': self.end, 'ensg': self.ensg, 'symbol': self.symbol}
+
+
+def convert(locator, keys: ty.List[ty.Any], result: str) -> list:
+    """Turn a locator's gene keys into the requested type of result"""
+    if result == 'dict':
+        return [locator._serialize(key) for key in keys]
+    elif result == 'gene':
+        records = locator._gene_records()
+        return [records[key] for key in keys]
+    elif result == 'id':
+        return keys
+    raise ValueError('Unknown result type {!r}; choose one of {}'.format(result, sorted(RESULT_TYPES)))
@@ -0,0 +1,180 @@
+"""
+Hold several datasets in one process, routed by (build, gencode version, geneset)
+
+A service that keeps GRCh37 and GRCh38, both genesets and several gencode versions in memory holds one copy of every
+    ENSG id and symbol per dataset, even though most genes appear in all of them. So `DatasetRegistry` builds each
+    tree-based locator from strings that pass through one shared `StringPool`, and every dataset refers to the same
+    string objects. The genes are read from a binary copy of the dataset (see `assets.get_copy_dir`), so that each tree
+    is only built once, from the shared strings. (`intern_strings=False` turns this off. The array engines store
+    strings as packed utf-8 blobs, with no per-gene objects to share.)
+
+    registry = DatasetRegistry()
+    registry.load('GRCh38', geneset='all')
+    registry.at('GRCh38', 'chr19', 234523, geneset='all')
+    registry.memory_usage()  # => {'GRCh38 gencode32 all': ..., 'shared strings': ...}
+"""
+
+import collections
+import sys
+import threading
+import typing as ty
+
+from . import cache as gene_cache
+from . import exception as gene_exc
+from .const import BUILD_LOOKUP, KNOWN_ENGINES, KNOWN_GENESETS
+from .lazy import LazyGeneLocator
+from .locate import GeneLocator
+
+
+# Registry keys are (GRCh build number, gencode version, geneset)
+DatasetKey = ty.Tuple[int, int, str]
+
+
+class StringPool:
+    """Maps every string to one shared copy of it"""
+    def __init__(self):
+        self._strings = {}  # type: ty.Dict[str, str]
+
+    def __call__(self, value: str) -> str:
+        return self._strings.setdefault(value, value)
+
+    def __len__(self) -> int:
+        return len(self._strings)
+
+    def nbytes(self) -> int:
+        return sum(sys.getsizeof(value) for value in self._strings)
+
+
+def intern_genes(locator, pool: StringPool) -> GeneLocator:
+    """
+    Build a tree-based locator with the same genes as `locator` (any engine), taking its chromosome names, ENSG ids and
+        symbols from `pool`. Genes are added in their original order, so ties resolve in the same way.
+    """
+    if isinstance(locator, LazyGeneLocator):
+        genes = locator._source.genes()  # type: ty.Iterable[dict]
+    elif isinstance(locator, GeneLocator):
+        genes = ({'chrom': chrom, 'start': start, 'end': end, 'ensg': ensg, 'symbol': symbol}
+                 for ensg, (chrom, start, end, symbol) in locator._gene_info.items())
+    else:
+        genes = locator.genes()
+    build = (locator._contig_index() if isinstance(locator, GeneLocator) else locator._index.contigs).build
+    return GeneLocator(({'chrom': pool(gene['chrom']), 'start': gene['start'], 'end': gene['end'],
+                         'ensg': pool(gene['ensg']), 'symbol': pool(gene['symbol'])} for gene in genes), build=build)
+
+
+def _key(build: str, gencode_version: int, geneset: str) -> DatasetKey:
+    if build not in BUILD_LOOKUP:
+        raise gene_exc.UnsupportedDatasetException('Unknown build: {!r}'.format(build))
+    if geneset not in KNOWN_GENESETS:
+        raise gene_exc.UnsupportedDatasetException('Unknown geneset: {!r}'.format(geneset))
+    return BUILD_LOOKUP[build], int(gencode_version), geneset
+
+
+def describe(key: DatasetKey) -> str:
+    return 'GRCh{} gencode{} {}'.format(*key)
+
+
+class DatasetRegistry:
+    """Loads datasets on request, and keeps them (and their shared strings) for the life of the registry"""
+    def __init__(self, *, engine: str = 'tree', auto_fetch: bool = False, intern_strings: bool = True,
+                 cache_dir: str = None):
+        if engine not in KNOWN_ENGINES:
+            raise ValueError('Unknown engine {!r}; choose one of {}'.format(engine, sorted(KNOWN_ENGINES)))
+        self.engine = engine
+        self.auto_fetch = auto_fetch
+        self.cache_dir = cache_dir
+        self.strings = StringPool() if intern_strings else None
+        self._lock = threading.Lock()
+        self._locators = {}  # type: ty.Dict[DatasetKey, ty.Any]
+        # One lock per dataset, so that different datasets can load at the same time. Also records the order that
+        #   datasets were first asked for, which is the order they are listed in.
+        self._key_locks = collections.OrderedDict()  # type: ty.MutableMapping[DatasetKey, threading.Lock]
+
+    def __len__(self) -> int:
+        return len(self._locators)
+
+    def __contains__(self, key: DatasetKey) -> bool:
+        return key in self._locators
+
+    def keys(self) -> ty.List[DatasetKey]:
+        """The loaded datasets, in the order they were first asked for"""
+        return [key for key, _ in self.items()]
+
+    def items(self) -> ty.List[ty.Tuple[DatasetKey, ty.Any]]:
+        with self._lock:
+            return [(key, self._locators[key]) for key in self._key_locks if key in self._locators]
+
+    def load(self, build: str, gencode_version: int = 32, geneset: str = 'common_genetypes'):
+        """Get a dataset, loading it (once, even if several threads ask at the same time) if it isn't loaded yet"""
+        key = _key(build, gencode_version, geneset)
+        locator = self._locators.get(key)
+        if locator is not None:
+            return locator
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._locators:
+                locator = self._load(build, key)
+                with self._lock:
+                    self._locators[key] = locator
+            return self._locators[key]
+
+    get = load
+
+    def load_in_background(self, build: str, gencode_version: int = 32, geneset: str = 'common_genetypes', *,
+                           executor: ty.Any = None):
+        """Start loading a dataset in another thread, and return a `background.LoadHandle` for it (see `load`)"""
+        from .background import LoadHandle
+        key = _key(build, gencode_version, geneset)
+        with self._lock:
+            self._key_locks.setdefault(key, threading.Lock())  # list datasets in the order they were asked for
+        return LoadHandle.start(lambda: self.load(build, gencode_version, geneset), executor=executor, description=describe(key))
+
+    def add(self, build: str, gencode_version: int, geneset: str, locator) -> None:
+        """
+        Register a locator that was loaded some other way. A tree-based locator is replaced by a copy that uses the
+            shared strings (unless `intern_strings` is off).
+        """
+        key = _key(build, gencode_version, geneset)
+        locator = self._intern(locator)
+        with self._lock:
+            self._key_locks.setdefault(key, threading.Lock())
+            self._locators[key] = locator
+
+    def _load(self, build: str, key: DatasetKey):
+        # Load a copy of our own (not from the shared cache)
+        from . import get_genelocator
+        _, gencode_version, geneset = key
+        interning = self.strings is not None and self.engine == 'tree'
+        # To intern strings, read the genes without building any trees (a lazy locator only opens a binary copy of the
+        #   dataset), then build the trees once, from the shared strings
+        locator = get_genelocator(build, gencode_version=gencode_version, common_genetypes_only=(geneset == 'common_genetypes'),
+                                  auto_fetch=self.auto_fetch, engine=self.engine, lazy=interning, cache=False,
+                                  cache_dir=self.cache_dir)
+        return intern_genes(locator, self.strings) if interning else locator
+
+    def _intern(self, locator):
+        if self.strings is not None and isinstance(locator, GeneLocator):
+            return intern_genes(locator, self.strings)
+        return locator
+
+    def at(self, build: str, chrom: str, pos: int, *, gencode_version: int = 32, geneset: str = 'common_genetypes',
+           **kwargs) -> list:
+        """Look up a position in a dataset (see `GeneLocator.at` for the other arguments)"""
+        return self.load(build, gencode_version, geneset).at(chrom, pos, **kwargs)
+
+    def memory_usage(self) -> ty.Dict[str, int]:
+        """
+        Estimated bytes used by each dataset, not counting the strings that they share, which are reported once
+            (as `shared strings`)
+        """
+        usage = collections.OrderedDict()  # type: ty.Dict[str, int]
+        for key, locator in self.items():
+            size = gene_cache.estimate_memory(locator)
+            if self.strings is not None and type(locator) is GeneLocator:
+                # Its ENSG ids and symbols are the shared strings, which are counted once, below
+                size -= gene_cache.TREE_STRING_BYTES_PER_GENE * len(locator._gene_info)
+            usage[describe(key)] = size
+        if self.strings is not None:
+            usage['shared strings'] = self.strings.nbytes()
+        return usage
@@ -0,0 +1,67 @@
+"""
+Find genes by name (symbol or ENSG id), shared by every locator engine
+
+Each locator builds a `NameIndex` the first time it is searched. Every gene is indexed under its symbol, its ENSG id,
+    and its ENSG id without the version (so "ENSG00000148737" finds "ENSG00000148737.16"), all case-folded. Exact
+    lookups are one dict lookup; prefix searches (eg for autocomplete) bisect a sorted list of the same names.
+"""
+
+import bisect
+import collections
+import typing as ty
+
+from . import records
+
+
+def _names(gene: records.Gene) -> ty.Tuple[str, str, str]:
+    """Every name that a gene can be found by: its symbol, ENSG id, and ENSG id without the version"""
+    return gene.symbol, gene.ensg, gene.ensg.split('.', 1)[0]
+
+
+class NameIndex:
+    def __init__(self, genes: ty.Iterable[ty.Tuple[ty.Any, records.Gene]]):
+        """`genes` is (gene key, record) pairs, in the order that results should be returned"""
+        self._keys = {}  # type: ty.Dict[str, ty.List[ty.Any]]  # case-folded name -> gene keys
+        for key, gene in genes:
+            for name in {name.casefold() for name in _names(gene)}:
+                if name:
+                    self._keys.setdefault(name, []).append(key)
+        self._names = sorted(self._keys)
+
+    @classmethod
+    def from_locator(cls, locator) -> 'NameIndex':
+        genes = locator._gene_records()
+        return cls(genes.items() if isinstance(genes, dict) else enumerate(genes))
+
+    def find(self, name: str) -> ty.List[ty.Any]:
+        """The keys of every gene with this name, ignoring case"""
+        return list(self._keys.get(name.casefold(), ()))
+
+    def complete(self, prefix: str, limit: ty.Optional[int]) -> ty.List[ty.Any]:
+        """The keys of genes with a name that starts with `prefix` (ignoring case), in order of name"""
+        prefix = prefix.casefold()
+        found = collections.OrderedDict()  # type: ty.Dict[ty.Any, None]  # an ordered set
+        i = bisect.bisect_left(self._names, prefix)
+        while i < len(self._names) and self._names[i].startswith(prefix) and (limit is None or len(found) < limit):
+            for key in self._keys[self._names[i]]:
+                found[key] = None
+            i += 1
+        return list(found)[:limit]
+
+
+def lookup(locator, name: str, *, case_sensitive: bool = False, result: str = 'dict') -> list:
+    """See `GeneLocator.lookup`"""
+    keys = locator._name_index().find(name)
+    if case_sensitive:
+        keys = [key for key in keys if name in _names(locator.gene(key))]
+    return records.convert(locator, keys, result)
+
+
+def lookup_many(locator, names: ty.Iterable[str], *, case_sensitive: bool = False, result: str = 'dict') -> ty.List[list]:
+    """See `GeneLocator.lookup_many`"""
+    return [lookup(locator, name, case_sensitive=case_sensitive, result=result) for name in names]
+
+
+def autocomplete(locator, prefix: str, *, limit: ty.Optional[int] = 10, result: str = 'dict') -> list:
+    """See `GeneLocator.autocomplete`"""
+    return records.convert(locator, locator._name_index().complete(prefix, limit), result)
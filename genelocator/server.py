@@ -0,0 +1,370 @@
+"""
+A small asyncio HTTP service for gene lookups (standard library only)
+
+Endpoints (the dataset is chosen with the optional `build`, `version` and `geneset` query parameters; by default, the
+    first dataset that was loaded is used):
+    - `GET /locate?chrom=19&pos=234523`: the same genes as `GeneLocator.at`, as `{"chrom", "pos", "genes"}`
+    - `POST /locate`: many positions at once. The body is either a JSON array (of `[chrom, pos]` pairs or
+        `{"chrom", "pos"}` objects), answered with a JSON array; or, with `Content-Type: application/x-ndjson`, one
+        position per line, answered with one JSON object per line.
+
+Chromosomes must be strings and positions whole numbers. A request with an unknown chromosome, or a position that is
+    out of range, gets a 400 response from either endpoint.
+    - `GET /health`: the loaded datasets (and their estimated memory use)
+    - `GET /stats`: request counts, batch sizes and latency percentiles
+    - `GET /metrics`: lookup and load metrics in the Prometheus text format (if enabled; see `metrics`)
+
+Single lookups that arrive at about the same time are merged into one micro-batch and answered together with
+    `at_many`, which is much faster than answering each one separately. Every dataset is loaded before the server
+    starts accepting connections, so the first requests are as fast as the rest.
+
+Run with `python -m genelocator.server GRCh38 --port 8080`.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import time
+import typing as ty
+import urllib.parse
+
+from . import exception as gene_exc
+from . import metrics
+from .const import BUILD_LOOKUP, KNOWN_ENGINES, KNOWN_GENESETS
+from .registry import DatasetRegistry, describe
+
+
+logger = logging.getLogger(__name__)
+
+# Also the largest number of positions answered at once for a bulk request (between chunks, other requests can run)
+MAX_BATCH_SIZE = 4096
+NDJSON_TYPE = 'application/x-ndjson'
+# Positions are answered as int64 values
+MIN_POSITION, MAX_POSITION = -2 ** 63, 2 ** 63 - 1
+_REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error'}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _query(chrom: ty.Any, pos: ty.Any) -> ty.Tuple[str, int]:
+    """
+    Check one query from a request: `chrom` must be a string, and `pos` a whole number (or a string of one, as in a URL).
+        Raises ValueError for anything else, eg `null`, `19` or `1.5`.
+    """
+    if not isinstance(chrom, str) or isinstance(pos, bool) or not isinstance(pos, (int, str)):
+        raise ValueError('Bad query: {!r}, {!r}'.format(chrom, pos))
+    return chrom, int(pos)
+
+
+def _check_position(pos: int) -> None:
+    if not MIN_POSITION <= pos <= MAX_POSITION:
+        raise HTTPError(400, 'Position {} is out of range'.format(pos))
+
+
+def _check_chrom(locator, chrom: str) -> None:
+    if locator._sorted_boundaries(locator._chrom_key(chrom)) is None:
+        raise HTTPError(400, 'Unknown chromosome: {!r}'.format(locator._chrom_key(chrom)))
+
+
+class _MicroBatcher:
+    """Collect single lookups for one dataset, and answer them together"""
+    def __init__(self, locator, stats: 'ServiceStats', *, batch_window: float, max_batch_size: int):
+        self._locator = locator
+        self._stats = stats
+        self._batch_window = batch_window
+        self._max_batch_size = max_batch_size
+        self._pending = []  # type: ty.List[ty.Tuple[str, int, asyncio.Future]]
+        self._flush_handle = None  # type: ty.Optional[asyncio.TimerHandle]
+
+    def locate(self, chrom: str, pos: int) -> 'asyncio.Future[ty.List[dict]]':
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._pending.append((chrom, pos, future))
+        if len(self._pending) >= self._max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            # Wait briefly, so that other requests that are already on their way can join this batch
+            self._flush_handle = loop.call_later(self._batch_window, self._flush)
+        return future
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            result = self._locator.at_many([q[0] for q in batch], [q[1] for q in batch], strict=False)
+        except Exception:
+            # Answer each query on its own, so that one bad query only fails its own request
+            for chrom, pos, future in batch:
+                try:
+                    genes = self._locator.at_many([chrom], [pos], strict=False)[0]
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(genes)
+            return
+        self._stats.record_batch(len(batch))
+        for i, (_, _, future) in enumerate(batch):
+            if not future.done():  # eg the client disconnected
+                future.set_result(result[i])
+
+
+class ServiceStats:
+    """Counters and recent latencies, for the `/stats` endpoint"""
+    def __init__(self, max_samples: int = 10000):
+        self.started = time.time()
+        self.requests = collections.Counter()  # type: ty.Counter[str]
+        self.errors = 0
+        self.batches = 0
+        self.batched_queries = 0
+        self.latencies = collections.deque(maxlen=max_samples)  # type: ty.Deque[float]  # seconds, most recent last
+
+    def record_batch(self, size: int) -> None:
+        self.batches += 1
+        self.batched_queries += size
+
+    def record_request(self, endpoint: str, seconds: float, ok: bool) -> None:
+        self.requests[endpoint] += 1
+        self.errors += not ok
+        self.latencies.append(seconds)
+
+    def as_dict(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000 if latencies else None
+        return {
+            'uptime_seconds': time.time() - self.started,
+            'requests': dict(self.requests),
+            'errors': self.errors,
+            'batches': self.batches,
+            'mean_batch_size': self.batched_queries / self.batches if self.batches else None,
+            'latency_ms': {'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+                           'max': latencies[-1] * 1000 if latencies else None},
+        }
+
+
+class LocatorService:
+    """
+    Answers HTTP requests from a set of preloaded locators. `datasets` is a `DatasetRegistry`, or maps (build, gencode
+        version, geneset) to a locator; the first one is the default.
+    """
+    def __init__(self, datasets: ty.Union[DatasetRegistry, ty.Mapping[ty.Tuple[str, int, str], ty.Any]], *,
+                 batch_window: float = 0.001, max_batch_size: int = MAX_BATCH_SIZE, max_body_bytes: int = 64 * 1024 * 1024):
+        if not len(datasets):
+            raise ValueError('At least one dataset is required')
+        self.stats = ServiceStats()
+        self.max_body_bytes = max_body_bytes
+        self.registry = datasets if isinstance(datasets, DatasetRegistry) else None
+        self._locators = {}  # type: ty.Dict[ty.Tuple[int, int, str], ty.Any]
+        self._batchers = {}  # type: ty.Dict[ty.Tuple[int, int, str], _MicroBatcher]
+        for (build, version, geneset), locator in datasets.items():
+            key = (build if self.registry is not None else BUILD_LOOKUP[build], int(version), geneset)
+            locator._array_index()  # build the batch index now, rather than during the first request
+            self._locators[key] = locator
+            self._batchers[key] = _MicroBatcher(locator, self.stats, batch_window=batch_window,
+                                                max_batch_size=max_batch_size)
+        self._default = next(iter(self._locators))
+
+    @classmethod
+    def load(cls, builds: ty.Iterable[str], gencode_versions: ty.Iterable[int] = (32,),
+             genesets: ty.Iterable[str] = ('common_genetypes',), *, engine: str = 'compact', auto_fetch: bool = False,
+             **kwargs) -> 'LocatorService':
+        """Load every combination of build, gencode version and geneset (into a `registry.DatasetRegistry`)"""
+        datasets = DatasetRegistry(engine=engine, auto_fetch=auto_fetch)
+        for build in builds:
+            for version in gencode_versions:
+                for geneset in genesets:
+                    datasets.load(build, version, geneset)
+        return cls(datasets, **kwargs)
+
+    def _dataset(self, query: ty.Mapping[str, str]) -> ty.Tuple[int, int, str]:
+        build_number, version, geneset = self._default
+        try:
+            if 'build' in query:
+                build_number = BUILD_LOOKUP[query['build']]
+            if 'version' in query:
+                version = int(query['version'].replace('gencode', ''))
+        except (KeyError, ValueError):
+            raise HTTPError(400, 'Unknown build or version')
+        key = (build_number, version, query.get('geneset', geneset))
+        if key not in self._locators:
+            raise HTTPError(404, 'Dataset not loaded: {}'.format(describe(key)))
+        return key
+
+    async def handle(self, method: str, path: str, headers: ty.Mapping[str, str], body: bytes) -> ty.Tuple[int, str, bytes]:
+        """Answer one request, returning (status, content type, body)"""
+        url = urllib.parse.urlsplit(path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        if url.path == '/locate' and method == 'GET':
+            return 200, 'application/json', await self._locate_one(query)
+        elif url.path == '/locate' and method == 'POST':
+            return await self._locate_many(query, headers, body)
+        elif url.path == '/health' and method == 'GET':
+            health = {'status': 'ok', 'datasets': [describe(key) for key in self._locators]}
+            if self.registry is not None:
+                health['memory_bytes'] = self.registry.memory_usage()
+            return 200, 'application/json', _dumps(health)
+        elif url.path == '/stats' and method == 'GET':
+            return 200, 'application/json', _dumps(self.stats.as_dict())
+        elif url.path == '/metrics' and method == 'GET':
+            if metrics.active is None:
+                raise HTTPError(404, 'Metrics are not enabled')
+            return 200, 'text/plain; version=0.0.4', metrics.active.to_prometheus().encode('utf-8')
+        elif url.path in ('/locate', '/health', '/stats', '/metrics'):
+            raise HTTPError(405, 'Method not allowed')
+        raise HTTPError(404, 'Not found')
+
+    async def _locate_one(self, query: ty.Mapping[str, str]) -> bytes:
+        key = self._dataset(query)
+        try:
+            chrom, pos = _query(query['chrom'], query['pos'])
+        except (KeyError, ValueError):
+            raise HTTPError(400, 'Specify chrom and an integer pos')
+        _check_position(pos)
+        _check_chrom(self._locators[key], chrom)
+        genes = await self._batchers[key].locate(chrom, pos)
+        return _dumps({'chrom': chrom, 'pos': pos, 'genes': genes})
+
+    async def _locate_many(self, query: ty.Mapping[str, str], headers: ty.Mapping[str, str],
+                           body: bytes) -> ty.Tuple[int, str, bytes]:
+        locator = self._locators[self._dataset(query)]
+        ndjson = headers.get('content-type', '').split(';')[0].strip() == NDJSON_TYPE
+        try:
+            text = body.decode('utf-8')
+            items = [json.loads(line) for line in text.splitlines() if line.strip()] if ndjson else json.loads(text)
+            positions = [_query(item['chrom'], item['pos']) if isinstance(item, dict) else _query(item[0], item[1])
+                         for item in items]
+        except (ValueError, TypeError, KeyError, IndexError):
+            raise HTTPError(400, 'Expected a list of [chrom, pos] pairs or {"chrom", "pos"} objects, '
+                                 'with a string chrom and an integer pos')
+        for _, pos in positions:
+            _check_position(pos)
+        # Like single lookups, a batch with a chromosome that the dataset doesn't have is an error
+        for chrom in set(chrom for chrom, _ in positions):
+            _check_chrom(locator, chrom)
+
+        answers = []
+        for chunk_start in range(0, len(positions), MAX_BATCH_SIZE):
+            chunk = positions[chunk_start:chunk_start + MAX_BATCH_SIZE]
+            result = locator.at_many([chrom for chrom, _ in chunk], [pos for _, pos in chunk], strict=False)
+            self.stats.record_batch(len(chunk))
+            answers.extend({'chrom': chrom, 'pos': pos, 'genes': result[i]} for i, (chrom, pos) in enumerate(chunk))
+            await asyncio.sleep(0)  # let single lookups through between chunks
+        if ndjson:
+            return 200, NDJSON_TYPE, b''.join(_dumps(answer) + b'\n' for answer in answers)
+        return 200, 'application/json', _dumps(answers)
+
+    async def serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Handle HTTP/1.1 requests on one connection (with keep-alive) until the client closes it"""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                started = time.perf_counter()
+                try:
+                    method, path, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    return
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                keep_alive = (headers.get('connection', '').lower() != 'close' if version == 'HTTP/1.1'
+                              else headers.get('connection', '').lower() == 'keep-alive')
+
+                endpoint = urllib.parse.urlsplit(path).path
+                try:
+                    length = int(headers.get('content-length', 0))
+                    if length > self.max_body_bytes:
+                        raise HTTPError(413, 'Request body is too large')
+                    body = await reader.readexactly(length) if length else b''
+                    status, content_type, content = await self.handle(method, path, headers, body)
+                except HTTPError as e:
+                    status, content_type, content = e.status, 'application/json', _dumps({'error': e.message})
+                except (gene_exc.BaseGeneLocatorException, ValueError) as e:
+                    status, content_type, content = 400, 'application/json', _dumps({'error': str(e)})
+                except asyncio.IncompleteReadError:
+                    return
+                except Exception:
+                    logger.exception('Error handling %s %s', method, path)
+                    status, content_type, content = 500, 'application/json', _dumps({'error': 'Internal error'})
+                    keep_alive = False
+                self.stats.record_request(endpoint, time.perf_counter() - started, status < 400)
+
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, _REASONS.get(status, ''), content_type, len(content),
+                    '' if keep_alive else 'Connection: close\r\n').encode('latin-1') + content)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1', port: int = 8080) -> asyncio.AbstractServer:
+        """Start listening (use port 0 to pick any free port; see `server.sockets[0].getsockname()`)"""
+        return await asyncio.start_server(self.serve_connection, host, port)
+
+
+def _dumps(value) -> bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve gene lookups over HTTP")
+    parser.add_argument("builds", nargs='+', choices=BUILD_LOOKUP.keys(), help="The genome builds to load")
+    parser.add_argument("--version", dest="versions", action='append', type=int,
+                        help="A GENCODE version to load (can be given more than once; default: 32)")
+    parser.add_argument("--geneset", dest="genesets", action='append', choices=sorted(KNOWN_GENESETS),
+                        help="A geneset to load (can be given more than once; default: common_genetypes)")
+    parser.add_argument('--engine', choices=sorted(KNOWN_ENGINES), default='compact')
+    parser.add_argument('--auto-fetch', action='store_true', help="Build any datasets that are not available yet")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--metrics', action='store_true', help="Record metrics, and serve them at /metrics")
+    parser.add_argument('--batch-window-ms', type=float, default=1.0,
+                        help="How long to wait for more single lookups to join a batch")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    args = parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+    service = LocatorService.load(args.builds, args.versions or [32], args.genesets or ['common_genetypes'],
+                                  engine=args.engine, auto_fetch=args.auto_fetch,
+                                  batch_window=args.batch_window_ms / 1000)
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(service.start(args.host, args.port))
+    logger.info('Listening on %s', ', '.join(str(s.getsockname()) for s in server.sockets))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+
+
+if __name__ == '__main__':
+    main()
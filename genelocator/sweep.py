@@ -0,0 +1,118 @@
+"""
+Annotate positions that are already sorted (eg a VCF) by sweeping forward through each chromosome
+
+Instead of searching from scratch for every position, keep cursors into the sorted gene starts and ends of the current
+    chromosome, plus the set of genes that contain the current position. Each cursor only moves forward, so a whole
+    sorted input takes linear time overall.
+"""
+
+import heapq
+import itertools
+import typing as ty
+
+from . import exception as gene_exc
+
+
+ON_UNSORTED = {'raise', 'fallback'}
+
+
+class _ChromSweep:
+    """Cursors (and the set of overlapping genes) for one chromosome"""
+    def __init__(self, chrom: str, locator, boundaries):
+        self.chrom = chrom
+        self.pos = None  # type: ty.Optional[int]
+        self._serialize = locator._serialize
+        self._starts, self._start_genes, self._ends, self._end_genes = boundaries
+        self._added = 0  # the number of genes (in start order) with start <= pos
+        self._next_start = 0  # the first gene (in start order) with start >= pos
+        self._passed = 0  # the number of genes (in end order) with end <= pos
+        self._active = {}  # type: ty.Dict[ty.Any, dict]  # the genes that contain pos
+        self._ending = []  # type: ty.List[ty.Tuple[int, int, ty.Any]]  # heap of (end, tie breaker, gene) for active genes
+        self._counter = itertools.count()
+
+    def at(self, pos: int) -> ty.List[dict]:
+        """Move forward to `pos` (which must not be before the previous position), and locate genes there"""
+        starts, ends = self._starts, self._ends
+        n = len(starts)
+        while self._added < n and starts[self._added] <= pos:
+            gene = self._start_genes[self._added]
+            self._active[gene] = info = self._serialize(gene)
+            heapq.heappush(self._ending, (info['end'], next(self._counter), gene))
+            self._added += 1
+        while self._ending and self._ending[0][0] <= pos:
+            del self._active[heapq.heappop(self._ending)[2]]
+        while self._next_start < n and starts[self._next_start] < pos:
+            self._next_start += 1
+        while self._passed < n and ends[self._passed] <= pos:
+            self._passed += 1
+        self.pos = pos
+
+        if self._active:
+            # Copies, so that callers can modify the results (as they can with `GeneLocator.at`)
+            return [dict(g) for g in sorted(self._active.values(), key=lambda g: (g['start'], g['ensg']))]
+
+        # The same rules (and tie-breaking) as `GeneLocator.at`: the closer of the previous end and the next start
+        has_prev = self._passed > 0
+        has_next = self._next_start < n
+        if has_prev and (not has_next or pos - ends[self._passed - 1] < starts[self._next_start] - pos):
+            return [self._serialize(self._end_genes[self._passed - 1])]
+        elif has_next:
+            return [self._serialize(self._start_genes[self._next_start])]
+        else:
+            raise gene_exc.NoResultsFoundException(
+                'The position chr{!r}:{!r} has no genes before it or after it'.format(self.chrom, pos))
+
+
+def sweep(locator, records: ty.Iterable, *, key: ty.Callable[[ty.Any], ty.Tuple[str, int]] = None,
+          on_unsorted: str = 'raise', strict: bool = True) -> ty.Iterator[ty.Tuple[ty.Any, ty.List[dict]]]:
+    """
+    Locate genes for each record in a sorted stream, yielding `(record, genes)` with the same genes as `locator.at`.
+        `locator` can be a `GeneLocator` or a `CompactGeneLocator`.
+
+    Records are `(chrom, pos, ...)` tuples unless `key` says how to get (chrom, pos) from each record. They must be
+        grouped by chromosome (in any order of chromosomes) and sorted by position within each chromosome. A record
+        that breaks this order raises `UnsortedInputException`, or with `on_unsorted='fallback'`, is answered with a
+        normal lookup (and the sweep carries on from where it was).
+    """
+    if on_unsorted not in ON_UNSORTED:
+        raise ValueError('on_unsorted must be one of {}'.format(sorted(ON_UNSORTED)))
+    if key is None:
+        def key(record):
+            return record[0], record[1]
+
+    current = None  # type: ty.Optional[_ChromSweep]
+    finished = set()  # type: ty.Set[str]  # chromosomes that the sweep has moved past
+    unknown = set()  # type: ty.Set[str]  # chromosomes without data (only when not strict)
+    chrom_key = locator._chrom_key
+    for record in records:
+        raw_chrom, pos = key(record)
+        chrom = chrom_key(raw_chrom)
+        if current is not None and chrom == current.chrom and pos >= current.pos:
+            yield record, current.at(pos)
+            continue
+        if chrom in unknown:
+            yield record, []
+            continue
+
+        if chrom in finished or (current is not None and chrom == current.chrom):
+            if on_unsorted == 'raise':
+                if chrom in finished:
+                    reason = 'other chromosomes came between records for chromosome {}'.format(chrom)
+                else:
+                    reason = 'it came after position {}'.format(current.pos)
+                raise gene_exc.UnsortedInputException('Input is not sorted at {}:{} ({})'.format(raw_chrom, pos, reason))
+            yield record, locator.at(raw_chrom, pos, strict=strict)
+            continue
+
+        # The start of a new chromosome
+        boundaries = locator._sorted_boundaries(chrom)
+        if boundaries is None:
+            if strict:
+                raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            unknown.add(chrom)
+            yield record, []
+            continue
+        if current is not None:
+            finished.add(current.chrom)
+        current = _ChromSweep(chrom, locator, boundaries)
+        yield record, current.at(pos)
@@ -0,0 +1,112 @@
+"""
+A precompiled "answer tiling" of each chromosome, so that a lookup is a single bisect
+
+The answer to `at(chrom, pos)` is piecewise constant along a chromosome: it can only change at a gene start or end, one
+    past it, or where the nearest gene switches from the one before to the one after (halfway across the gap between
+    them). The tiling splits each chromosome at those points, and stores the answer (gene ids, and whether they overlap
+    the position) for each tile. Answering a query is then one bisect into the tile starts, with no overlap search and no
+    distance comparison.
+
+Tiles are computed by asking the array engine for the answer at the start of every tile, so they follow exactly the
+    same rules (including how ties are broken). Tilings can be saved in binary dataset files (see `fileformat`).
+"""
+
+import array
+import bisect
+import typing as ty
+
+from . import exception as gene_exc
+from .compact import CompactGeneLocator
+from .index import ArrayIndex, ChromIndex
+
+
+# Every tiling starts here, so that any position falls in some tile
+FIRST_TILE = -2 ** 63
+
+
+class ChromTiling:
+    """The tiles of one chromosome: tile `i` covers `[starts[i], starts[i + 1])`, with genes `ids[offsets[i]:offsets[i + 1]]`"""
+    ARRAYS = ('tile_starts', 'tile_offsets', 'tile_ids', 'tile_overlap')
+    TYPECODES = {'tile_starts': 'q', 'tile_offsets': 'q', 'tile_ids': 'i', 'tile_overlap': 'B'}
+
+    def __init__(self, tile_starts: ty.Sequence[int], tile_offsets: ty.Sequence[int], tile_ids: ty.Sequence[int],
+                 tile_overlap: ty.Sequence[int]):
+        """Any buffers of the types in `TYPECODES` work (eg `array.array`, or `memoryview` for a mapped file)"""
+        self.tile_starts = tile_starts
+        self.tile_offsets = tile_offsets
+        self.tile_ids = tile_ids
+        self.tile_overlap = tile_overlap  # 1 if the tile's genes overlap it, 0 if they are the nearest gene
+
+    @classmethod
+    def from_chrom(cls, arrays: ChromIndex, find: ty.Callable[[int], ty.Tuple[ty.List[int], str]]) -> 'ChromTiling':
+        """Tile a chromosome, where `find(pos)` gives (gene ids, outcome) by the usual rules"""
+        starts, ends = arrays.starts, arrays.ends
+        points = {FIRST_TILE}
+        for boundary in set(starts) | set(ends):
+            points.add(boundary)
+            points.add(boundary + 1)
+        # Where the nearest gene switches from the previous gene end to the next gene start. The start wins ties, so that
+        #   is the first position where the start is at least as close as the end.
+        for end in set(ends):
+            next_idx = bisect.bisect_right(starts, end)
+            if next_idx < len(starts):
+                points.add((end + starts[next_idx] + 1) // 2)
+
+        tile_starts, tile_offsets, tile_ids, tile_overlap = array.array('q'), array.array('q', [0]), array.array('i'), array.array('B')
+        previous = None
+        for point in sorted(points):
+            answer = find(point)
+            if answer == previous:
+                continue  # same answer as the tile before it, so merge them
+            previous = answer
+            ids, outcome = answer
+            tile_starts.append(point)
+            tile_ids.extend(ids)
+            tile_offsets.append(len(tile_ids))
+            tile_overlap.append(outcome == 'overlap')
+        return cls(tile_starts, tile_offsets, tile_ids, tile_overlap)
+
+    def __len__(self) -> int:
+        return len(self.tile_starts)
+
+    def find(self, pos: int) -> ty.Tuple[ty.List[int], str]:
+        i = bisect.bisect_right(self.tile_starts, pos) - 1
+        return self.tile_ids[self.tile_offsets[i]:self.tile_offsets[i + 1]].tolist(), 'overlap' if self.tile_overlap[i] else 'nearest'
+
+
+class TiledGeneLocator(CompactGeneLocator):
+    """
+    A `CompactGeneLocator` that answers `at` from a precompiled tiling. Everything else (and the answers) are the same.
+    """
+    def __init__(self, index: ArrayIndex, tiling: ty.Dict[str, ChromTiling] = None, *, metadata: dict = None):
+        """If no tiling is given, it is compiled from the index (which takes under a second for a whole genome)"""
+        super().__init__(index, metadata=metadata)
+        if tiling is None:
+            tiling = compile_tiling(index)
+        self._tiling = tiling
+
+    @classmethod
+    def from_genes(cls, genes: ty.Iterable[dict]) -> 'TiledGeneLocator':
+        return cls(ArrayIndex.from_genes(genes))
+
+    @classmethod
+    def from_locator(cls, locator) -> 'TiledGeneLocator':
+        """Tile a `GeneLocator` or `CompactGeneLocator`"""
+        return cls(locator._array_index(), metadata=getattr(locator, 'metadata', None))
+
+    def _at_ids(self, chrom: str, pos: int, strict: bool) -> ty.Tuple[ty.List[int], str]:
+        chrom = self._index.contigs.resolve(chrom)
+        try:
+            tiles = self._tiling[chrom]
+        except KeyError:
+            if strict:
+                raise gene_exc.BadCoordinateException("Unknown chromosome: {!r}".format(chrom))
+            return [], 'unknown_chromosome'
+        return tiles.find(pos)
+
+
+def compile_tiling(index: ArrayIndex) -> ty.Dict[str, ChromTiling]:
+    """Tile every chromosome of an index"""
+    reference = CompactGeneLocator(index)
+    return {chrom: ChromTiling.from_chrom(arrays, lambda pos, chrom=chrom: reference._at_ids(chrom, pos, True))
+            for chrom, arrays in index.chroms.items()}
@@ -115,7 +115,8 @@ setup(
     entry_points={
         'console_scripts': [
             'gene-locator=bin.command_line:main',
-            # TODO: create (and add script for) gene-downloader, which will prepare the environment the first time
+            'gene-downloader=bin.download_datasets:main',
+            'gene-locator-server=genelocator.server:main',
         ]},
     include_package_data=True,
     zip_safe=False,
@@ -125,7 +126,12 @@ setup(
     ],
     install_requires=[
         'intervaltree~=3.0',
+        'numpy>=1.13',
     ],
+    extras_require={
+        # Annotating DataFrames and Arrow tables (see `genelocator.frames`)
+        'dataframes': ['pandas', 'pyarrow'],
+    },
     tests_require=[
         'pytest~=5.0',
     ],
@@ -1,9 +1,52 @@
+import asyncio
+import concurrent.futures
+import gzip
+import io
+import json
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+
 import pytest
 
-from genelocator import get_genelocator
+from genelocator import get_genelocator, get_dataset_info, load_in_background
+from genelocator import annotate
 from genelocator import assets
+from genelocator import background
+from genelocator import build
+from genelocator import contigs
+from genelocator import cache as gene_cache
+from genelocator import delta
+from genelocator import differential
+from genelocator import fileformat
+from genelocator import frames
+from genelocator import genelist
+from genelocator import metrics
+from genelocator import registry
+from genelocator import server
+from genelocator import download
+from genelocator.download import save_locator
+from genelocator.sweep import sweep
 from genelocator import exception as gene_exc
-from genelocator.locate import BisectFinder
+from genelocator.compact import CompactGeneLocator
+from genelocator.lazy import LazyGeneLocator
+from genelocator.locate import BisectFinder, GeneLocator
+from genelocator.tiling import TiledGeneLocator
+
+
+@pytest.fixture(scope='session', autouse=True)
+def user_cache_dir(tmp_path_factory):
+    # Binary copies of pickled datasets are saved to the user's cache folder; keep them out of the real one
+    previous = os.environ.get('XDG_CACHE_HOME')
+    os.environ['XDG_CACHE_HOME'] = str(tmp_path_factory.mktemp('user-cache'))
+    yield os.environ['XDG_CACHE_HOME']
+    if previous is None:
+        del os.environ['XDG_CACHE_HOME']
+    else:
+        os.environ['XDG_CACHE_HOME'] = previous
 
 
 @pytest.fixture(scope='module')
@@ -12,6 +55,11 @@ def build38finder():
     return get_genelocator('GRCh38', gencode_version=32, common_genetypes_only=True)
 
 
+@pytest.fixture(scope='module')
+def build38compact():
+    return get_genelocator('GRCh38', gencode_version=32, common_genetypes_only=True, engine='compact')
+
+
 class TestGeneLocator:
     def test_creates_locator_from_filepath(self):
         """This should work (measured by not raising an exception)"""
@@ -49,6 +97,841 @@ class TestGeneLocator:
                           'symbol': 'NRAP'}], 'Found two genes, ordered by start position'
 
 
+class TestBatchQueries:
+    def test_matches_single_queries(self, build38finder):
+        chroms = ['chr19', '10', '10', 'chr10', '19', 'X', 'chrMT']
+        positions = [1234, 112950250, 113588900, 10**9, 58346000, 155000000, 5000]
+        result = build38finder.at_many(chroms, positions)
+        assert len(result) == len(positions)
+        assert result.to_lists() == [build38finder.at(c, p) for c, p in zip(chroms, positions)]
+
+    def test_columnar_output(self, build38finder):
+        result = build38finder.at_many('10', [112950250, 113588900])
+        assert result.offsets.tolist() == [0, 1, 3], 'The second position overlaps two genes'
+        assert result.symbol.tolist() == ['TCF7L2', 'HABP2', 'NRAP']
+        assert result.distances.tolist() == [0, 0, 0]
+        assert result.overlap.tolist() == [True, True, True]
+        assert result.query_index.tolist() == [0, 1, 1]
+
+        result = build38finder.at_many(['chr19'], [1234])
+        assert result.ensg.tolist() == ['ENSG00000176695.8']
+        assert result.distances.tolist() == [107104 - 1234]
+        assert result.overlap.tolist() == [False]
+
+    def test_unknown_chromosome(self, build38finder):
+        with pytest.raises(gene_exc.BadCoordinateException, match="99"):
+            build38finder.at_many(['1', 'chr99'], [1234, 1234])
+        result = build38finder.at_many(['1', 'chr99'], [1234, 1234], strict=False)
+        assert result.counts.tolist() == [1, 0]
+
+
+class TestCompactGeneLocator:
+    def test_matches_tree_locator(self, build38finder, build38compact):
+        for chrom, pos in [('chr19', 1234), ('chr10', 112950250), ('10', 113588900), ('10', 113589602),
+                           ('chrX', 155000000), ('MT', 5000), ('chr1', 10**9)]:
+            assert build38compact.at(chrom, pos) == build38finder.at(chrom, pos)
+
+    def test_matches_tree_locator_at_gene_boundaries(self, build38finder, build38compact):
+        chroms, positions = [], []
+        for ensg, (chrom, start, end, symbol) in list(build38finder._gene_info.items())[::7]:
+            for pos in (start - 1, start, end - 1, end):
+                chroms.append(chrom)
+                positions.append(pos)
+        expected = [build38finder.at(c, p) for c, p in zip(chroms, positions)]
+        assert [build38compact.at(c, p) for c, p in zip(chroms, positions)] == expected
+        assert build38compact.at_many(chroms, positions).to_lists() == expected
+
+    def test_warns_on_unknown_chromosome(self, build38compact):
+        with pytest.raises(gene_exc.BadCoordinateException, match="99"):
+            build38compact.at('chr99', 1234)
+        assert build38compact.at('chr99', 1234, strict=False) == []
+
+    def test_rejects_unknown_engine(self):
+        with pytest.raises(ValueError, match='engine'):
+            get_genelocator('GRCh38', engine='btree')
+
+
+class TestBinaryFormat:
+    def test_round_trip(self, build38finder, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38finder, path, metadata={'build': 'GRCh38'})
+        assert fileformat.is_locator_file(path)
+        assert not fileformat.is_locator_file(assets._get_cache_filepath('GRCh38', 32, 'common_genetypes'))
+
+        compact = get_genelocator(path, engine='compact')
+        assert compact.metadata == {'build': 'GRCh38'}
+        for chrom, pos in [('chr19', 1234), ('chr10', 112950250), ('10', 113588900)]:
+            assert compact.at(chrom, pos) == build38finder.at(chrom, pos)
+        assert compact.at_many(['10', '10'], [112950250, 113588900]).symbol.tolist() == ['TCF7L2', 'HABP2', 'NRAP']
+
+        tree = get_genelocator(path)
+        assert tree.at('10', 113588900) == build38finder.at('10', 113588900)
+
+    def test_rejects_other_versions(self, build38compact, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38compact, path)
+        with open(path, 'r+b') as f:
+            f.seek(len(fileformat.MAGIC))
+            f.write((fileformat.FORMAT_VERSION + 1).to_bytes(4, 'little'))
+        with pytest.raises(gene_exc.UnsupportedDatasetException, match='version'):
+            fileformat.load(path)
+
+
+class TestLazyLoading:
+    def test_loads_only_queried_chromosomes(self, build38finder, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38finder, path, metadata={'build': 'GRCh38'})
+        info = get_dataset_info(path)
+        assert info['metadata'] == {'build': 'GRCh38'} and info['n_genes'] == len(build38finder._gene_info)
+        assert info['chroms']['10'] == len(build38finder._its['10']) and sum(info['chroms'].values()) == info['n_genes']
+
+        lazy = get_genelocator(path, lazy=True, cache=False)
+        assert lazy.loaded_chroms == []
+        assert lazy.at('chr10', 113588900) == build38finder.at('chr10', 113588900)
+        assert lazy.at('10', 113588900, result='gene') == build38finder.at('10', 113588900, result='gene')
+        assert lazy.overlapping('chr10', 112950250, 113588900) == build38finder.overlapping('10', 112950250, 113588900)
+        assert lazy.loaded_chroms == ['10']
+        assert lazy.at_many(['19'], [1234]).to_lists() == [build38finder.at('19', 1234)]
+        assert lazy.loaded_chroms == ['10'], 'Batch queries read the file directly'
+        with pytest.raises(gene_exc.BadCoordinateException):
+            lazy.at('chr99', 5)
+
+        positions = differential.edge_positions(build38finder, max_per_chrom=20) + differential.random_positions(build38finder, 500)
+        assert differential.compare(build38finder, lazy, positions) == []
+        assert pickle.loads(pickle.dumps(lazy)).at('19', 1234) == build38finder.at('19', 1234)
+
+    def test_converts_pickles(self, build38finder, tmp_path, monkeypatch, user_cache_dir):
+        lazy = get_genelocator('GRCh38', lazy=True, cache=False)
+        assert lazy.loaded_chroms == [] and lazy.at('NC_000019.10', 1234) == build38finder.at('19', 1234)
+        assert gene_cache.estimate_memory(lazy) > 0, 'The mapped file counts'
+        info = get_dataset_info('GRCh38')
+        assert info['metadata']['build'] == 'GRCh38' and info['n_genes'] == len(build38finder._gene_info)
+        pickle_path = assets.locate_by_metadata('GRCh38', 32, 'common_genetypes', file_formats=('pickle',))
+        assert os.path.dirname(assets.find_binary_copy(pickle_path)) == os.path.join(user_cache_dir, 'genelocator')
+
+        source = str(tmp_path / 'genes.pickle.gz')
+        save_locator(build38finder, source)
+        monkeypatch.setenv(assets.CACHE_DIR_ENV, str(tmp_path / 'copies'))
+        get_genelocator(source, lazy=True, cache=False)
+        copy_path = assets.find_binary_copy(source)
+        assert os.path.dirname(copy_path) == str(tmp_path / 'copies')
+        save_locator(build38finder, source)
+        os.utime(source, ns=(0, 0))
+        assert assets.find_binary_copy(source) is None, 'A copy of an older pickle is not used'
+        assert isinstance(get_genelocator(source, lazy=True, cache=False), LazyGeneLocator)
+        assert assets.find_binary_copy(source) == copy_path
+
+        # If no copy can be saved, the pickle is loaded in full
+        (tmp_path / 'file').write_text('')
+        monkeypatch.setenv(assets.CACHE_DIR_ENV, str(tmp_path / 'file'))
+        locator = get_genelocator(source, lazy=True, cache=False)
+        assert type(locator) is GeneLocator and locator.at('19', 1234) == build38finder.at('19', 1234)
+        with pytest.raises(gene_exc.UnsupportedDatasetException):
+            get_dataset_info(source)
+
+    def test_concurrent_first_queries(self, build38finder, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38finder, path)
+        lazy = get_genelocator(path, lazy=True, cache=False)
+        with concurrent.futures.ThreadPoolExecutor(8) as pool:
+            answers = list(pool.map(lambda pos: lazy.at('1', pos), range(1000000, 1000800, 100)))
+        assert answers == [build38finder.at('1', pos) for pos in range(1000000, 1000800, 100)]
+        assert len(lazy._gene_info) == len(build38finder._its['1'])
+
+
+class TestTiling:
+    def test_matches_reference(self, build38finder, build38compact, tmp_path):
+        tiled = TiledGeneLocator.from_locator(build38compact)
+        positions = (differential.edge_positions(build38finder, max_per_chrom=200) +
+                     differential.random_positions(build38finder, 2000) + [('chr99', 5), ('10', -5)])
+        assert differential.compare(build38finder, tiled, positions) == []
+        assert tiled.at('10', 113588900, result='gene') == build38finder.at('10', 113588900, result='gene')
+        with pytest.raises(gene_exc.BadCoordinateException):
+            tiled.at('chr99', 5)
+
+        # A tiling is saved with the dataset, and read back (rather than recompiled) from the mapped file
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(tiled, path)
+        loaded = get_genelocator(path, engine='tiled', cache=False)
+        assert isinstance(loaded._tiling['10'].tile_starts, memoryview)
+        assert differential.compare(build38finder, loaded, positions) == []
+        assert not hasattr(get_genelocator(path, engine='compact', cache=False), '_tiling')
+
+    def test_ties(self):
+        # Gene ends at 100 and the next starts at 110: 104 is closer to the end, 105 is a tie (which goes to the start)
+        genes = [{'chrom': '1', 'start': 50, 'end': 100, 'ensg': 'A', 'symbol': 'A'},
+                 {'chrom': '1', 'start': 110, 'end': 120, 'ensg': 'B', 'symbol': 'B'},
+                 {'chrom': '1', 'start': 110, 'end': 115, 'ensg': 'C', 'symbol': 'C'}]
+        tiled = TiledGeneLocator.from_genes(genes)
+        reference = GeneLocator(genes)
+        for pos in range(0, 130):
+            assert tiled.at('1', pos, result='gene') == reference.at('1', pos, result='gene'), pos
+        assert [g['ensg'] for g in tiled.at('1', 104)] == ['A'] and [g['ensg'] for g in tiled.at('1', 105)] == ['B']
+
+
+class TestNameSearch:
+    def test_lookup(self, build38finder, build38compact):
+        for locator in (build38finder, build38compact):
+            expected = [{'chrom': '10', 'start': 112950247, 'end': 113167678, 'ensg': 'ENSG00000148737.17', 'symbol': 'TCF7L2'}]
+            assert locator.lookup('TCF7L2') == expected
+            assert locator.lookup('tcf7l2') == expected
+            assert locator.lookup('tcf7l2', case_sensitive=True) == []
+            assert locator.lookup('ENSG00000148737') == expected
+            assert locator.lookup('ensg00000148737.17', result='gene')[0].as_dict() == expected[0]
+            assert locator.lookup_many(['TCF7L2', 'NOT_A_GENE']) == [expected, []]
+
+            completions = locator.autocomplete('tcf7', limit=None)
+            assert [g['symbol'] for g in completions] == sorted(g['symbol'] for g in completions)
+            assert {'TCF7', 'TCF7L1', 'TCF7L2'} <= {g['symbol'] for g in completions}
+            assert len(locator.autocomplete('TCF', limit=3)) == 3
+            assert locator.autocomplete('ENSG00000148737') == expected
+
+    def test_shared_symbols(self):
+        genes = [{'chrom': '1', 'start': 1, 'end': 5, 'ensg': 'ENSG1.1', 'symbol': 'DUP'},
+                 {'chrom': '2', 'start': 1, 'end': 5, 'ensg': 'ENSG2.1', 'symbol': 'DUP'}]
+        assert [g['ensg'] for g in GeneLocator(genes).lookup('dup')] == ['ENSG1.1', 'ENSG2.1']
+        assert CompactGeneLocator.from_genes(genes).lookup('DUP', result='id') == [0, 1]
+
+
+class TestRegistry:
+    def test_routes_and_shares_strings(self, build38finder):
+        datasets = registry.DatasetRegistry()
+        common = datasets.load('GRCh38')
+        everything = datasets.load('hg38', 32, 'all')
+        assert datasets.load('GRCh38', 32, 'common_genetypes') is common
+        assert datasets.keys() == [(38, 32, 'common_genetypes'), (38, 32, 'all')]
+        with pytest.raises(gene_exc.UnsupportedDatasetException):
+            datasets.load('GRCh38', 32, 'coding')
+
+        for pos in (1234, 281040, 50000000):
+            assert datasets.at('GRCh38', '19', pos) == build38finder.at('19', pos)
+        assert datasets.at('GRCh38', '10', 113588900, geneset='all') == get_genelocator('GRCh38', common_genetypes_only=False).at('10', 113588900)
+
+        # Genes in both datasets refer to the very same string objects, everywhere they are stored
+        ensg = next(iter(common._gene_info))
+        shared = next(key for key in everything._gene_info if key == ensg)
+        assert shared is ensg
+        assert everything._gene_info[ensg][3] is common._gene_info[ensg][3]
+        chrom = common._gene_info[ensg][0]
+        interval = next(iv for iv in everything._its[chrom] if iv.data == ensg)
+        assert interval.data is ensg
+        assert ensg in common._gene_starts[chrom]._values and any(v is ensg for v in everything._gene_ends[chrom]._values)
+
+        usage = datasets.memory_usage()
+        assert list(usage) == ['GRCh38 gencode32 common_genetypes', 'GRCh38 gencode32 all', 'shared strings']
+        assert all(size > 0 for size in usage.values())
+
+
+class TestBackgroundLoading:
+    def test_handle(self, build38compact):
+        started = threading.Event()
+        handle = background.LoadHandle.start(lambda: started.wait(5) and build38compact, description='test')
+        assert not handle.ready() and not handle.done()
+        with pytest.raises(concurrent.futures.TimeoutError):
+            handle.wait(timeout=0.01)
+        started.set()
+        assert handle.wait(timeout=5) is build38compact
+        assert handle.ready() and handle.exception() is None
+        assert asyncio.get_event_loop().run_until_complete(self._await(handle)) is build38compact
+
+    @staticmethod
+    async def _await(handle):
+        return await handle
+
+    def test_errors_propagate(self, tmp_path):
+        handle = load_in_background(str(tmp_path / 'missing.gloc'), cache=False)
+        with pytest.raises(FileNotFoundError):
+            handle.wait(timeout=5)
+        assert handle.done() and not handle.ready()
+        assert isinstance(handle.exception(), FileNotFoundError)
+        with pytest.raises(FileNotFoundError):
+            asyncio.get_event_loop().run_until_complete(self._await(handle))
+
+    def test_registry_loads_in_order_asked(self):
+        datasets = registry.DatasetRegistry(engine='compact')
+        with concurrent.futures.ThreadPoolExecutor(2) as pool:
+            handles = [datasets.load_in_background('GRCh38', 32, geneset, executor=pool) for geneset in ('all', 'common_genetypes')]
+            locators = [handle.wait(timeout=60) for handle in handles]
+        assert datasets.items() == list(zip([(38, 32, 'all'), (38, 32, 'common_genetypes')], locators))
+
+
+class TestStartup:
+    def test_import_is_light(self, monkeypatch):
+        # Build-time and batch machinery are only imported when they are used
+        code = 'import sys, genelocator; print(sorted(m for m in ("numpy", "urllib.request", "pickle") if m in sys.modules))'
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True,
+                                env=dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+        assert output.stdout.decode().strip() == '[]'
+        from genelocator import get_genes_iterator  # a wrapper (module __getattr__ needs Python 3.7)
+        monkeypatch.setattr(download, 'get_genes_iterator', lambda build, **kwargs: iter([(build, kwargs)]))
+        assert list(get_genes_iterator('GRCh38', gencode_version=31)) == [('GRCh38', {'gencode_version': 31})]
+
+    def test_save_binary_copy(self, build38compact, tmp_path, monkeypatch):
+        source = assets._get_cache_filepath('GRCh38', 32, 'common_genetypes')
+        monkeypatch.setenv(assets.CACHE_DIR_ENV, str(tmp_path))
+        path = assets.save_binary_copy(source, build38compact, metadata=assets.get_metadata('GRCh38', 32, 'common_genetypes'))
+        assert os.path.dirname(path) == str(tmp_path) and assets.find_binary_copy(source) == path
+        assert fileformat.read_info(path)['metadata']['geneset'] == 'common_genetypes'
+        (tmp_path / 'file').write_text('')
+        monkeypatch.setenv(assets.CACHE_DIR_ENV, str(tmp_path / 'file'))
+        assert assets.save_binary_copy(source, build38compact) is None
+
+
+class TestCacheDir:
+    def test_finds_bundled_data_outside_cache_dir(self, tmp_path, monkeypatch):
+        monkeypatch.setenv(assets.CACHE_DIR_ENV, str(tmp_path))
+        assert assets._get_cache_filepath('GRCh38', 32, 'all') == str(tmp_path / 'genes-grch38-gencode32-all.pickle.gz')
+        path = assets.locate_by_metadata('GRCh38', 32, 'all')
+        assert os.path.dirname(path) == assets.PACKAGE_DATA_DIR
+
+    def test_concurrent_fetches_build_once(self, tmp_path, monkeypatch):
+        calls = []
+
+        def fake_build(builds, versions, genesets, *, file_formats, out_dir):
+            calls.append(out_dir)
+            time.sleep(0.2)  # long enough for every other caller to be waiting on the lock
+            path = os.path.join(out_dir, 'genes-grch38-gencode99-all.pickle.gz')
+            with open(path, 'wb'):
+                pass
+            return {('GRCh38', 99, 'all'): [path]}
+
+        monkeypatch.setattr(build, 'build_datasets', fake_build)
+        with concurrent.futures.ThreadPoolExecutor(4) as pool:
+            paths = list(pool.map(lambda _: assets.locate_by_metadata('GRCh38', 99, 'all', auto_fetch=True, file_formats=('pickle',),
+                                                                      cache_dir=str(tmp_path / 'cache')),
+                                  range(4)))
+        assert calls == [str(tmp_path / 'cache')]
+        assert paths == [str(tmp_path / 'cache' / 'genes-grch38-gencode99-all.pickle.gz')] * 4
+
+
+class TestAnnotateStream:
+    LINES = ['##fileformat=VCFv4.2\n', '#CHROM\tPOS\tID\n', 'chr19\t1234\trs1\n', '10\t113588900\trs2\n', 'chr99\t5\trs3\n']
+
+    def test_tsv_output(self, build38finder):
+        out = io.StringIO()
+        count = annotate.annotate_stream(build38finder, self.LINES, out, input_format='vcf', chunk_size=2)
+        assert count == 3
+        assert out.getvalue().splitlines() == [
+            '##fileformat=VCFv4.2',
+            '#CHROM\tPOS\tID',
+            'chr19\t1234\trs1\t19\t107104\t117102\tENSG00000176695.8\tOR4F17\t105870',
+            '10\t113588900\trs2\t10,10\t113550837,113588716\t113589602,113664127\t'
+            'ENSG00000148702.15,ENSG00000197893.13\tHABP2,NRAP\t0,0',
+            'chr99\t5\trs3\t\t\t\t\t\t',
+        ]
+
+    def test_json_output_with_header_and_columns(self, build38finder):
+        lines = ['rsid,chrom,pos\n', 'rs1,chr19,1234\n', 'rs2,10,113588900\n']
+        out = io.StringIO()
+        annotate.annotate_stream(build38finder, lines, out, chrom_col=1, pos_col=2, delimiter=',', header=True,
+                                 output_format='json')
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        assert [[g['symbol'] for g in r['genes']] for r in records] == [['OR4F17'], ['HABP2', 'NRAP']]
+
+        out = io.StringIO()
+        annotate.annotate_stream(build38finder, lines, out, chrom_col=1, pos_col=2, delimiter=',', header=True,
+                                 output_format='genes')
+        assert out.getvalue().splitlines()[0] == 'chr19,1234,19,107104,117102,ENSG00000176695.8,OR4F17,105870'
+
+    def test_bed_positions_are_shifted(self, build38finder):
+        out = io.StringIO()
+        annotate.annotate_stream(build38finder, ['chr10\t112950246\t112950247\n'], out, input_format='bed',
+                                 output_format='genes')
+        assert out.getvalue().split('\t')[:2] == ['chr10', '112950247']
+        assert 'TCF7L2' in out.getvalue()
+
+    def test_reads_gzipped_input(self, tmp_path):
+        path = tmp_path / 'positions.tsv.gz'
+        with gzip.open(str(path), 'wt') as f:
+            f.writelines(self.LINES)
+        with annotate.open_input(str(path)) as f:
+            assert list(f) == self.LINES
+
+    def test_reports_bad_rows(self, build38finder):
+        with pytest.raises(gene_exc.BadCoordinateException, match='Line 2'):
+            annotate.annotate_stream(build38finder, ['chr1\t5\n', 'chr1\tabc\n'], io.StringIO())
+
+    def test_parallel_matches_serial(self, build38finder, tmp_path):
+        lines = ['# comment\n', 'chrom\tpos\n'] + ['chr{}\t{}\n'.format(i % 22 + 1, i * 7919 % 10**8) for i in range(490)]
+        lines[100:100] = ['NC_000019.10\t{}\n'.format(i * 1000) for i in range(10)]  # workers know the build too
+        expected = io.StringIO()
+        annotate.annotate_stream(build38finder, lines, expected, header=True)
+        path = str(tmp_path / 'locator.gloc')
+        fileformat.write(build38finder, path)
+        for dataset in (path, build38finder):
+            out = io.StringIO()
+            count = annotate.annotate_parallel(dataset, lines, out, processes=2, header=True, chunk_size=37)
+            assert count == 500
+            assert out.getvalue() == expected.getvalue()
+        with pytest.raises(gene_exc.BadCoordinateException, match='Line 42'):
+            annotate.annotate_parallel(path, ['chr1\t5\n'] * 41 + ['chr1\tabc\n'], io.StringIO(), processes=2, chunk_size=10)
+
+
+class TestSweep:
+    def test_matches_single_queries(self, build38finder, build38compact):
+        records = [('chr1', 1), ('chr1', 11869), ('chr1', 14409), ('chr1', 65418), ('chr1', 10**9),
+                   ('chr10', 112950247), ('chr10', 113588900), ('chr10', 113589602), ('19', 1234), ('19', 1234)]
+        expected = [build38finder.at(c, p) for c, p in records]
+        for locator in (build38finder, build38compact):
+            assert [genes for record, genes in sweep(locator, records)] == expected
+
+    def test_unsorted_input(self, build38finder):
+        records = [('10', 113588900), ('10', 112950250), ('19', 1234), ('10', 113588900)]
+        with pytest.raises(gene_exc.UnsortedInputException, match='112950250'):
+            list(sweep(build38finder, records))
+        results = sweep(build38finder, records, on_unsorted='fallback')
+        assert [genes for record, genes in results] == [build38finder.at(c, p) for c, p in records]
+
+    def test_unknown_chromosome(self, build38finder):
+        with pytest.raises(gene_exc.BadCoordinateException, match='99'):
+            list(sweep(build38finder, [('chr99', 1)]))
+        records = [('chr99', 5), ('chr99', 1), ('19', 1234)]
+        assert [len(genes) for record, genes in sweep(build38finder, records, strict=False)] == [0, 0, 1]
+
+
+class TestLocatorCache:
+    def test_get_genelocator_reuses_loaded_locators(self, build38finder):
+        assert get_genelocator('GRCh38', gencode_version=32, common_genetypes_only=True) is build38finder
+        assert get_genelocator('GRCh38', cache=False) is not build38finder
+
+    def test_reloads_changed_files(self, build38compact, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38compact, path)
+        first = get_genelocator(path, engine='compact')
+        assert get_genelocator(path, engine='compact') is first
+        os.utime(path, ns=(0, 0))
+        assert get_genelocator(path, engine='compact') is not first
+
+    def test_concurrent_loads_share_one_load(self):
+        cache = gene_cache.LocatorCache()
+        calls = []
+
+        def load():
+            calls.append(1)
+            time.sleep(0.1)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get('key', load))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert len(calls) == 1
+        assert len(set(map(id, results))) == 1
+        assert cache.stats()['misses'] == 1 and cache.stats()['hits'] == 4
+
+    def test_errors_are_not_cached(self):
+        cache = gene_cache.LocatorCache()
+
+        def fail():
+            raise gene_exc.NoCachedDataException()
+        with pytest.raises(gene_exc.NoCachedDataException):
+            cache.get('key', fail)
+        assert cache.get('key', lambda: 'ok') == 'ok'
+
+    def test_evicts_least_recently_used(self, build38compact):
+        cache = gene_cache.LocatorCache(max_entries=2)
+        cache.get('a', lambda: 'a')
+        cache.get('b', lambda: 'b')
+        cache.get('a', lambda: 'unused')
+        cache.get('c', lambda: 'c')
+        assert cache.get('a', lambda: 'reloaded') == 'a'
+        assert cache.get('b', lambda: 'reloaded') == 'reloaded', 'b was the least recently used entry'
+        assert cache.stats()['evictions'] == 2
+
+        cache = gene_cache.LocatorCache(max_bytes=1)
+        cache.get('a', lambda: build38compact)
+        cache.get('b', lambda: build38compact)
+        assert cache.stats()['entries'] == 1, 'The newest entry is kept even if it is over budget'
+
+
+class TestRangeAndNearestQueries:
+    def test_overlapping(self, build38finder, build38compact):
+        for locator in (build38finder, build38compact):
+            genes = locator.overlapping('chr10', 112950000, 113600000)
+            assert [g['symbol'] for g in genes] == ['TCF7L2', 'HABP2', 'NRAP']
+            assert locator.overlapping('10', 113588900, 113588900) == build38finder.at('10', 113588900)
+            assert locator.overlapping('10', 112950000, 112950246) == [], 'Window ends just before TCF7L2'
+            with pytest.raises(gene_exc.BadCoordinateException):
+                locator.overlapping('10', 5, 4)
+
+    def test_overlapping_many(self, build38finder, build38compact):
+        windows = [('chr10', 112950000, 113600000), ('19', 1, 1234), ('10', 113588900, 113588900)]
+        expected = [build38finder.overlapping(*w) for w in windows]
+        for locator in (build38finder, build38compact):
+            result = locator.overlapping_many(*zip(*windows))
+            assert result.to_lists() == expected
+
+    def test_nearest(self, build38finder, build38compact):
+        for locator in (build38finder, build38compact):
+            genes = locator.nearest('chr19', 1234, k=3)
+            assert [g['symbol'] for g in genes][0] == 'OR4F17'
+            assert [g['distance'] for g in genes] == sorted(g['distance'] for g in genes)
+            assert genes[0]['distance'] == 107104 - 1234
+
+            genes = locator.nearest('10', 113588900, k=3)
+            assert [(g['symbol'], g['distance']) for g in genes[:2]] == [('HABP2', 0), ('NRAP', 0)]
+
+            assert locator.nearest('chr19', 1234, k=3, max_distance=1000) == []
+            genes = locator.nearest('10', 113588900, k=None, max_distance=500000)
+            assert genes and all(g['distance'] <= 500000 for g in genes)
+
+    def test_nearest_many(self, build38finder):
+        assert build38finder.nearest_many(['19', '10'], [1234, 112950250]) == [
+            build38finder.nearest('19', 1234), build38finder.nearest('10', 112950250)]
+
+
+class TestGencodeIngest:
+    GTF_LINES = [
+        '##description: a tiny GENCODE-like file',
+        'chr1\tHAVANA\tgene\t100\t200\t.\t+\t.\tgene_id "ENSG01.1"; gene_type "protein_coding"; gene_name "AAA";',
+        'chr1\tHAVANA\ttranscript\t100\t200\t.\t+\t.\tgene_id "ENSG01.1"; transcript_id "ENST01.1"; gene_type "protein_coding"; gene_name "AAA";',
+        'chr1\tHAVANA\tgene\t150\t400\t.\t-\t.\tgene_id "ENSG02.3"; gene_type "misc_RNA"; gene_name "BBB";',
+        'GL000009.2\tENSEMBL\tgene\t1\t50\t.\t+\t.\tgene_id "ENSG03.1"; gene_type "lincRNA"; gene_name "CCC";',
+        'chrX\tHAVANA\tgene\t1000\t2000\t.\t+\t.\tgene_id "ENSGR04.1"; gene_type "protein_coding"; gene_name "DDD";',
+    ]
+
+    @pytest.fixture
+    def gtf_path(self, tmp_path):
+        path = str(tmp_path / 'tiny.gtf.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('\n'.join(self.GTF_LINES) + '\n')
+        return path
+
+    def test_stream_local_file(self, gtf_path, tmp_path):
+        timings = download.BuildTimings()
+        genes = list(download.get_genes_iterator('GRCh38', common_genetypes_only=False, source=gtf_path, timings=timings,
+                                                 cache_dir=str(tmp_path)))
+        assert [g['ensg'] for g in genes] == ['ENSG01.1', 'ENSG02.3', 'ENSGR04.1'], 'Skips transcripts and GL contigs'
+        assert genes[0] == {'chrom': 'chr1', 'start': 100, 'end': 200, 'ensg': 'ENSG01.1', 'symbol': 'AAA'}
+        assert all(seconds >= 0 for seconds in timings.seconds.values())
+
+        url = 'file://' + gtf_path
+        out_path = str(tmp_path / 'tiny.gloc')
+        locator = download.make_gene_locator('GRCh38', out_path, common_genetypes_only=True, source=url, timings=timings,
+                                             cache_dir=str(tmp_path))
+        assert [g['symbol'] for g in locator.at('1', 160)] == ['AAA'], 'misc_RNA is not a common genetype'
+        assert get_genelocator(out_path, engine='compact').at('X', 1500)[0]['symbol'] == 'DDD'
+        assert timings.seconds['index'] > 0 and timings.seconds['serialize'] > 0
+
+    def test_build_datasets(self, gtf_path, tmp_path):
+        sources = {('GRCh38', 32): gtf_path, ('GRCh37', 32): gtf_path}
+        written = build.build_datasets(['GRCh38', 'hg19', 'GRCh37'], [32], out_dir=str(tmp_path), sources=sources, processes=2)
+        assert sorted(written) == [('GRCh38', 32, 'all'), ('GRCh38', 32, 'common_genetypes'),
+                                   ('hg19', 32, 'all'), ('hg19', 32, 'common_genetypes')], 'hg19 and GRCh37 are built once'
+        paths = written[('GRCh38', 32, 'all')]
+        assert [os.path.basename(p) for p in paths] == ['genes-grch38-gencode32-all.gloc', 'genes-grch38-gencode32-all.pickle.gz']
+        assert len(get_genelocator(paths[0], engine='compact').at('1', 160)) == 2
+        assert len(get_genelocator(paths[1]).at('1', 160)) == 2
+        common = get_genelocator(written[('hg19', 32, 'common_genetypes')][0])
+        assert [g['symbol'] for g in common.at('1', 160)] == ['AAA']
+        assert not [name for name in os.listdir(str(tmp_path)) if name.startswith('.tmp-')]
+
+
+class TestGeneListCache:
+    def test_round_trip(self, tmp_path):
+        genes = [{'chrom': 'chr1', 'start': 100, 'end': 200, 'ensg': 'ENSG01.1', 'symbol': 'AAA', 'genetype': 'protein_coding'},
+                 {'chrom': 'chr2', 'start': 5, 'end': 50, 'ensg': 'ENSG02.1', 'symbol': 'BÉB', 'genetype': 'lincRNA'}]
+        path = str(tmp_path / 'genes.genes.gz')
+        genelist.GeneList.from_genes(genes, metadata={'source': 'x'}).write(path)
+        loaded = genelist.read(path)
+        assert loaded.metadata == {'source': 'x'}
+        assert list(loaded.genes()) == [{k: v for k, v in g.items() if k != 'genetype'} for g in genes]
+        assert [g['ensg'] for g in loaded.genes({'lincRNA'})] == ['ENSG02.1']
+
+    def test_rebuild_without_gtf(self, tmp_path, monkeypatch):
+        path = str(tmp_path / 'tiny.gtf.gz')
+        with gzip.open(path, 'wt') as f:
+            f.write('\n'.join(TestGencodeIngest.GTF_LINES) + '\n')
+        cache_dir = str(tmp_path)
+        first = list(download.get_genes_iterator('GRCh38', common_genetypes_only=False, source=path, cache_dir=cache_dir))
+        assert os.path.exists(os.path.join(cache_dir, 'gencode-38-gencode32.genes.gz'))
+
+        def no_gtf(*args, **kwargs):
+            raise AssertionError('The GTF should not be read again')
+        monkeypatch.setattr(download, '_open_gencode_gtf', no_gtf)
+        assert list(download.get_genes_iterator('GRCh38', common_genetypes_only=False, source=path, cache_dir=cache_dir)) == first
+        common = list(download.get_genes_iterator('GRCh38', common_genetypes_only=True, source=path, cache_dir=cache_dir))
+        assert [g['symbol'] for g in common] == ['AAA', 'DDD']
+
+
+class TestDelta:
+    def test_upgrade_matches_fresh_build(self, build38finder, tmp_path):
+        old_genes = [build38finder._serialize(ensg) for ensg in build38finder._gene_info]
+        new_genes = []
+        for i, gene in enumerate(old_genes):
+            if gene['chrom'] == '21' and i % 10 == 0:
+                continue  # removed
+            if gene['chrom'] == '21' and i % 10 == 1:
+                gene = dict(gene, ensg=gene['ensg'].split('.')[0] + '.99', end=gene['end'] + 1000)  # changed
+            new_genes.append(gene)
+            if gene['chrom'] == 'Y' and i % 10 == 2:
+                new_genes.append(dict(gene, ensg='ENSGNEW{}.1'.format(i), start=gene['start'] + 7))  # added
+        changes = delta.compare(build38finder, new_genes)
+        assert len(changes.removed) == sum(1 for i, g in enumerate(old_genes) if g['chrom'] == '21' and i % 10 == 0)
+        assert {new.ensg.endswith('.99') for old, new in changes.changed} == {True}
+        assert {gene.chrom for gene in changes.added} == {'Y'}
+
+        path = str(tmp_path / ('upgrade' + delta.EXTENSION))
+        delta.make_delta(build38finder, iter(new_genes), metadata={'gencode_version': 33}).write(path)
+        patch = delta.read(path)
+        assert sorted(patch.edits) == ['21', 'Y'] and patch.metadata == {'gencode_version': 33}
+        upgraded = delta.apply(build38finder, patch)
+        fresh = GeneLocator(new_genes)
+        assert upgraded._gene_info == fresh._gene_info and delta.fingerprint(upgraded) == delta.fingerprint(fresh)
+        assert upgraded._its['1'] is build38finder._its['1'], 'Unchanged chromosomes are not indexed again'
+        for chrom in ('21', 'Y'):
+            assert set(upgraded._its[chrom]) == set(fresh._its[chrom])
+            assert upgraded._gene_starts[chrom]._values == fresh._gene_starts[chrom]._values
+        for chrom, pos in [('21', 5000000), ('21', 30000000), ('Y', 2800000), ('Y', 20000000), ('1', 1234)]:
+            assert upgraded.at(chrom, pos) == fresh.at(chrom, pos)
+        assert len(build38finder._its['21']) == sum(1 for g in old_genes if g['chrom'] == '21'), 'The old locator is unchanged'
+
+        with pytest.raises(gene_exc.UnsupportedDatasetException):
+            delta.apply(fresh, patch)
+        assert not delta.compare(fresh, upgraded)
+        # The order that genes come in (or that a dict keeps them in) doesn't matter
+        assert delta.fingerprint(reversed(new_genes)) == delta.fingerprint(fresh) == delta.fingerprint(GeneLocator(reversed(new_genes)))
+
+
+class TestFrames:
+    CHROMS = ['chr19', '10', 'chr99', '10', 'X']
+    POSITIONS = [1234, 112950250, 5, 113588900, 155000000]
+
+    def test_dataframe(self, build38compact):
+        pd = pytest.importorskip('pandas')
+        df = pd.DataFrame({'chrom': self.CHROMS, 'pos': self.POSITIONS})
+        first = frames.annotate_dataframe(build38compact, df)
+        assert list(first.columns) == ['chrom', 'pos'] + list(frames.COLUMNS)
+        assert isinstance(first['symbol'].dtype, pd.CategoricalDtype) and isinstance(first['gene_chrom'].dtype, pd.CategoricalDtype)
+        assert first['symbol'].tolist()[:2] == ['OR4F17', 'TCF7L2'] and first['symbol'].tolist()[3] == 'HABP2'
+        assert pd.isna(first['ensg'][2]) and pd.isna(first['distance'][2])
+        assert first['distance'].tolist()[:2] == [107104 - 1234, 0] and first['overlap'].tolist()[3] is True
+
+        exploded = frames.annotate_dataframe(build38compact, df.astype({'chrom': 'category'}), multiple='explode')
+        expected = [build38compact.at(c, p, strict=False) or [None] for c, p in zip(self.CHROMS, self.POSITIONS)]
+        assert exploded.index.tolist() == [i for i, genes in enumerate(expected) for _ in genes]
+        assert [None if pd.isna(e) else e for e in exploded['ensg']] == [g and g['ensg'] for genes in expected for g in genes]
+        with pytest.raises(gene_exc.BadCoordinateException):
+            frames.annotate_dataframe(build38compact, df, strict=True)
+
+        with pytest.raises(ValueError, match="'symbol'"):
+            frames.annotate_dataframe(build38compact, df.assign(symbol='mine'))
+        prefixed = frames.annotate_dataframe(build38compact, df.assign(symbol='mine'), prefix='gene_')
+        assert prefixed['symbol'].tolist() == ['mine'] * len(df) and prefixed['gene_symbol'].tolist()[0] == 'OR4F17'
+
+    def test_arrow(self, build38finder):
+        pd = pytest.importorskip('pandas')
+        pa = pytest.importorskip('pyarrow')
+        table = pa.table({'chrom': self.CHROMS, 'pos': self.POSITIONS})
+        annotated = frames.annotate_arrow(build38finder, table, multiple='explode')
+        assert pa.types.is_dictionary(annotated.schema.field('symbol').type)
+        expected = frames.annotate_dataframe(build38finder, pd.DataFrame({'chrom': self.CHROMS, 'pos': self.POSITIONS}),
+                                             multiple='explode')
+        assert annotated.column('gene_start').to_pylist() == [None if pd.isna(v) else v for v in expected['gene_start']]
+        assert annotated.column('symbol').to_pylist() == [None if pd.isna(v) else v for v in expected['symbol']]
+        with pytest.raises(ValueError, match="'distance'"):
+            frames.annotate_arrow(build38finder, table.append_column('distance', pa.array([1] * len(self.CHROMS))))
+
+
+class TestContigs:
+    def test_spellings(self, build38finder, build38compact):
+        tiled = TiledGeneLocator.from_locator(build38compact)
+        for locator in (build38finder, build38compact, tiled):
+            for name in ('NC_000019.10', 'CHR19', 'Chr19'):
+                assert locator.at(name, 1234) == build38finder.at('19', 1234)
+            assert locator.at('NC_012920.1', 500) == locator.at('chrMT', 500) == build38finder.at('M', 500)
+            with pytest.raises(gene_exc.BadCoordinateException, match='NC_000019.9'):
+                locator.at('NC_000019.9', 1234)  # chr19 of GRCh37
+            with pytest.raises(gene_exc.BadCoordinateException, match="'99'"):
+                locator.at('chr99', 5)
+        assert build38finder.nearest('NC_000010.11', 113588900) == build38finder.nearest('10', 113588900)
+        assert metrics._chrom_label('NC_000019.10') == metrics._chrom_label('chr19') == '19'
+
+        assert contigs.ContigIndex(['19'], build='hg19').resolve('NC_000019.9') == '19'
+        # Without a build, no accession can be trusted
+        assert contigs.ContigIndex(['19']).resolve('NC_000019.10') == 'NC_000019.10'
+
+    def test_contig_ids(self, build38finder, build38compact):
+        chroms = ['chr19', 'NC_000010.11', 'chr99', '10', 'X']
+        positions = [1234, 112950250, 5, 113588900, 155000000]
+        for locator in (build38finder, build38compact):
+            ids = locator.contig_ids(chroms)
+            assert ids[2] == -1 and ids[1] == ids[3]
+            assert (locator.at_many(None, positions, strict=False, contig_ids=ids).to_lists() ==
+                    locator.at_many(chroms, positions, strict=False).to_lists())
+
+    def test_saved_with_dataset(self, build38finder, tmp_path):
+        path = str(tmp_path / 'genes.gloc')
+        save_locator(build38finder, path)
+        with open(path, 'rb') as f:
+            _, header = fileformat._read_preamble(f)
+        assert header['contig_aliases']['NC_000019.10'] == '19' and header['contig_build'] == 38
+        assert 'NC_000019.9' not in header['contig_aliases']
+        lazy = get_genelocator(path, lazy=True, cache=False)
+        assert lazy.at('NC_000019.10', 1234) == build38finder.at('19', 1234) and lazy.loaded_chroms == ['19']
+
+        assert '_contigs' in pickle.loads(pickle.dumps(GeneLocator([]))).__dict__
+        old = pickle.loads(pickle.dumps(build38finder))
+        old.__dict__.pop('_contigs', None)  # as in datasets pickled before aliases were saved
+        assert old.at('chr19', 1234) == build38finder.at('19', 1234)
+        old._set_build('GRCh38')  # as `get_genelocator` does, for a known build
+        assert old.at('NC_000019.10', 1234) == build38finder.at('19', 1234)
+        assert pickle.loads(pickle.dumps(lazy)).at('NC_000019.10', 1234) == build38finder.at('19', 1234)
+
+
+class TestServer:
+    @staticmethod
+    async def _request(port, method, path, body=b'', content_type='application/json'):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write('{} {} HTTP/1.1\r\nHost: localhost\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            method, path, content_type, len(body)).encode() + body)
+        response = await reader.read()
+        writer.close()
+        head, _, content = response.partition(b'\r\n\r\n')
+        return int(head.split()[1]), content
+
+    def test_endpoints(self, build38compact):
+        service = server.LocatorService({('GRCh38', 32, 'common_genetypes'): build38compact}, batch_window=0.01)
+
+        async def scenario():
+            srv = await service.start('127.0.0.1', 0)
+            port = srv.sockets[0].getsockname()[1]
+            try:
+                positions = [('chr19', 1234), ('10', 113588900), ('chr10', 112950250)] * 20
+                answers = await asyncio.gather(*(self._request(port, 'GET', '/locate?chrom={}&pos={}'.format(*p))
+                                                 for p in positions))
+                for (chrom, pos), (status, content) in zip(positions, answers):
+                    assert status == 200
+                    assert json.loads(content) == {'chrom': chrom, 'pos': pos, 'genes': build38compact.at(chrom, pos)}
+                assert service.stats.batches < len(positions), 'Concurrent lookups share batches'
+
+                status, content = await self._request(port, 'POST', '/locate?build=hg38', json.dumps(positions[:3]).encode())
+                assert status == 200 and [a['genes'] for a in json.loads(content)] == [build38compact.at(*p) for p in positions[:3]]
+                ndjson = b'{"chrom": "19", "pos": 1234}\n{"chrom": "chr10", "pos": "113588900"}\n'
+                status, content = await self._request(port, 'POST', '/locate', ndjson, server.NDJSON_TYPE)
+                lines = [json.loads(line) for line in content.splitlines()]
+                assert status == 200 and lines[0]['genes'] == build38compact.at('19', 1234)
+                assert lines[1] == {'chrom': 'chr10', 'pos': 113588900, 'genes': build38compact.at('10', 113588900)}
+
+                assert (await self._request(port, 'GET', '/locate?chrom=nope&pos=5'))[0] == 400
+                assert (await self._request(port, 'GET', '/locate?chrom=1&pos=5&geneset=all'))[0] == 404
+                status, content = await self._request(port, 'GET', '/health')
+                assert status == 200 and json.loads(content)['status'] == 'ok'
+                status, content = await self._request(port, 'GET', '/stats')
+                stats = json.loads(content)
+                assert stats['requests']['/locate'] == len(positions) + 4 and stats['errors'] == 2
+                assert stats['latency_ms']['p99'] is not None
+            finally:
+                srv.close()
+                await srv.wait_closed()
+        asyncio.get_event_loop().run_until_complete(scenario())
+
+    def test_bad_position_only_fails_its_own_request(self, build38compact):
+        service = server.LocatorService({('GRCh38', 32, 'common_genetypes'): build38compact}, batch_window=0.05)
+
+        async def scenario():
+            srv = await service.start('127.0.0.1', 0)
+            port = srv.sockets[0].getsockname()[1]
+            try:
+                (good, content), (bad, _) = await asyncio.gather(
+                    self._request(port, 'GET', '/locate?chrom=19&pos=1234'),
+                    self._request(port, 'GET', '/locate?chrom=19&pos=99999999999999999999999'))
+                assert good == 200 and json.loads(content)['genes'] == build38compact.at('19', 1234)
+                assert bad == 400
+                status, _ = await self._request(port, 'POST', '/locate', b'[["19", 1234], ["19", 99999999999999999999999]]')
+                assert status == 400
+                # Both endpoints reject the same things, rather than failing inside the lookup
+                for body in (b'[[19, 1234]]', b'[{"chrom": null, "pos": 1234}]', b'[["19", 1.5]]', b'[["19", true]]',
+                             b'[["19", 1234], ["nope", 5]]'):
+                    status, content = await self._request(port, 'POST', '/locate', body)
+                    assert status == 400, body
+                assert b'nope' in content
+                for query in ('chrom=19&pos=1.5', 'chrom=nope&pos=5'):
+                    assert (await self._request(port, 'GET', '/locate?' + query))[0] == 400
+            finally:
+                srv.close()
+                await srv.wait_closed()
+        asyncio.get_event_loop().run_until_complete(scenario())
+
+        # Queries that fail inside a batch (whatever the reason) fail on their own
+        loop = asyncio.get_event_loop()
+        batcher = server._MicroBatcher(build38compact, service.stats, batch_window=10, max_batch_size=2)
+        good = batcher.locate('19', 1234)
+        bad = batcher.locate('19', 2 ** 70)
+        loop.run_until_complete(asyncio.wait([good, bad]))
+        assert good.result() == build38compact.at('19', 1234)
+        assert isinstance(bad.exception(), OverflowError)
+
+
+class TestResultTypes:
+    def test_records_and_ids(self, build38finder, build38compact):
+        for locator in (build38finder, build38compact):
+            for chrom, pos in [('10', 113588900), ('chr19', 1234)]:
+                dicts = locator.at(chrom, pos)
+                genes = locator.at(chrom, pos, result='gene')
+                assert [g.as_dict() for g in genes] == dicts
+                assert all(a is b for a, b in zip(genes, locator.at(chrom, pos, result='gene'))), 'Records are shared'
+                assert [locator.gene(key) for key in locator.at(chrom, pos, result='id')] == genes
+            assert [g.symbol for g in locator.overlapping('chr10', 112950000, 113600000, result='gene')] == ['TCF7L2', 'HABP2', 'NRAP']
+            with pytest.raises(ValueError):
+                locator.at('1', 1, result='tuple')
+
+
+class TestDifferential:
+    def test_engines_and_batch_paths_agree(self, build38finder, build38compact):
+        positions = (differential.edge_positions(build38finder, max_per_chrom=20) +
+                     differential.random_positions(build38finder, 1000) + [('chr99', 5)])
+        for candidate in (build38finder, build38compact):
+            assert differential.compare(build38finder, candidate, positions) == []
+
+    def test_reports_mismatches(self, build38finder):
+        class Broken:
+            def __init__(self, locator):
+                self._locator = locator
+
+            def __getattr__(self, name):
+                return getattr(self._locator, name)
+
+            def at(self, chrom, pos, **kwargs):
+                return self._locator.at(chrom, pos, **kwargs)[:1]  # drops all but the first overlapping gene
+        mismatches = differential.compare(build38finder, Broken(build38finder), [('10', 112950250), ('10', 113588900)])
+        assert [(m.path, m.pos, len(m.actual)) for m in mismatches] == [('at', 113588900, 1), ('at(result=gene)', 113588900, 1)]
+
+
+class TestMetrics:
+    def test_records_lookups_and_loads(self, build38finder, build38compact, tmp_path):
+        events = []
+        recorder = metrics.enable(metrics.Metrics(callback=lambda *event: events.append(event)))
+        try:
+            for locator in (build38finder, build38compact):
+                locator.at('chr10', 113588900)
+                locator.at('19', 1234)
+                locator.at('nope', 1, strict=False)
+                with pytest.raises(gene_exc.BadCoordinateException):
+                    locator.at('nope', 1)
+                locator.at_many(['1', '2'], [1, 2])
+            path = str(tmp_path / 'locator.gloc')
+            fileformat.write(build38compact, path)
+            get_genelocator(path, engine='compact', cache=False)
+        finally:
+            metrics.disable()
+
+        assert recorder.queries == {('10', 'overlap'): 2, ('19', 'nearest'): 2, ('other', 'unknown_chromosome'): 2,
+                                    ('other', 'error'): 2}
+        assert recorder.batches == 2 and recorder.batch_queries == 4
+        assert recorder.loads == {'compact': 1} and recorder.load_bytes == os.path.getsize(path)
+        assert [e[0] for e in events].count('query') == 8
+        text = recorder.to_prometheus()
+        assert 'genelocator_queries_total{chrom="10",outcome="overlap"} 2' in text
+        assert 'genelocator_query_duration_seconds_bucket{le="+Inf"} 8' in text
+        assert 'genelocator_loads_total{engine="compact"} 1' in text
+
+        build38finder.at('10', 113588900)
+        assert sum(recorder.queries.values()) == 8, 'Nothing is recorded once metrics are disabled'
+
+
 class TestBisectFinder:
     """Validate that the bisect finder works as expected"""
     def test_scenarios(self):